@@ -0,0 +1,335 @@
+#-*- coding: utf-8 -*-
+"""
+    dmlt.cache
+    ~~~~~~~~~~
+
+    Content addressed caches for rendered documents and node-trees.
+
+    A cache is enabled by setting the `cache` attribute of a machine::
+
+        >>> class CachedMachine(SimpleMarkupMachine):
+        ...     cache = LRUCache(max_size=32 * 1024 * 1024)
+
+    The keys are built from a fingerprint of the machine definition
+    (the machine class, its directives and their rules and code, and
+    the registered stream and tree callbacks) as well as the escaping
+    flag, the output format and the raw document.  Changing any of those
+    changes the key, so stale entries are never served.  Node classes
+    are not part of the fingerprint, bump `MarkupMachine.cache_version`
+    if their output changes.
+
+    :copyright: 2008 by Christopher Grebs.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import errno
+import tempfile
+from hashlib import sha1
+from functools import partial
+from threading import Lock
+from types import CodeType, FunctionType, MethodType
+from collections import OrderedDict
+from dmlt.filters import NodeFilter, TokenFilter
+
+
+__all__ = ('BaseCache', 'LRUCache', 'FileSystemCache', 'cache_key',
+           'machine_fingerprint')
+
+
+#: the events that change the output of a machine
+_FINGERPRINT_EVENTS = ('define-raw-directive', 'define-document-node',
+                       'process-stream', 'process-doc-tree')
+#: machine options that can be changed per instance
+_MACHINE_OPTIONS = ('_begin', '_end', 'escape_character', 'restrictive_mode',
+                    'max_nesting_depth')
+#: class attributes that are caches and never part of a fingerprint
+_IGNORED_ATTRIBUTES = frozenset(['__dict__', '__weakref__', '__doc__',
+                                 '__module__', '_lexer_table_cache',
+                                 '_fingerprint_cache', '_callback_cache',
+                                 '_pipeline_cache', '_stream_pipeline_cache',
+                                 'cache'])
+
+
+def _describe(value, depth=0):
+    """
+    Return a string that describes `value` and is stable between
+    processes (no memory addresses).
+    """
+    if depth > 8:
+        return '...'
+    depth += 1
+    if isinstance(value, CodeType):
+        return 'code(%r, %s, %r)' % (
+            value.co_code,
+            u', '.join(_describe(x, depth) for x in value.co_consts),
+            value.co_names
+        )
+    elif isinstance(value, MethodType):
+        return _describe(value.im_func, depth)
+    elif isinstance(value, FunctionType):
+        closure = value.func_closure or ()
+        return 'function(%s, %s, %s)' % (
+            _describe(value.func_code, depth),
+            _describe(value.func_defaults, depth),
+            _describe(tuple(c.cell_contents for c in closure), depth)
+        )
+    elif isinstance(value, partial):
+        # callbacks registered with `EventManager.register`
+        return 'partial(%s, %s, %s)' % (
+            _describe(value.func, depth),
+            _describe(value.args, depth),
+            _describe(sorted((value.keywords or {}).items()), depth)
+        )
+    elif isinstance(value, (staticmethod, classmethod)):
+        return _describe(value.__func__, depth)
+    elif isinstance(value, property):
+        return 'property(%s, %s)' % (_describe(value.fget, depth),
+                                     _describe(value.fset, depth))
+    elif isinstance(value, type):
+        return '%s.%s' % (value.__module__, value.__name__)
+    elif isinstance(value, (list, tuple)):
+        return '(%s)' % u', '.join(_describe(x, depth) for x in value)
+    elif hasattr(value, 'regex') and hasattr(value, 'enter'):
+        # a lexing rule
+        return 'rule(%r, %r, %s, %r, %r, %r)' % (
+            value.regex.pattern, value.regex.flags,
+            _describe(value.token, depth), value.enter, value.leave,
+            value.one
+        )
+    rv = repr(value)
+    if ' at 0x' in rv:
+        return value.__class__.__name__
+    return rv
+
+
+def _describe_class(cls):
+    """Describe a class and all the attributes it inherits."""
+    result = []
+    for base in cls.__mro__:
+        if base is object:
+            continue
+        result.append('%s.%s' % (base.__module__, base.__name__))
+        for key, value in sorted(vars(base).items()):
+            if key not in _IGNORED_ATTRIBUTES:
+                result.append('%s=%s' % (key, _describe(value)))
+    return '\n'.join(result)
+
+
+def machine_fingerprint(machine):
+    """
+    Return a hex digest describing the definition of `machine`.
+    The fingerprint is computed once per machine class and recomputed
+    if the directives or the registered callbacks change.
+    """
+    cls = machine.__class__
+    chains = machine.get_callback_chains()
+    callbacks = tuple(chains[x] for x in _FINGERPRINT_EVENTS)
+    signature = (tuple(machine.directives), callbacks)
+    cached = cls.__dict__.get('_fingerprint_cache')
+    if cached is None or cached[0] != signature:
+        digest = sha1(_describe_class(cls))
+        for directive in machine.directives:
+            digest.update('\0' + _describe_class(directive))
+        for event, items in zip(_FINGERPRINT_EVENTS, callbacks):
+            for callback in items:
+                if isinstance(callback, (NodeFilter, TokenFilter)):
+                    description = _describe_class(callback.__class__) + \
+                        _describe(sorted(vars(callback).items()))
+                else:
+                    description = '%s.%s %s' % (
+                        callback.__module__,
+                        getattr(callback, '__name__', ''),
+                        _describe(callback)
+                    )
+                digest.update('\0%s:%s' % (event, description))
+        cached = (signature, digest.hexdigest())
+        cls._fingerprint_cache = cached
+    return cached[1]
+
+
+def cache_key(machine, kind, raw, format=None, enable_escaping=False):
+    """
+    Return the cache key for processing `raw` with `machine`.
+
+    :param kind: What is cached, e.g. ``'render'`` or ``'parse'``.
+    """
+    if isinstance(raw, unicode):
+        raw = raw.encode('utf-8')
+    options = tuple(getattr(machine, x) for x in _MACHINE_OPTIONS)
+    return sha1('%s\0%r\0%r\0%s\0%s\0%d\0%s' % (
+        machine_fingerprint(machine), options, machine.cache_version, kind,
+        format, bool(enable_escaping), raw
+    )).hexdigest()
+
+
+class BaseCache(object):
+    """
+    Baseclass for all caches.  Keys are strings created by `cache_key`,
+    values are byte strings.
+
+    Subclasses implement `_get`, `_set` and `_clear` and increment
+    `evictions` if they drop entries on their own.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the value for `key` or `None` if it's not cached."""
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Store `value` under `key`."""
+        self._set(key, value)
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        self._clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return a dict with the hit, miss and eviction counters."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+    def _get(self, key):
+        raise NotImplementedError()
+
+    def _set(self, key, value):
+        raise NotImplementedError()
+
+    def _clear(self):
+        raise NotImplementedError()
+
+
+class LRUCache(BaseCache):
+    """
+    An in-process cache that drops the least recently used entries
+    once the stored values exceed `max_size` bytes.
+    """
+
+    def __init__(self, max_size=16 * 1024 * 1024):
+        BaseCache.__init__(self)
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def _get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+            return value
+
+    def _set(self, key, value):
+        size = len(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                key, old = self._entries.popitem(last=False)
+                self.size -= len(old)
+                self.evictions += 1
+
+    def _clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileSystemCache(BaseCache):
+    """
+    A cache that stores every entry in a file in `cache_dir` so that
+    it can be shared by multiple processes.  If there are more than
+    `threshold` entries the oldest ones are removed.
+    """
+
+    def __init__(self, cache_dir, threshold=500, mode=0600):
+        BaseCache.__init__(self)
+        self.cache_dir = cache_dir
+        self.threshold = threshold
+        self.mode = mode
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _get_filename(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _list_dir(self):
+        return [os.path.join(self.cache_dir, x)
+                for x in os.listdir(self.cache_dir)
+                if not x.startswith('.')]
+
+    def _prune(self):
+        # make room for one new entry
+        entries = self._list_dir()
+        if len(entries) < self.threshold:
+            return
+        def mtime(filename):
+            try:
+                return os.path.getmtime(filename)
+            except OSError:
+                return 0
+        entries.sort(key=mtime)
+        for filename in entries[:len(entries) - self.threshold + 1]:
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            self.evictions += 1
+
+    def _get(self, key):
+        try:
+            f = open(self._get_filename(key), 'rb')
+        except IOError:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def _set(self, key, value):
+        self._prune()
+        fd, tmp = tempfile.mkstemp(prefix='.', dir=self.cache_dir)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(value)
+            finally:
+                f.close()
+            filename = self._get_filename(key)
+            try:
+                os.rename(tmp, filename)
+            except OSError, e:
+                # windows doesn't replace existing files
+                if e.errno != errno.EEXIST:
+                    raise
+                os.remove(filename)
+                os.rename(tmp, filename)
+            os.chmod(filename, self.mode)
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _clear(self):
+        for filename in self._list_dir():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
@@ -11,10 +11,14 @@
 """
 import sys
 from copy import copy as ccopy
+from array import array
+from threading import Lock
+from collections import deque
 from dmlt.exc import StackEmpty
 
 
-__all__ = ('Token', 'TokenStream', 'Stack', 'Context')
+__all__ = ('Token', 'TokenStream', 'TokenTypeTable', 'CompactTokenBuffer',
+           'Stack', 'ContextStack', 'Context')
 
 
 _undefined = object()
@@ -110,9 +114,25 @@ class TokenStream(object):
         >>> stream.current
         <Token(20, None, None)>
 
-    As you see it's easy to manipulate the token stream. But note, never
-    push more then one token back to the stream. Although the stream object
-    won't stop you that behaviour is undefined!
+    As you see it's easy to manipulate the token stream.  Pushed tokens
+    and tokens looked at are kept in a buffer in stream order, so it's
+    possible to push back or look at any number of tokens::
+
+        # look two tokens ahead
+        >>> stream.look(2)
+        # or just at the types of the current and the next two tokens
+        >>> stream.peek_types(3)
+
+    For speculative parsing a position can be marked and the stream can
+    be rewound to it later on::
+
+        >>> mark = stream.mark()
+        >>> stream.skip(2)
+        >>> stream.rewind(mark)
+
+    Every marker must be either rewound to or `release`\d, the stream
+    keeps all tokens read since the oldest active marker.
+
     Well, a TokenStream supports as a generator object does some methods to
     walk through the stream. That's in fact the `next` and `expect` methods.
 
@@ -136,7 +156,11 @@ class TokenStream(object):
     def __init__(self, generator=None):
         generator = generator or iter([])
         self._next = generator.next
-        self._pushed = []
+        self._buffer = deque()
+        #: ``(marker, position)`` tuples in the order they were created
+        self._marks = []
+        self._last_marker = 0
+        self._history = None
         self.current = Token('initial', _undefined, _undefined)
         self.next()
 
@@ -145,17 +169,27 @@ class TokenStream(object):
         """
         Initialize the stream with an `iterable`. If the iterable-children
         are no `Token` instances they're wrapped into a `Token` one.
+
+        The iterable is consumed lazily, so the stream never holds more
+        tokens than the ones pushed back or looked at.
+        """
+        return cls(cls.iter_tokens(iterable or ()))
+
+    @staticmethod
+    def iter_tokens(iterable):
+        """
+        Return a generator that wraps the items of `iterable` into
+        `Token` instances like `from_tuple_iter` does.
         """
-        _iter = []
-        iterable = iterable or []
         for item in iterable:
-            if hasattr(item, 'as_tuple'):
-                _iter.append(item.as_tuple())
+            if item.__class__ is tuple:
+                yield Token(*item)
+            elif hasattr(item, 'as_tuple'):
+                yield Token(*item.as_tuple())
             elif isinstance(item, (tuple, set, frozenset, list)):
-                _iter.append(item)
+                yield Token(*item)
             else:
-                _iter.append((item,))
-        return cls(Token(*a) for a in _iter)
+                yield Token(item)
 
     def __iter__(self):
         return TokenStreamIterator(self)
@@ -163,7 +197,12 @@ class TokenStream(object):
     @property
     def eof(self):
         """Are we at the end of the tokenstream?"""
-        return not bool(self._pushed) and self.current.type == 'eof'
+        return not self._buffer and self.current.type == 'eof'
+
+    @property
+    def _pushed(self):
+        # backwards compatibility, tokens pushed back are in the buffer
+        return self._buffer
 
     def debug(self, stream=None):
         """Displays the tokenized code on the stream provided or stdout."""
@@ -172,23 +211,87 @@ class TokenStream(object):
         for token in self:
             stream.write(repr(token) + '\n')
 
-    def look(self):
-        """See what's the next token."""
-        if self._pushed:
-            return self._pushed[-1]
-        old_token = self.current
-        self.next()
-        new_token = self.current
-        self.current = old_token
-        self.push(new_token)
-        return new_token
+    def _fill(self, n):
+        """
+        Read tokens from the generator until `n` tokens are buffered.
+        Return `False` if the generator was exhausted before.
+        """
+        buffer = self._buffer
+        while len(buffer) < n:
+            try:
+                buffer.append(self._next())
+            except StopIteration:
+                return False
+        return True
+
+    def look(self, n=1):
+        """
+        See what's the `n`-th next token.  `look(0)` returns the
+        current token.
+        """
+        if n < 1:
+            return self.current
+        if len(self._buffer) >= n or self._fill(n):
+            return self._buffer[n - 1]
+        return Token('eof')
+
+    def peek_types(self, n):
+        """
+        Return a tuple with the types of the current token and
+        the next `n - 1` tokens.
+        """
+        if n > 1:
+            self._fill(n - 1)
+        return (self.current.type,) + tuple(
+            self.look(idx).type for idx in xrange(1, n))
 
     def push(self, token, current=False):
-        """Push a token back to the stream (only one!)."""
-        self._pushed.append(token)
+        """
+        Push a token back to the stream so that it's the next one.
+        If `current` is `True` the pushed token is the current one.
+        """
+        self._buffer.appendleft(token)
         if current:
             self.next()
 
+    def mark(self):
+        """
+        Remember the current position of the stream and return a
+        marker that can be passed to `rewind` or `release`.  Markers
+        are unique, even for the same position.
+        """
+        if not self._marks:
+            self._history = [self.current]
+        self._last_marker += 1
+        self._marks.append((self._last_marker, len(self._history) - 1))
+        return self._last_marker
+
+    def _find_mark(self, marker):
+        for idx, (other, position) in enumerate(self._marks):
+            if other == marker:
+                return idx, position
+        raise ValueError('unknown marker %r' % marker)
+
+    def rewind(self, marker):
+        """
+        Go back to the position `marker` was created at.  The marker
+        and all markers created after it are released.
+        """
+        idx, position = self._find_mark(marker)
+        history = self._history
+        self._buffer.extendleft(reversed(history[position + 1:]))
+        del history[position + 1:]
+        self.current = history[position]
+        del self._marks[idx:]
+        if not self._marks:
+            self._history = None
+
+    def release(self, marker):
+        """Forget about `marker` without moving in the stream."""
+        del self._marks[self._find_mark(marker)[0]]
+        if not self._marks:
+            self._history = None
+
     def skip(self, n):
         """Go n tokens ahead."""
         for idx in xrange(n):
@@ -196,46 +299,236 @@ class TokenStream(object):
 
     def next(self):
         """Go one token ahead."""
-        if self._pushed:
-            self.current = self._pushed.pop()
+        if self._buffer:
+            self.current = self._buffer.popleft()
         else:
             try:
                 self.current = self._next()
             except StopIteration:
-                if self.current.type != 'eof':
-                    self.current = Token('eof')
+                if self.current.type == 'eof':
+                    return
+                self.current = Token('eof')
+        if self._marks:
+            self._history.append(self.current)
 
     def expect(self, type, value=None):
-        """expect a given token."""
-        assert self.current.type == type, (
-            "token is from type %s not %s" % (self.current.type, type)
+        """
+        expect a given token.  Token types are compared by identity
+        first, so passing the interned names of a rule is fastest.
+        """
+        current = self.current
+        assert current.type is type or current.type == type, (
+            "token is from type %s not %s" % (current.type, type)
         )
         if value is not None:
-            assert self.current.value == value or \
+            assert current.value == value or \
                    (value.__class__ is tuple and
-                    self.current.value in value)
-        try:
-            return self.current
-        finally:
-            self.next()
+                    current.value in value)
+        self.next()
+        return current
 
     def test(self, type, value=Ellipsis):
         """Test the current token."""
-        return self.current.type == type and \
-               (value is Ellipsis or self.current.value == value or
-                value.__class__ is tuple and \
-                self.current.value in value)
+        current = self.current
+        if current.type is not type and current.type != type:
+            return False
+        return value is Ellipsis or current.value == value or \
+               value.__class__ is tuple and current.value in value
 
     def shift(self, token):
         """
         Push one token into the stream.
         """
-        old_current = self.current
-        self.next()
         self.push(self.current)
-        self.push(old_current)
-        self.push(token)
-        self.next()
+        self.push(token, True)
+
+
+class TokenTypeTable(object):
+    """
+    Interns token types to small integers so that they can be stored
+    in the arrays of a `CompactTokenBuffer`.  Every `MarkupMachine`
+    has it's own table, see `MarkupMachine.token_types`.
+
+        >>> types = TokenTypeTable()
+        >>> types.intern('strong_begin')
+        0
+        >>> types[0]
+        'strong_begin'
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._types = []
+        self._lock = Lock()
+
+    def intern(self, type):
+        """Return the id of `type`, a new one is assigned if required."""
+        try:
+            return self._ids[type]
+        except KeyError:
+            self._lock.acquire()
+            try:
+                if type not in self._ids:
+                    self._ids[type] = len(self._types)
+                    self._types.append(type)
+                return self._ids[type]
+            finally:
+                self._lock.release()
+
+    def __getitem__(self, id):
+        return self._types[id]
+
+    def __contains__(self, type):
+        return type in self._ids
+
+    def __len__(self):
+        return len(self._types)
+
+    def __repr__(self):
+        return '<%s (%s)>' % (
+            self.__class__.__name__,
+            ', '.join(repr(t) for t in self._types)
+        )
+
+
+class CompactTokenBuffer(object):
+    """
+    Stores tokens in parallel arrays instead of `Token` objects.  Types
+    are stored as ids of a `TokenTypeTable`, directives as indices into
+    `directives` and values as offset and length into `raw`.  `Token`
+    instances are only created if a token is accessed.
+
+        >>> buffer = CompactTokenBuffer(u'foo **bar**')
+        >>> buffer.append('text', u'foo ')
+        >>> buffer.append('strong_begin', u'**')
+        >>> buffer[1]
+        <Token('strong_begin', u'**', None)>
+
+    Values are looked up right after the last appended value or inside
+    of it, which is where the lexer finds them.  Values that are not
+    found there (e.g. text the escape characters were removed from)
+    are stored as they are and the lookup of the next value searches
+    a bit further.
+
+    :param raw: The document the tokens were created from.
+    :param types: A `TokenTypeTable` that is used to intern the types.
+    """
+
+    def __init__(self, raw, types=None):
+        self.raw = raw
+        if types is None:
+            types = TokenTypeTable()
+        self.types = types
+        self.directives = []
+        self._directive_ids = {}
+        self._type_ids = array('i')
+        self._directive_idx = array('i')
+        self._starts = array('l')
+        self._lengths = array('l')
+        self._end_of_context = array('b')
+        self._values = []
+        # `_anchor` is the start and `_cursor` the end of the last value
+        # that was found at the cursor position.  `_skip` and `_slack` are
+        # the minimal and maximal number of characters the values not
+        # found in the document since then may cover.
+        self._anchor = self._cursor = self._skip = self._slack = 0
+
+    def append(self, type, value=None, directive=None, end_of_context=False):
+        """Add a token to the buffer."""
+        self._type_ids.append(self.types.intern(type))
+
+        if directive is None:
+            self._directive_idx.append(-1)
+        else:
+            try:
+                idx = self._directive_ids[id(directive)]
+            except KeyError:
+                idx = self._directive_ids[id(directive)] = \
+                    len(self.directives)
+                self.directives.append(directive)
+            self._directive_idx.append(idx)
+
+        raw = self.raw
+        if value is None:
+            start, length = 0, -1
+        elif not isinstance(value, basestring):
+            start, length = len(self._values), -2
+            self._values.append(value)
+        else:
+            length = len(value)
+            cursor = self._cursor
+            if self._slack:
+                # the last values were not found in the document.  The
+                # text they were created from is at least as long as they
+                # are and at most twice as long (every character may have
+                # been escaped).
+                start = raw.find(value, cursor + self._skip,
+                                 cursor + self._slack + length)
+            elif raw.startswith(value, cursor):
+                start = cursor
+            else:
+                start = -1
+            if start < 0:
+                start = raw.find(value, self._anchor, cursor)
+                if start >= 0:
+                    # a part of the last value, e.g. a group of a match
+                    cursor = None
+            if start < 0:
+                self._skip += length
+                self._slack += 2 * length + 1
+                start, length = len(self._values), -2
+                self._values.append(value)
+            elif cursor is not None:
+                self._anchor = start
+                self._cursor = start + length
+                self._skip = self._slack = 0
+        self._starts.append(start)
+        self._lengths.append(length)
+        self._end_of_context.append(bool(end_of_context))
+
+    def extend(self, iterable):
+        """
+        Add all tokens of `iterable`.  The items can be `Token`
+        instances or tuples as yielded by the lexer.
+        """
+        append = self.append
+        for item in iterable:
+            if item.__class__ is tuple:
+                append(*item)
+            elif hasattr(item, 'as_tuple'):
+                append(*item.as_tuple())
+            else:
+                append(item)
+
+    def _value(self, idx):
+        length = self._lengths[idx]
+        if length == -1:
+            return None
+        start = self._starts[idx]
+        if length == -2:
+            return self._values[start]
+        return self.raw[start:start + length]
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        directive = self._directive_idx[idx]
+        return Token(self.types[self._type_ids[idx]], self._value(idx),
+                     directive >= 0 and self.directives[directive] or None,
+                     bool(self._end_of_context[idx]))
+
+    def __len__(self):
+        return len(self._type_ids)
+
+    def __iter__(self):
+        for idx in xrange(len(self._type_ids)):
+            yield self[idx]
+
+    def __repr__(self):
+        return '<%s (%d tokens)>' % (
+            self.__class__.__name__,
+            len(self)
+        )
 
 
 class Context(dict):
@@ -354,3 +647,102 @@ class Stack(object):
             self.__class__.__name__,
             self._stack or 'empty'
         )
+
+
+class ContextStack(object):
+    """
+    The stack of open contexts used by the lexer.  It keeps the order
+    of the contexts as well as a count of every context name so that
+    membership tests, pushing, popping and removing are all O(1)
+    (removing is amortized).
+
+        >>> stack = ContextStack()
+        >>> stack.push('quote')
+        >>> stack.push('b')
+        >>> 'quote' in stack
+        True
+        >>> stack.top
+        'b'
+
+    `remove` removes the most recently pushed entry of a context name
+    no matter where it is in the stack.  Removed entries are just marked
+    as dead and dropped once they reach the top of the stack.
+    """
+
+    def __init__(self, iterable=None):
+        self._order = []
+        self._entries = {}
+        self._dead = set()
+        self._seq = 0
+        self._size = 0
+        if iterable is not None:
+            for name in iterable:
+                self.push(name)
+
+    def _trim(self):
+        order = self._order
+        while order and order[-1][0] in self._dead:
+            self._dead.remove(order.pop()[0])
+
+    @property
+    def top(self):
+        """The most recently pushed context or `None`."""
+        self._trim()
+        if self._order:
+            return self._order[-1][1]
+
+    def push(self, name):
+        """Enter the context `name`."""
+        self._seq += 1
+        self._order.append((self._seq, name))
+        self._entries.setdefault(name, []).append(self._seq)
+        self._size += 1
+
+    def pop(self):
+        """
+        Leave the most recently pushed context and return it's name.
+        A `StackEmpty` exception is thrown if the stack is empty.
+        """
+        self._trim()
+        if not self._order:
+            raise StackEmpty()
+        seq, name = self._order.pop()
+        self._entries[name].pop()
+        self._size -= 1
+        self._trim()
+        return name
+
+    def remove(self, name):
+        """
+        Leave the most recently pushed context called `name`.
+        A `ValueError` is raised if there is no such context.
+        """
+        entries = self._entries.get(name)
+        if not entries:
+            raise ValueError('%r is not in the stack' % name)
+        self._dead.add(entries.pop())
+        self._size -= 1
+        self._trim()
+
+    def count(self, name):
+        """Return how often the context `name` is in the stack."""
+        return len(self._entries.get(name, ()))
+
+    def __contains__(self, name):
+        return bool(self._entries.get(name))
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        """Iterate over all contexts, the most recently pushed first."""
+        dead = self._dead
+        for seq, name in reversed(self._order):
+            if seq not in dead:
+                yield name
+
+    def __repr__(self):
+        return '<%s (%s)>' % (
+            self.__class__.__name__,
+            list(self) or 'empty'
+        )
@@ -9,8 +9,8 @@
     :copyright: 2008 by Christopher Grebs.
     :license: BSD, see LICENSE for details.
 """
+from functools import partial
 from dmlt.exc import EventNotFound
-from dmlt.utils import patch_wrapper
 from collections import deque
 
 
@@ -23,9 +23,17 @@ REGISTERED_EVENTS = [
 
 
 class EventManager(object):
+    """
+    Stores the callbacks connected to events.  The module level
+    `manager` is the global scope used by all machines, machines can
+    use additional managers as their `MarkupMachine.event_scope`.
+    """
 
     def __init__(self):
         self._store = {}
+        #: incremented on every change so that machines know when they
+        #: have to rebuild their callback chains
+        self.version = 0
 
     def connect(self, event, callable):
         if not event in REGISTERED_EVENTS:
@@ -35,6 +43,7 @@ class EventManager(object):
             self._store[event] = deque([callable])
         else:
             self._store[event].append(callable)
+        self.version += 1
 
     def iter(self, event):
         if event not in self._store:
@@ -42,11 +51,46 @@ class EventManager(object):
         return iter(self._store[event])
 
     def remove(self, callable):
-        for count, event in enumerate(self._store):
-            if callable in event:
-                event.remove(callable)
+        count = 0
+        for callbacks in self._store.itervalues():
+            if callable in callbacks:
+                callbacks.remove(callable)
+                count += 1
+        self.version += 1
         return count
 
+    def register(self, name):
+        """
+        This function can be used as a decorator to register
+        some callback object to an event of this manager.
+        The callback is called with the manager as first argument.
+
+        The decorator returns the connected callback, a
+        `functools.partial` of `func` and the manager.  Partials don't
+        bind as methods, so the decorator doesn't work on methods in a
+        class body; connect bound methods with `connect` instead.
+        """
+        def decorator(func):
+            # a partial doesn't add a python frame to every call
+            bound = partial(func, self)
+            bound.__name__ = func.__name__
+            bound.__module__ = func.__module__
+            bound.__doc__ = func.__doc__
+            self.connect(name, bound)
+            return bound
+        return decorator
+
+    def emit(self, name, *args, **kwargs):
+        return [cb(*args, **kwargs) for cb in self.iter(name)] or None
+
+    def emit_ovr(self, name, *args, **kwargs):
+        value = None
+        for callback in self.iter(name):
+            ret = callback(*args, **kwargs)
+            if ret is not None:
+                value = ret
+        return value
+
 manager = EventManager()
 
 
@@ -63,19 +107,13 @@ def define(name):
 def register(name):
     """
     This function can be used as a decorator to register
-    some callback object to an event.
+    some callback object to an event.  See `EventManager.register`.
     """
-    def decorator(func):
-        def proxy(*args, **kwargs):
-            return func(manager, *args, **kwargs)
-        proxy = patch_wrapper(proxy, func)
-        manager.connect(name, proxy)
-        return proxy
-    return decorator
+    return manager.register(name)
 
 
 def emit(name, *args, **kwargs):
-    return [cb(*args, **kwargs) for cb in manager.iter(name)] or None
+    return manager.emit(name, *args, **kwargs)
 
 
 def emit_ovr(name, *args, **kwargs):
@@ -83,13 +121,22 @@ def emit_ovr(name, *args, **kwargs):
     a special `emit` method that returns only one (non-inheriting)
     value instead of a list.
     """
-    value = None
-    for callback in manager.iter(name):
-        ret = callback(*args, **kwargs)
-        if ret is not None:
-            value = ret
-    return value
+    return manager.emit_ovr(name, *args, **kwargs)
 
 
 def iter_callbacks(event):
     return manager.iter(event)
+
+
+def callback_chains(scope=None):
+    """
+    Return a dict that maps all registered events to a tuple of the
+    global callbacks followed by the ones connected to `scope`.
+    """
+    chains = {}
+    for event in REGISTERED_EVENTS:
+        callbacks = tuple(manager.iter(event))
+        if scope is not None:
+            callbacks += tuple(scope.iter(event))
+        chains[event] = callbacks
+    return chains
@@ -43,3 +43,17 @@ class EventNotFound(DMLTError, RuntimeError):
     This exception is raised if the event tried to register
     is not supported.
     """
+
+
+class FormatNotFound(DMLTError, LookupError):
+    """
+    This exception is raised if a machine or a node is asked
+    for an output format no node implements.
+    """
+
+
+class SerializationError(DMLTError, ValueError):
+    """
+    Raised if a node-tree cannot be dumped or a dump
+    cannot be loaded, e.g. because of a version mismatch.
+    """
@@ -0,0 +1,253 @@
+#-*- coding: utf-8 -*-
+"""
+    dmlt.filters
+    ~~~~~~~~~~~~
+
+    Node-filters that are applied to the node-tree in one traversal and
+    token-filters that are applied to the token stream while it's read.
+
+    A node-filter declares the node types it's interested in and
+    implements `NodeFilter.enter` and/or `NodeFilter.leave`.  Filters are
+    connected to the ``process-doc-tree`` event like whole-tree callbacks::
+
+        >>> class StripEmpty(NodeFilter):
+        ...     node_types = (Container,)
+        ...     def leave(self, node, ctx):
+        ...         node.children = [x for x in node.children
+        ...                          if not x.is_text_node or x.text]
+        >>> events.manager.connect('process-doc-tree', StripEmpty())
+
+    Consecutive node-filters of a callback chain are fused into one
+    `FilterPass` that walks the tree once and calls the hooks of all
+    filters for every node.  Other callbacks are called with the whole
+    document like before, so they split the chain into multiple passes.
+
+    Token-filters are generator stages connected to the
+    ``process-stream`` event.  Consecutive token-filters are composed
+    into the generator chain of the lexer, so the tokens flow through
+    all of them one by one and the stream is never materialized::
+
+        >>> class DropEmptyText(TokenFilter):
+        ...     def filter(self, tokens, ctx):
+        ...         for token in tokens:
+        ...             if token.type != 'text' or token.value:
+        ...                 yield token
+        >>> events.manager.connect('process-stream', DropEmptyText())
+
+    :copyright: 2008 by Christopher Grebs.
+    :license: BSD, see LICENSE for more details.
+"""
+from dmlt.datastructure import TokenStream
+from dmlt.query import iter_tree_events
+
+
+__all__ = ('NodeFilter', 'FilterPass', 'compile_pipeline', 'TokenFilter',
+           'TokenFilterChain', 'compile_stream_pipeline')
+
+
+class NodeFilter(object):
+    """
+    Baseclass for node-filters.  Instances are shared by all machines
+    they're connected to, so per-document state has to be stored on
+    the context.
+    """
+
+    #: a tuple of node classes the hooks are called for (subclasses
+    #: included) or `None` for all nodes.
+    node_types = None
+
+    def enter(self, node, ctx):
+        """
+        Called before the children of `node` are visited.  Return
+        `False` to skip the children of `node` for this filter.
+        """
+
+    def leave(self, node, ctx):
+        """
+        Called after the children of `node` were visited.  If a node is
+        returned it replaces `node` in the tree and is passed to the
+        `leave` hooks of the following filters.
+        """
+
+    def __call__(self, document, ctx):
+        """Apply this filter alone to `document`."""
+        return FilterPass((self,))(document, ctx)
+
+    def __repr__(self):
+        return '<%s>' % self.__class__.__name__
+
+
+def _overrides(filter, name):
+    return getattr(filter.__class__, name).im_func is not \
+           getattr(NodeFilter, name).im_func
+
+
+class FilterPass(object):
+    """
+    Applies a sequence of node-filters in one traversal of the tree
+    with `dmlt.query.iter_tree_events`.  The hooks of the filters are
+    called in the order the filters were given, for both `enter` and
+    `leave`.
+    """
+
+    def __init__(self, filters):
+        self.filters = tuple(filters)
+        self._enter = frozenset(x for x in self.filters
+                                if _overrides(x, 'enter'))
+        self._leave = frozenset(x for x in self.filters
+                                if _overrides(x, 'leave'))
+        #: maps node classes to the filters interested in them
+        self._dispatch = {}
+
+    def _get_filters(self, cls):
+        try:
+            return self._dispatch[cls]
+        except KeyError:
+            filters = tuple(x for x in self.filters if x.node_types is None
+                            or issubclass(cls, x.node_types))
+            enter = tuple(x for x in filters if x in self._enter)
+            leave = tuple(x for x in filters if x in self._leave)
+            self._dispatch[cls] = rv = (enter, leave)
+            return rv
+
+    def __call__(self, document, ctx):
+        all_filters = self.filters
+        get_filters = self._get_filters
+        # the filters that visit the children of the entered nodes
+        descending = [all_filters]
+        push = descending.append
+        pop = descending.pop
+        prune = lambda node: not descending[-1]
+        for node, parent, index, leaving in iter_tree_events(document,
+                                                             prune):
+            if leaving:
+                pop()
+                active = descending[-1]
+                leave = get_filters(node.__class__)[1]
+                if not leave:
+                    continue
+                if active is not all_filters:
+                    leave = tuple(x for x in leave if x in active)
+                replaced = node
+                for filter in leave:
+                    ret = filter.leave(replaced, ctx)
+                    if ret is not None:
+                        replaced = ret
+                if replaced is not node:
+                    if parent is None:
+                        document = replaced
+                    else:
+                        parent.children[index] = replaced
+                continue
+
+            active = descend = descending[-1]
+            enter = get_filters(node.__class__)[0]
+            if enter and active is not all_filters:
+                enter = tuple(x for x in enter if x in active)
+            for filter in enter:
+                if filter.enter(node, ctx) is False:
+                    descend = tuple(x for x in descend if x is not filter)
+            push(descend)
+        return document
+
+    def __repr__(self):
+        return '<%s(%s)>' % (self.__class__.__name__,
+                             u', '.join(repr(x) for x in self.filters))
+
+
+def compile_pipeline(callbacks):
+    """
+    Compile the callbacks of the ``process-doc-tree`` event into a tuple
+    of callables that are called with the document and the context.
+    Runs of node-filters are fused into one `FilterPass`, all other
+    callbacks are returned as they are.
+    """
+    steps = []
+    filters = []
+    for callback in callbacks:
+        if isinstance(callback, NodeFilter):
+            filters.append(callback)
+            continue
+        if filters:
+            steps.append(FilterPass(filters))
+            filters = []
+        steps.append(callback)
+    if filters:
+        steps.append(FilterPass(filters))
+    return tuple(steps)
+
+
+class TokenFilter(object):
+    """
+    Baseclass for token-filters.  Subclasses implement either `process`
+    for a simple token in, tokens out mapping or `filter` to handle the
+    whole iterator, e.g. to look ahead or to keep state.  As `filter` is
+    only called once per stream it's the faster of the two.
+    """
+
+    def filter(self, tokens, ctx):
+        """
+        Return an iterator over the filtered `Token` instances of the
+        iterator `tokens`.  Usually implemented as a generator.
+        """
+        process = self.process
+        for token in tokens:
+            for item in process(token, ctx):
+                yield item
+
+    def process(self, token, ctx):
+        """
+        Return an iterable of the tokens that replace `token`, an empty
+        one to drop it.
+        """
+        return (token,)
+
+    def __call__(self, stream, ctx):
+        """Apply this filter alone to the `TokenStream` `stream`."""
+        return TokenStream(self.filter(iter(stream), ctx))
+
+    def __repr__(self):
+        return '<%s>' % self.__class__.__name__
+
+
+class TokenFilterChain(object):
+    """
+    Composes a sequence of token-filters into one generator chain.
+    """
+
+    def __init__(self, filters):
+        self.filters = tuple(filters)
+
+    def apply(self, tokens, ctx):
+        """Return an iterator over `tokens` passed through all filters."""
+        for filter in self.filters:
+            tokens = filter.filter(tokens, ctx)
+        return tokens
+
+    def __call__(self, stream, ctx):
+        return TokenStream(self.apply(iter(stream), ctx))
+
+    def __repr__(self):
+        return '<%s(%s)>' % (self.__class__.__name__,
+                             u', '.join(repr(x) for x in self.filters))
+
+
+def compile_stream_pipeline(callbacks):
+    """
+    Compile the callbacks of the ``process-stream`` event like
+    `compile_pipeline`.  Runs of token-filters are composed into one
+    `TokenFilterChain`, all other callbacks are returned as they are.
+    """
+    steps = []
+    filters = []
+    for callback in callbacks:
+        if isinstance(callback, TokenFilter):
+            filters.append(callback)
+            continue
+        if filters:
+            steps.append(TokenFilterChain(filters))
+            filters = []
+        steps.append(callback)
+    if filters:
+        steps.append(TokenFilterChain(filters))
+    return tuple(steps)
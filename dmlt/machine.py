@@ -9,17 +9,53 @@
     :license: BSD, see LICENSE for more details.
 """
 import re
+import sys
+import sre_parse
+import sre_constants
 from itertools import izip
-from collections import deque
+from threading import local
 from dmlt import events, node
-from dmlt.exc import MissingContext
+from dmlt.filters import compile_pipeline, compile_stream_pipeline, \
+     TokenFilterChain
+from dmlt.exc import MissingContext, FormatNotFound, SerializationError
+from dmlt.cache import cache_key
+from dmlt.serialize import dump_nodes, load_nodes
 from dmlt.utils import AdvancedDefaultdict
-from dmlt.datastructure import TokenStream, Context
+from dmlt.datastructure import TokenStream, TokenTypeTable, \
+     CompactTokenBuffer, ContextStack, Context
 
 
 __all__ = ('bygroups', 'rule', 'Directive', 'MarkupMachine')
 
 
+#: the `re` module does not support more than 100 groups in one pattern
+_MAX_GROUPS = 99
+
+#: ranges in character sets up to this size are expanded into
+#: single characters by the first character analysis.
+_MAX_RANGE = 128
+
+_category_escapes = {
+    sre_constants.CATEGORY_DIGIT:       r'\d',
+    sre_constants.CATEGORY_NOT_DIGIT:   r'\D',
+    sre_constants.CATEGORY_SPACE:       r'\s',
+    sre_constants.CATEGORY_NOT_SPACE:   r'\S',
+    sre_constants.CATEGORY_WORD:        r'\w',
+    sre_constants.CATEGORY_NOT_WORD:    r'\W',
+}
+
+#: maps lowercase characters to all other characters of the basic
+#: multilingual plane with the same lowercase form.  Filled on demand
+#: by `_case_variants`.
+_case_folding = {}
+
+
+def _intern(name):
+    """Intern `name` if it's a byte string."""
+    if name.__class__ is str:
+        return intern(name)
+    return name
+
 
 def bygroups(*args):
     return lambda m: izip(args, m.groups())
@@ -28,16 +64,48 @@ def bygroups(*args):
 class rule(object):
     """
     Represents one parsing rule.
+
+    The token types the lexer creates for a rule are precomputed
+    and interned, see `compile_names`.
     """
-    __slots__ = ('match', 'token', 'enter', 'leave', 'one')
+    __slots__ = ('regex', 'match', 'token', 'enter', 'leave', 'one',
+                 'suffixes', 'begin', 'end', 'standalone')
 
     def __init__(self, regexp, token=None, enter=None, leave=None,
                  one=False):
-        self.match = re.compile(regexp, re.U).match
+        self.regex = re.compile(regexp, re.U)
+        self.match = self.regex.match
         self.token = token
-        self.enter = enter
-        self.leave = leave
+        if token is not None and not callable(token):
+            self.token = _intern(token)
+        self.enter = enter is not None and _intern(enter) or enter
+        self.leave = leave is not None and _intern(leave) or leave
         self.one = one
+        self.compile_names()
+
+    def compile_names(self, begin='_begin', end='_end'):
+        """
+        Precompute the token types for entering (`begin`) and leaving
+        (`end`) the context of this rule as well as the one of a
+        standalone rule (`standalone`).
+        """
+        self.suffixes = (begin, end)
+        enter, leave = self.enter, self.leave
+        self.begin = enter is not None and _intern(enter + begin) or None
+        self.end = leave is not None and _intern(leave + end) or None
+        self.standalone = leave and self.begin or enter
+
+    def with_suffixes(self, begin, end):
+        """
+        Return a copy of the rule whose token types are built with other
+        suffixes.  Used by machines that overwrite `MarkupMachine._begin`
+        or `MarkupMachine._end`.
+        """
+        copy = object.__new__(self.__class__)
+        for name in self.__slots__:
+            setattr(copy, name, getattr(self, name))
+        copy.compile_names(begin, end)
+        return copy
 
     def __repr__(self):
         return '<rule(%s, %s -> %s)>' % (
@@ -47,17 +115,370 @@ class rule(object):
         )
 
 
+def _iter_opcodes(data):
+    """Yield all opcodes of a parsed regular expression recursively."""
+    if isinstance(data, sre_parse.SubPattern):
+        for op, av in data.data:
+            yield op
+            for item in _iter_opcodes(av):
+                yield item
+    elif isinstance(data, (list, tuple)):
+        for av in data:
+            for item in _iter_opcodes(av):
+                yield item
+
+
+def _is_combinable(regex):
+    """
+    Return `True` if the compiled `regex` can be part of an alternation
+    without changing it's meaning.  Backreferences and named groups
+    depend on the group numbering of the pattern so they can't be merged.
+    """
+    if regex.groupindex or regex.groups >= _MAX_GROUPS:
+        return False
+    for op in _iter_opcodes(sre_parse.parse(regex.pattern, regex.flags)):
+        if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            return False
+    return True
+
+
+def _case_variants(char):
+    """
+    Return all characters that match `char` if a pattern is compiled
+    with the `re.IGNORECASE` and `re.UNICODE` flags.
+    """
+    if not _case_folding:
+        for code in xrange(min(sys.maxunicode, 0xffff) + 1):
+            c = unichr(code)
+            lower = c.lower()
+            if lower != c:
+                _case_folding.setdefault(lower, set([lower])).add(c)
+    lower = char.lower()
+    return _case_folding.get(lower, set([lower]))
+
+
+class AnyFirstChar(Exception):
+    """
+    Raised by the first character analysis if a pattern could
+    start with every character.
+    """
+
+
+def _add_first_chars(data, flags, chars, classes):
+    """
+    Add the characters the parsed pattern `data` can start with to the
+    set `chars` and all character classes that can't be expanded to the
+    set `classes`.  Return `True` if the pattern can match the empty string
+    so that the following items have to be considered as well.
+    """
+    ignorecase = flags & re.I
+    for op, av in data:
+        if op == sre_constants.LITERAL:
+            if ignorecase:
+                if av > 0xffff:
+                    raise AnyFirstChar()
+                chars.update(_case_variants(unichr(av)))
+            else:
+                chars.add(unichr(av))
+            return False
+        elif op == sre_constants.IN:
+            for iop, iav in av:
+                if iop == sre_constants.LITERAL:
+                    _add_first_chars([(iop, iav)], flags, chars, classes)
+                elif iop == sre_constants.RANGE and not ignorecase:
+                    low, high = iav
+                    if high - low < _MAX_RANGE:
+                        chars.update(unichr(c) for c in xrange(low, high + 1))
+                    else:
+                        classes.add(u'%s-%s' % (re.escape(unichr(low)),
+                                                re.escape(unichr(high))))
+                elif iop == sre_constants.CATEGORY and not ignorecase and \
+                     iav in _category_escapes:
+                    classes.add(_category_escapes[iav])
+                else:
+                    raise AnyFirstChar()
+            return False
+        elif op == sre_constants.SUBPATTERN:
+            if not _add_first_chars(av[1], flags, chars, classes):
+                return False
+        elif op == sre_constants.BRANCH:
+            nullable = False
+            for branch in av[1]:
+                if _add_first_chars(branch, flags, chars, classes):
+                    nullable = True
+            if not nullable:
+                return False
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            lower, upper, item = av
+            if not _add_first_chars(item, flags, chars, classes) and lower:
+                return False
+        elif op in (sre_constants.AT, sre_constants.ASSERT,
+                    sre_constants.ASSERT_NOT):
+            # zero-width assertions don't consume any characters.
+            continue
+        else:
+            raise AnyFirstChar()
+    return True
+
+
+def first_chars(regex):
+    """
+    Return a `(chars, classes)` tuple with a set of all characters a match
+    of the compiled `regex` can start with and a set of character class
+    expressions for characters that could not be expanded.  If that can't
+    be proven `None` is returned.
+    """
+    if regex.flags & re.L:
+        return None
+    chars, classes = set(), set()
+    try:
+        data = sre_parse.parse(regex.pattern, regex.flags)
+        if _add_first_chars(data, regex.flags, chars, classes):
+            # the pattern can match the empty string
+            return None
+    except AnyFirstChar:
+        return None
+    return frozenset(chars), frozenset(classes)
+
+
+class CombinedRules(object):
+    """
+    Matches a list of `(rule, directive)` pairs with one regular expression
+    by merging all rule patterns into one alternation.  The declaration
+    order of the rules is kept as priority so that the result is the same
+    as trying every rule on its own.
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self._groups = groups = {}
+        parts = []
+        index = 1
+        for rule, directive in items:
+            groups[index] = (rule, directive)
+            parts.append('(%s)' % rule.regex.pattern)
+            index += rule.regex.groups + 1
+        self._match = re.compile('|'.join(parts),
+                                 items[0][0].regex.flags).match
+
+    def match(self, raw, pos):
+        """
+        Return a `(match, rule, directive)` tuple for the first
+        rule that matches `raw` at `pos` or `None`.
+        """
+        m = self._match(raw, pos)
+        if m is None:
+            return None
+        rule, directive = self._groups[m.lastindex]
+        if rule.regex.groups or callable(rule.token):
+            # the groups of the alternation are not the ones of the rule
+            # so rematch the rule to get a proper match object.
+            m = rule.match(raw, pos)
+        return m, rule, directive
+
+    def __repr__(self):
+        return '<%s(%s)>' % (
+            self.__class__.__name__,
+            u', '.join(repr(r) for r, d in self.items)
+        )
+
+
+class SingleRule(object):
+    """
+    Matches one `(rule, directive)` pair that can't be merged
+    with other rules.
+    """
+
+    def __init__(self, rule, directive):
+        self.items = [(rule, directive)]
+        self.rule = rule
+        self.directive = directive
+
+    def match(self, raw, pos):
+        m = self.rule.match(raw, pos)
+        if m is None:
+            return None
+        return m, self.rule, self.directive
+
+    def __repr__(self):
+        return '<%s(%r)>' % (self.__class__.__name__, self.rule)
+
+
+def compile_matchers(items, combine=True):
+    """
+    Compile a list of `(rule, directive)` tuples into a list of matchers.
+    Consecutive rules that can be merged are compiled into one
+    `CombinedRules` object, all others are tried on their own.
+    """
+    matchers = []
+    bucket = []
+    groups = 0
+
+    def flush():
+        if len(bucket) == 1:
+            matchers.append(SingleRule(*bucket[0]))
+        elif bucket:
+            matchers.append(CombinedRules(bucket[:]))
+        del bucket[:]
+
+    for rule, directive in items:
+        regex = rule.regex
+        if not combine or not _is_combinable(regex):
+            flush()
+            matchers.append(SingleRule(rule, directive))
+            continue
+        if bucket and (bucket[0][0].regex.flags != regex.flags or
+                       groups + regex.groups + 1 > _MAX_GROUPS):
+            flush()
+        if not bucket:
+            groups = 0
+        bucket.append((rule, directive))
+        groups += regex.groups + 1
+    flush()
+    return matchers
+
+
+class LexerTable(object):
+    """
+    The compiled form of all lexing rules of a `MarkupMachine`.
+
+    The rules are compiled with `compile_matchers` and indexed by the
+    characters they can start with, so that at every position only the
+    rules that could match the current character are tried (in
+    declaration order).  Rules whose first character can't be
+    determined fall into the "unknown first char" bucket and are
+    tried everywhere.
+
+    The table also knows about all characters a rule can start with so
+    that plain text can be skipped with the help of `scanner`.
+
+    :param items: A list of `(rule, directive)` tuples.
+    :param combine: If `False` no rules are merged at all.
+    """
+
+    def __init__(self, items, combine=True):
+        self.items = items
+        self.first_chars = [first_chars(rule.regex) for rule, d in items]
+        self._scanners = {}
+        self.matchers = compile_matchers(items, combine)
+
+        # rules that can't be dispatched by a single character.  This
+        # includes rules that start with some character class like `\w`.
+        unknown = []
+        chars = set()
+        for idx, first in enumerate(self.first_chars):
+            if first is None or first[1]:
+                unknown.append(idx)
+            if first is not None:
+                chars.update(first[0])
+        self.unknown = [items[idx] for idx in unknown]
+
+        buckets = {}
+        self.index = index = {}
+        for char in chars:
+            bucket = []
+            for idx, first in enumerate(self.first_chars):
+                if first is None or char in first[0] or \
+                   (first[1] and re.match(u'[%s]' % u''.join(first[1]),
+                                          char, re.U)):
+                    bucket.append(idx)
+            bucket = tuple(bucket)
+            if bucket not in buckets:
+                buckets[bucket] = compile_matchers(
+                    [items[idx] for idx in bucket], combine)
+            index[char] = buckets[bucket]
+        self.default = compile_matchers(self.unknown, combine)
+
+    def scanner(self, escape_character=None):
+        """
+        Return a `search` function of a regular expression that finds the
+        next position some rule could match at or `None` if every position
+        is a candidate.  If `escape_character` is given it's treated as
+        candidate as well.
+        """
+        try:
+            return self._scanners[escape_character]
+        except KeyError:
+            pass
+        chars, classes = set(), set()
+        for first in self.first_chars:
+            if first is None:
+                search = None
+                break
+            chars.update(first[0])
+            classes.update(first[1])
+        else:
+            if escape_character:
+                chars.add(escape_character)
+            items = [re.escape(c) for c in sorted(chars)] + sorted(classes)
+            if items:
+                search = re.compile(u'[%s]' % u''.join(items), re.U).search
+            else:
+                search = re.compile(u'(?!)').search
+        self._scanners[escape_character] = search
+        return search
+
+    def match(self, raw, pos):
+        """
+        Return a `(match, rule, directive)` tuple for the first
+        rule that matches `raw` at `pos` or `None`.
+        """
+        for matcher in self.index.get(raw[pos], self.default):
+            rv = matcher.match(raw, pos)
+            if rv is not None:
+                return rv
+
+    def debug(self, stream=None):
+        """
+        Displays the first character index on the stream provided
+        or stdout.
+        """
+        if stream is None:
+            stream = sys.stdout
+        for char in sorted(self.index):
+            stream.write('%r: %s\n' % (char, u', '.join(
+                repr(r) for m in self.index[char] for r, d in m.items)))
+        stream.write('unknown first char: %s\n' % u', '.join(
+            repr(r) for r, d in self.unknown))
+
+    def __repr__(self):
+        return '<%s(%s)>' % (
+            self.__class__.__name__,
+            u', '.join(repr(m) for m in self.matchers)
+        )
+
+
+#: the `Context` instances of the documents parsed in this thread
+_parsing = local()
+
+
 class Directive(object):
     """
     A directive that represents a part of the markup language.
     It's used to create a tokenstream and process that stream
     into a node tree.
+
+    The instances are created once per machine and escaping mode and
+    shared by all documents the machine processes, also by documents
+    processed in other threads.  Per-document state belongs into
+    `ctx`, not onto the directive.
     """
     rule = None
 
     def __init__(self, machine, escaping_enabled=False):
         self.machine = machine
-        self.ctx = Context(machine, escaping_enabled)
+        self.escaping_enabled = escaping_enabled
+
+    @property
+    def ctx(self):
+        """
+        The `Context` of the document the machine is currently parsing
+        in this thread, it's also passed to the node-filters.  `None`
+        outside of `MarkupMachine.parse`.
+        """
+        for machine, ctx in reversed(getattr(_parsing, 'stack', ())):
+            if machine is self.machine:
+                return ctx
 
     @property
     def rules(self):
@@ -94,6 +515,16 @@ def _handle_define_raw_directive(manager, *args, **kwargs):
     return RawDirective
 
 
+def _emit_ovr(callbacks, *args, **kwargs):
+    """Like `events.emit_ovr` for a callback chain."""
+    value = None
+    for callback in callbacks:
+        ret = callback(*args, **kwargs)
+        if ret is not None:
+            value = ret
+    return value
+
+
 class MarkupMachine(object):
     """
     The markup machine is the heart of DMLT.
@@ -101,6 +532,25 @@ class MarkupMachine(object):
     which is used to create a AST (Abstract Syntax Tree) or
     called node-tree that represents the parsed document
     in an abstract form.
+
+    A machine can either be bound to one document by passing it
+    to the constructor or created once and used for any number
+    of documents::
+
+        >>> machine = SimpleMarkupMachine()
+        >>> machine.render(u'**bold**')
+        >>> machine.parse(u'**bold**')
+
+    A machine that is not bound to a document can be shared between
+    threads.  The state of a document lives in the stream, the node-tree
+    and the `Context` instances created for every call.  The compiled
+    state (the lexer table, the directive instances, the callback chains
+    and filter pipelines and the cache fingerprint) is built lazily on
+    first use and stored on the machine or its class.  Building it is
+    idempotent and every cache is replaced with one assignment, so two
+    threads racing for it may both build it but never see a half built
+    one.  That relies on the GIL.  The directive instances are shared
+    as well, see `Directive.ctx` for their per-document state.
     """
     # token-stack-state names. They're defined here so
     # that it's possible to overwrite them
@@ -118,21 +568,156 @@ class MarkupMachine(object):
     # states won't be touched.
     restrictive_mode = False
 
-    def __init__(self, raw):
+    # Merge the lexing rules into as few alternation patterns as possible
+    # so that every position in the document costs just one regular
+    # expression call.  Rules using backreferences or named groups are
+    # still tried on their own.  Set this to `False` to disable merging.
+    combine_rules = True
+
+    # The maximum number of contexts that can be open at the same time.
+    # Contexts that would be nested deeper are kept as text as well as
+    # the points leaving them.  `None` (the default) disables the limit,
+    # set it to a number to protect against maliciously deep documents.
+    max_nesting_depth = None
+
+    # A `dmlt.cache.BaseCache` instance used by `parse` and `render` for
+    # raw documents.  `cache_version` is part of all cache keys, change
+    # it to invalidate the entries if the output of the nodes changes.
+    cache = None
+    cache_version = None
+
+    # The output formats this machine renders to.  They're checked when
+    # the machine is created and rendering to other formats is refused
+    # before the document is parsed.
+    output_formats = ('html', 'text')
+
+    # An `events.EventManager` whose callbacks are only used by this
+    # machine (and its subclasses) in addition to the global ones.
+    event_scope = None
+
+    def __init__(self, raw=None):
         self.raw = raw
         self._stream = None
+        self._directive_cache = {}
+        #: interns token types for `CompactTokenBuffer` objects
+        self.token_types = TokenTypeTable()
         # process special directives to init some special features
         self._process_special_events()
+        for format in self.output_formats:
+            node.check_format(format)
 
     def __repr__(self):
-        return '<MarkupMachine(%s)>' % u', '.join(self.directives)
+        return '<%s(%s)>' % (
+            self.__class__.__name__,
+            u', '.join(x.__name__ for x in self.directives)
+        )
 
     def _process_special_events(self):
         # raw_directive
-        self.raw_directive = rw = events.emit_ovr('define-raw-directive')(self)
+        chain = self.get_callback_chains()['define-raw-directive']
+        self.raw_directive = rw = _emit_ovr(chain)(self)
         # and the raw directive name
         self.raw_name = rw.name
 
+    def get_callback_chains(self):
+        """
+        Return a dict that maps the event names to tuples of the global
+        callbacks followed by the ones of the `event_scope`.
+
+        The chains are built once per machine class and rebuilt if
+        a callback is connected to or removed from one of the managers.
+        """
+        cls = self.__class__
+        scope = self.event_scope
+        signature = (events.manager.version, scope,
+                     scope is not None and scope.version)
+        cached = cls.__dict__.get('_callback_cache')
+        if cached is None or cached[0] != signature:
+            cached = (signature, events.callback_chains(scope))
+            cls._callback_cache = cached
+        return cached[1]
+
+    def get_filter_pipeline(self):
+        """
+        Return the ``process-doc-tree`` callbacks compiled by
+        `filters.compile_pipeline`, consecutive node-filters are fused
+        into one traversal.  The pipeline is cached like the callback
+        chains.
+        """
+        cls = self.__class__
+        chain = self.get_callback_chains()['process-doc-tree']
+        cached = cls.__dict__.get('_pipeline_cache')
+        if cached is None or cached[0] is not chain:
+            cached = (chain, compile_pipeline(chain))
+            cls._pipeline_cache = cached
+        return cached[1]
+
+    def get_stream_pipeline(self):
+        """
+        Return the ``process-stream`` callbacks compiled by
+        `filters.compile_stream_pipeline`, consecutive token-filters are
+        composed into one generator chain.
+        """
+        cls = self.__class__
+        chain = self.get_callback_chains()['process-stream']
+        cached = cls.__dict__.get('_stream_pipeline_cache')
+        if cached is None or cached[0] is not chain:
+            cached = (chain, compile_stream_pipeline(chain))
+            cls._stream_pipeline_cache = cached
+        return cached[1]
+
+    def get_directives(self, enable_escaping=False):
+        """
+        Return the directive instances of this machine.  They're created
+        once per escaping mode and reused for all documents processed
+        by this machine until `directives` changes.
+        """
+        signature = tuple(self.directives)
+        cached = self._directive_cache.get(enable_escaping)
+        if cached is None or cached[0] != signature:
+            cached = (signature, [x(self, enable_escaping)
+                                  for x in self.directives])
+            self._directive_cache[enable_escaping] = cached
+        return cached[1]
+
+    def get_lexer_table(self):
+        """
+        Return the `LexerTable` of this machine class.
+
+        The table is built on first use and shared by all instances
+        of the class.  It's rebuilt if `directives`, `combine_rules` or
+        the state suffixes (`_begin` and `_end`) change, the suffixes
+        may be overridden per instance.  As the table is built only
+        once the rules of a directive must not depend on the directive
+        instance.
+        The items of the table are `(rule, index)` tuples where `index`
+        is the position of the directive in `directives`.
+        """
+        cls = self.__class__
+        suffixes = (self._begin, self._end)
+        signature = (tuple(self.directives), self.combine_rules, suffixes)
+        cached = cls.__dict__.get('_lexer_table_cache')
+        if cached is None or cached[0] != signature:
+            lexing_items = []
+            for idx, d in enumerate(self.get_directives()):
+                rules = d.rules is not None and d.rules or [d.rule]
+                for r in rules:
+                    if r.suffixes != suffixes:
+                        r = r.with_suffixes(*suffixes)
+                    lexing_items.append((r, idx))
+            cached = (signature, LexerTable(lexing_items, self.combine_rules))
+            cls._lexer_table_cache = cached
+        return cached[1]
+
+    def debug_rules(self, stream=None):
+        """
+        Displays which rules are tried for which first character on the
+        stream provided or stdout.  Rules in the "unknown first char"
+        bucket are tried at every position and prevent plain text from
+        being skipped quickly.
+        """
+        self.get_lexer_table().debug(stream)
+
     def _process_lexing_rules(self, raw, enable_escaping=False):
         """
         Process the raw-document with all lexing
@@ -144,84 +729,105 @@ class MarkupMachine(object):
                  tuples which can be mapped into a `Token` instance.
         """
         escaped = False
-        pos = d = 0
+        pos = 0
         end = len(raw)
         text_buffer = []
         add_text = text_buffer.append
         flatten = u''.join
-        stack = deque([''])
-        lexing_items = []
-        for d in (x(self, enable_escaping) for x in self.directives):
-            rules = d.rules is not None and d.rules or [d.rule]
-            lexing_items.extend([(r, d) for r in rules])
-        del d
+        stack = ContextStack()
+        max_depth = self.max_nesting_depth
+        overflow = {}
+        directives = self.get_directives(enable_escaping)
+        table = self.get_lexer_table()
+        match = table.match
+        scan = table.scanner(enable_escaping and self.escape_character)
 
         while pos < end:
-            for rule, directive in lexing_items:
-                m = rule.match(raw, pos)
-                if m is not None:
-                    # handle escaped tokens
-                    if escaped:
+            matched = match(raw, pos)
+            if matched is not None:
+                m, rule, idx = matched
+                directive = directives[idx]
+                # handle escaped tokens
+                if escaped:
+                    add_text(m.group())
+                    pos = m.end()
+                    escaped = False
+                    continue
+
+                # contexts nested too deep are kept as text, as well
+                # as the matching points that leave them.  The counts
+                # are kept per stack depth, so they're dropped if the
+                # context they were opened in is closed.
+                enter, leave = rule.enter, rule.leave
+                if max_depth is not None and not (rule.one and
+                                                  enter not in stack):
+                    key = (len(stack), leave)
+                    if leave is not None and overflow.get(key):
+                        overflow[key] -= 1
                         add_text(m.group())
                         pos = m.end()
-                        escaped = False
-                        break
-
-                    # flush text from the text_buffer
-                    if text_buffer:
-                        text = flatten(text_buffer)
-                        if text:
-                            yield self.raw_name, text, self.raw_directive
-                        del text_buffer[:]
-
-                    if rule.enter is not None or rule.leave is not None:
-                        enter, leave = rule.enter, rule.leave
-                        if enter not in stack and rule.one:
-                            # the rule is a standalone one so just yield
-                            # the enter point and leave the context
-                            token = leave and enter + self._begin or enter
-                            yield token, m.group(), directive, True
-
-                            # special case handling XXX: needs documentation
-                            if leave:
-                                # process special tokens before apply closing items.
-                                if callable(rule.token):
-                                    for item in rule.token(m):
-                                        yield item
-                                token = leave + self._end
-                                yield token, m.group(), directive, False
-                        elif leave is not None and leave in stack:
-                            # there is some leaving-point defined so jump out
-                            # of this context
-
-                            # in restrictive mode we remove all tokens from the stack
-                            # until we reach the token to leave.
-                            if self.restrictive_mode:
-                                while stack[0] != leave:
-                                    yield stack[0], None, None, True
-                                    stack.popleft()
-                                stack.popleft()
-                            else:
-                                stack.remove(leave)
-                            token = leave + self._end
-                            yield token, m.group(), directive, True
-                        elif enter is not None and not rule.one:
-                            # enter a new context
-                            stack.appendleft(enter)
-                            token = enter + self._begin
-                            yield token, m.group(), directive, False
-                        elif leave is not None and leave not in stack:
-                            raise MissingContext(u'cannot leave %r' % leave)
-
-                    # process some callables like `bygroups`
-                    if callable(rule.token):
-                        for item in rule.token(m):
-                            yield item
-                    elif rule.token is not None:
-                        yield rule.token, m.group(), directive, False
+                        continue
+                    if enter is not None and not rule.one and \
+                       len(stack) >= max_depth and leave not in stack:
+                        key = (len(stack), enter)
+                        overflow[key] = overflow.get(key, 0) + 1
+                        add_text(m.group())
+                        pos = m.end()
+                        continue
 
-                    pos = m.end()
-                    break
+                # flush text from the text_buffer
+                if text_buffer:
+                    text = flatten(text_buffer)
+                    if text:
+                        yield self.raw_name, text, self.raw_directive
+                    del text_buffer[:]
+
+                if enter is not None or leave is not None:
+                    if enter not in stack and rule.one:
+                        # the rule is a standalone one so just yield
+                        # the enter point and leave the context
+                        yield rule.standalone, m.group(), directive, True
+
+                        # special case handling XXX: needs documentation
+                        if leave:
+                            # process special tokens before apply closing items.
+                            if callable(rule.token):
+                                for item in rule.token(m):
+                                    yield item
+                            yield rule.end, m.group(), directive, False
+                    elif leave is not None and leave in stack:
+                        # there is some leaving-point defined so jump out
+                        # of this context
+
+                        # in restrictive mode we remove all tokens from the stack
+                        # until we reach the token to leave.
+                        if self.restrictive_mode:
+                            while stack.top != leave:
+                                yield stack.pop(), None, None, True
+                            stack.pop()
+                        else:
+                            stack.remove(leave)
+                        if overflow:
+                            depth = len(stack)
+                            for key in [x for x in overflow
+                                        if x[0] > depth]:
+                                del overflow[key]
+                        yield rule.end, m.group(), directive, True
+                    elif enter is not None and not rule.one:
+                        # enter a new context
+                        stack.push(enter)
+                        yield rule.begin, m.group(), directive, False
+                    elif leave is not None and leave not in stack:
+                        raise MissingContext(u'cannot leave %r' % leave)
+
+                # process some callables like `bygroups`
+                if callable(rule.token):
+                    for item in rule.token(m):
+                        yield item
+                elif rule.token is not None:
+                    yield rule.token, m.group(), directive, False
+
+                pos = m.end()
             else:
                 char = raw[pos]
                 if enable_escaping:
@@ -238,6 +844,18 @@ class MarkupMachine(object):
                 add_text(char)
                 pos += 1
 
+                # jump over all plain text no rule can start at and
+                # add it to the text buffer at once.
+                if scan is not None and pos < end:
+                    candidate = scan(raw, pos)
+                    skip_to = candidate is None and end or candidate.start()
+                    if skip_to > pos:
+                        if escaped:
+                            add_text(self.escape_character)
+                            escaped = False
+                        add_text(raw[pos:skip_to])
+                        pos = skip_to
+
         # if there is a bogus escaped push a backslash
         if escaped:
             add_text(self.escape_character)
@@ -248,59 +866,139 @@ class MarkupMachine(object):
             if text:
                 yield self.raw_name, text, self.raw_directive
 
-    def tokenize(self, raw=None, enable_escaping=False):
+    def _get_raw(self, raw):
+        if raw is None:
+            raw = self.raw
+            if raw is None:
+                raise TypeError('No document given and the machine '
+                                'is not bound to one')
+        return raw
+
+    def compact_tokens(self, raw=None, enable_escaping=False):
+        """
+        Tokenize the raw document into a `CompactTokenBuffer`.
+        Stream-filters are not applied.
+
+        :param raw: The raw document.  If `None` the `raw` attribute
+                    is used.
+        :return: A `CompactTokenBuffer` instance.
+        """
+        raw = self._get_raw(raw)
+        buffer = CompactTokenBuffer(raw, self.token_types)
+        buffer.extend(self._process_lexing_rules(raw, enable_escaping))
+        return buffer
+
+    def tokenize(self, raw=None, enable_escaping=False, compact=False):
         """
         Tokenize the raw document, apply stream-filters
         and return the processing-ready token stream.
 
-        :param raw: The raw document.
+        :param raw: The raw document.  If `None` the `raw` attribute
+                    is used.
+        :param compact: If `True` the document is tokenized into a
+                        `CompactTokenBuffer` at once and the stream
+                        creates `Token` instances on access.
         :return: A `TokenStream` instance.
         """
+        raw = self._get_raw(raw)
         ctx = Context(self, enable_escaping)
-        stream = TokenStream.from_tuple_iter(self._process_lexing_rules(
-            raw or self.raw, enable_escaping))
+        if compact:
+            tokens = iter(self.compact_tokens(raw, enable_escaping))
+        else:
+            tokens = TokenStream.iter_tokens(self._process_lexing_rules(
+                raw, enable_escaping))
 
-        for callback in events.iter_callbacks('process-stream'):
-            ret = callback(stream, ctx)
+        # token-filters are composed into the generator chain, the
+        # stream is only created for callbacks that need one.
+        stream = None
+        for step in self.get_stream_pipeline():
+            if step.__class__ is TokenFilterChain:
+                if stream is not None:
+                    tokens = iter(stream)
+                    stream = None
+                tokens = step.apply(tokens, ctx)
+                continue
+            if stream is None:
+                stream = TokenStream(tokens)
+            ret = step(stream, ctx)
             if ret is not None:
                 stream = ret
 
+        if stream is None:
+            stream = TokenStream(tokens)
         return stream
 
     def parse(self, stream=None, inline=False, enable_escaping=False):
         """
-        Parse an existing stream or the current `raw` document,
-        apply node-filters and return a node-tree.
+        Parse an existing stream, a document or the current `raw`
+        document, apply node-filters and return a node-tree.
 
-        :param stream:  An existing stream. If `None` the `raw` attribute
-                        is processed into a `TokenStream`.
+        :param stream:  An existing stream or a raw document. If `None`
+                        the `raw` attribute is processed into a
+                        `TokenStream`.
         :param inline:  If `True` only child-nodes are returned and no
                         `Document` node as the top level one.
         :return:        A node-tree that represents the finished document
                         in an abstract form.
         """
-        if stream is None:
-            stream = self.tokenize(enable_escaping=enable_escaping)
+        if stream is None or isinstance(stream, basestring):
+            raw = self._get_raw(stream)
+            if self.cache is not None:
+                document = self._parse_cached(raw, enable_escaping)
+            else:
+                document = self._build_tree(self.tokenize(raw,
+                    enable_escaping), enable_escaping)
+        else:
+            document = self._build_tree(stream, enable_escaping)
 
-        # create the node-tree
-        document = events.emit_ovr('define-document-node')()
+        if inline:
+            return document.children
+        return document
 
-        while not stream.eof:
-            node = self.dispatch_node(stream)
-            if node is not None:
-                document.children.append(node)
-            else:
-                stream.next()
+    def _build_tree(self, stream, enable_escaping):
+        chains = self.get_callback_chains()
+        # create the node-tree
+        document = _emit_ovr(chains['define-document-node'])()
+        ctx = Context(self, enable_escaping)
+        try:
+            stack = _parsing.stack
+        except AttributeError:
+            stack = _parsing.stack = []
+        stack.append((self, ctx))
+        try:
+            while not stream.eof:
+                node = self.dispatch_node(stream)
+                if node is not None:
+                    document.children.append(node)
+                else:
+                    stream.next()
+        finally:
+            stack.pop()
 
         # apply node-filters
-        ctx = Context(self, enable_escaping)
-        for callback in events.iter_callbacks('process-doc-tree'):
+        for callback in self.get_filter_pipeline():
             ret = callback(document, ctx)
             if ret is not None:
                 document = ret
+        return document
 
-        if inline:
-            return document.children
+    def _parse_cached(self, raw, enable_escaping):
+        key = cache_key(self, 'parse', raw, None, enable_escaping)
+        value = self.cache.get(key)
+        if value is not None:
+            try:
+                return load_nodes(value)[1]
+            except SerializationError:
+                # written by another version or with other node classes
+                pass
+        document = self._build_tree(self.tokenize(raw, enable_escaping),
+                                    enable_escaping)
+        try:
+            value = dump_nodes(document)
+        except SerializationError:
+            # trees with nodes that can't be dumped are not cached
+            return document
+        self.cache.set(key, value)
         return document
 
     def dispatch_node(self, stream):
@@ -317,15 +1015,63 @@ class MarkupMachine(object):
 
     def render(self, tree=None, format='html', enable_escaping=False):
         """
-        Process a given `tree` or the current `raw` document
-        into the given output`format`.
+        Process a given `tree`, a document or the current `raw`
+        document into the given output`format`.
 
-        :param tree: A tree that should be processed.
+        :param tree: A tree or a raw document that should be processed.
         :param format: The output format to return.
         """
-        if tree is None:
-            tree = self.parse(enable_escaping=enable_escaping)
-        return u''.join(tree.prepare(format))
+        self._check_output_format(format)
+        if tree is None or isinstance(tree, basestring):
+            if self.cache is not None:
+                return self._render_cached(self._get_raw(tree), format,
+                                           enable_escaping)
+            tree = self.parse(tree, enable_escaping=enable_escaping)
+        result = []
+        tree.render_to(result, format)
+        return u''.join(result)
+
+    def _check_output_format(self, format):
+        if format not in self.output_formats:
+            raise FormatNotFound(u'%s does not render to %r' % (
+                self.__class__.__name__, format))
+
+    def _render_cached(self, raw, format, enable_escaping):
+        key = cache_key(self, 'render', raw, format, enable_escaping)
+        value = self.cache.get(key)
+        if value is not None:
+            return value.decode('utf-8')
+        # the tree is built directly, only the output is cached
+        result = []
+        self._build_tree(self.tokenize(raw, enable_escaping),
+                         enable_escaping).render_to(result, format)
+        result = u''.join(result)
+        self.cache.set(key, result.encode('utf-8'))
+        return result
+
+    def render_to(self, sink, tree=None, format='html',
+                  enable_escaping=False):
+        """
+        Like `render` but write the output fragments into `sink` instead
+        of returning a string.  `sink` is a file like object with a
+        `write` method (e.g. a WSGI write callable wrapper or a file)
+        or a list the fragments are appended to.
+        """
+        self._check_output_format(format)
+        if tree is None or isinstance(tree, basestring):
+            tree = self.parse(tree, enable_escaping=enable_escaping)
+        tree.render_to(sink, format)
+
+    def compile(self, tree=None, format='html', enable_escaping=False):
+        """
+        Compile a given `tree`, a document or the current `raw` document
+        into a `RenderProgram` that can be rendered repeatedly without
+        walking the node-tree again.
+        """
+        self._check_output_format(format)
+        if tree is None or isinstance(tree, basestring):
+            tree = self.parse(tree, enable_escaping=enable_escaping)
+        return node.compile_tree(tree, format)
 
     ## Some property definitions for an easy-to-use interface
     def _get_stream(self):
@@ -8,17 +8,78 @@
     :copyright: 2008 by Christopher Grebs.
     :license: BSD, see LICENSE for more details.
 """
+from weakref import WeakValueDictionary
 from dmlt import events
-from dmlt.utils import node_repr, escape, striptags
-from dmlt.query import NodeQueryMixin
+from dmlt.exc import FormatNotFound
+from dmlt.utils import node_repr, escape, striptags, load_tree, \
+     _dump_items
+from dmlt.query import NodeQueryMixin, NodeIndex
+
+
+#: The names of all formats at least one node class can be rendered to.
+FORMATS = set()
+
+#: All node classes by module and name, used by `dmlt.serialize` to
+#: look up the classes of a dump without importing anything.
+_node_types = WeakValueDictionary()
+
+
+class NodeType(type):
+    """
+    The metaclass of all nodes.  It collects the `prepare_*` methods
+    of a node class into the `format_table` dict so that dispatching a
+    format is a dict lookup.  The name of every format found is added
+    to `FORMATS`.  Methods added after the class was created are not
+    picked up.
+
+    It also collects the names of all slots that hold the state of the
+    node in `state_slots` and registers the class in `_node_types`.
+    """
+
+    def __init__(cls, name, bases, d):
+        type.__init__(cls, name, bases, d)
+        slots = []
+        for base in reversed(cls.__mro__):
+            names = base.__dict__.get('__slots__', ())
+            if isinstance(names, basestring):
+                names = (names,)
+            slots.extend(x for x in names if x not in slots and
+                         x not in ('__dict__', '__weakref__') and
+                         x not in cls._transient)
+        cls.state_slots = tuple(slots)
+        table = {}
+        for key in dir(cls):
+            if key.startswith('prepare_') and key != 'prepare_format':
+                value = getattr(cls, key)
+                if callable(value):
+                    table[key[8:]] = getattr(value, 'im_func', value)
+        cls.format_table = table
+        FORMATS.update(table)
+        _node_types[cls.__module__, name] = cls
+
+
+def register_format(name):
+    """
+    Register a format that is not implemented by a `prepare_*` method
+    of a node class, e.g. one handled by a custom renderer.
+    """
+    FORMATS.add(name)
+
+
+def check_format(format):
+    """Raise `FormatNotFound` if no node can be rendered to `format`."""
+    if format not in FORMATS:
+        raise FormatNotFound(u'There is no output format called %r' % format)
 
 
 class BaseNode(object):
     """
     A node that represents a part of a document.
     It still implements the `Query` interface to query for nodes.
-    Should be subclassed to implement more `format` options.
+    Should be subclassed to implement more `format` options by
+    adding `prepare_<format>` methods.
     """
+    __metaclass__ = NodeType
     __slots__ = ()
 
     #: The node can contain children.
@@ -41,12 +102,40 @@ class BaseNode(object):
 
     is_document = False
 
+    #: True if the output of the node may change between two renderings
+    #: (e.g. it depends on the current user or time).  Such nodes are
+    #: kept as slots if the tree gets compiled by `compile_tree`.
+    is_dynamic = False
+
     #: the value of the node as text
     text = u''
 
+    #: Attributes that hold caches or links into the tree.  They're
+    #: not part of the state of the node and ignored for comparisons,
+    #: the `repr` and pickling.  They're set to `None` if a node is
+    #: restored by `__setstate__`.
+    _transient = ()
+
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', ()))
+        for key in self.state_slots:
+            try:
+                state[key] = getattr(self, key)
+            except AttributeError:
+                pass
+        for key in self._transient:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        for key in self._transient:
+            setattr(self, key, None)
+        for key, value in state.iteritems():
+            setattr(self, key, value)
+
     def __eq__(self, other):
         return self.__class__ is other.__class__ and \
-               self.__dict__ == other.__dict__
+               self.__getstate__() == other.__getstate__()
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -55,26 +144,75 @@ class BaseNode(object):
 
 
 class Node(BaseNode, NodeQueryMixin):
+    __slots__ = ()
 
     def prepare(self, format='html'):
-        return {'html': self.prepare_html}[format]()
+        """
+        Return an iterator over the output fragments of this node
+        and all of its children.
+        """
+        return iter_fragments(self, format)
+
+    def prepare_format(self, format='html'):
+        """
+        Return the `prepare_*` iterator for `format` of this node only.
+        It yields output fragments or child nodes that should be
+        rendered in place.
+        """
+        try:
+            func = self.format_table[format]
+        except KeyError:
+            raise FormatNotFound(u'%s nodes cannot be rendered as %r' % (
+                self.__class__.__name__, format))
+        return func(self)
 
     def prepare_html(self):
         return iter(())
 
+    def prepare_text(self):
+        yield self.text
+
+    def render_to(self, sink, format='html'):
+        """Write the rendered node into `sink`, see `render_to`."""
+        render_to(self, sink, format)
+
 
 class DeferredNode(Node):
     """
     Special node with a `replace_by()` function that can be used to replace
-    this node in place with another one.
+    this node in place with another one.  Deferred nodes have no slots,
+    so they can be turned into nodes of classes without slots.
     """
+    _transient = ('_parent',)
 
     def __init__(self, node):
         self.node = node
+        self._parent = None
 
     def replace_by(self, other):
-        self.__class__ = other.__class__
-        self.__dict__ = other.__dict__
+        """
+        Replace this node by `other`.  If the node is a child of a
+        `Container` it's replaced in the children of its parent and
+        `node` is set to `other`, so that references to the deferred
+        node can still reach the replacement.  Otherwise the class and
+        the attributes of `other` are copied into this node, which
+        raises a `ValueError` if `other` uses slots.
+        """
+        parent = self._parent
+        if parent is not None:
+            children = parent.children
+            for idx, child in enumerate(children):
+                if child is self:
+                    children[idx] = other
+                    self._parent = None
+                    self.node = other
+                    return
+        try:
+            self.__class__ = other.__class__
+            self.__dict__ = other.__dict__
+        except (TypeError, AttributeError):
+            raise ValueError('the deferred node is not part of a tree and '
+                             '%s nodes use slots' % other.__class__.__name__)
 
     is_container = property(lambda s: s.node.is_container)
     is_text_node = property(lambda s: s.node.is_text_node)
@@ -86,6 +224,7 @@ class Text(Node):
     Represents text.
     """
 
+    __slots__ = ('text',)
     is_text_node = True
 
     def __init__(self, text=u''):
@@ -99,52 +238,421 @@ class HTML(Node):
     """
     Raw HTML snippet.
     """
+    __slots__ = ('html', '_text')
+    _transient = ('_text',)
 
     def __init__(self, html=u''):
         self.html = html
+        self._text = None
 
     @property
     def text(self):
-        return striptags(self.html)
+        cached = self._text
+        if cached is None or cached[0] is not self.html:
+            cached = self._text = (self.html, striptags(self.html))
+        return cached[1]
 
     def prepare_html(self):
         yield self.html
 
 
+class NodeList(list):
+    """
+    The list of the children of a `Container`.  Changing the list
+    invalidates the cached text of its owner and all of its parents.
+    """
+    __slots__ = ('owner',)
+
+    def __init__(self, items=(), owner=None):
+        list.__init__(self, items)
+        self.owner = owner
+        if owner is not None:
+            _adopt(self, owner)
+
+    def _changed(self, items=()):
+        owner = self.owner
+        if owner is not None:
+            _adopt(items, owner)
+            owner._invalidate_text()
+
+    def append(self, item):
+        list.append(self, item)
+        self._changed((item,))
+
+    def extend(self, items):
+        items = list(items)
+        list.extend(self, items)
+        self._changed(items)
+
+    def insert(self, index, item):
+        list.insert(self, index, item)
+        self._changed((item,))
+
+    def remove(self, item):
+        list.remove(self, item)
+        self._changed()
+
+    def pop(self, index=-1):
+        item = list.pop(self, index)
+        self._changed()
+        return item
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        list.reverse(self)
+        self._changed()
+
+    def __setitem__(self, index, item):
+        list.__setitem__(self, index, item)
+        self._changed(isinstance(index, slice) and self[index] or (item,))
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._changed()
+
+    def __setslice__(self, i, j, items):
+        items = list(items)
+        list.__setslice__(self, i, j, items)
+        self._changed(items)
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self._changed()
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def __imul__(self, count):
+        list.__imul__(self, count)
+        self._changed()
+        return self
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def _join_text(children):
+    """
+    Join the `text` of `children` without recursion.  Containers that
+    neither have their text cached nor a custom `text` property are
+    expanded in place.
+    """
+    result = []
+    write = result.append
+    stack = [iter(children)]
+    push = stack.append
+    pop = stack.pop
+    while stack:
+        for node in stack[-1]:
+            if isinstance(node, basestring):
+                write(node)
+            elif isinstance(node, Container) and node._text is None and \
+                 node.__class__.text is Container.text:
+                push(iter(node._children))
+                break
+            else:
+                write(node.text)
+        else:
+            pop()
+    return u''.join(result)
+
+
+def _adopt(items, owner):
+    for item in items:
+        if '_parent' in getattr(item, '_transient', ()):
+            item._parent = owner
+
+
 class Container(Node):
     """
     A basic node with children.
+
+    The text of a container is the text of its children joined, it
+    doesn't depend on the ``text`` render format.  It's cached and the
+    cache is invalidated if the `children` of the container or one of
+    its child containers are changed or replaced.  Changing the
+    attributes of leaf nodes in place is not detected, neither are
+    changes of a node that was added to more than one container, only
+    the containers it was last added to are invalidated.  Assign the
+    changed node to its position in `children` again to update the
+    cache.
     """
+    __slots__ = ('_children', '_parent', '_text')
     is_container = True
+    _transient = ('_parent', '_text')
+    #: only documents hold a `NodeIndex`, see `Document.get_index`
+    _index = None
 
     def __init__(self, children=None):
         if children is None:
             children = []
+        self._parent = self._text = None
         self.children = children
 
+    def _get_children(self):
+        return self._children
+    def _set_children(self, children):
+        self._children = NodeList(children, self)
+        self._invalidate_text()
+    children = property(_get_children, _set_children)
+
+    def _invalidate_text(self):
+        node = self
+        while True:
+            node._text = None
+            if node._parent is None:
+                break
+            node = node._parent
+        if node._index is not None:
+            node._index = None
+
     @property
     def text(self):
-        return u''.join(x.text for x in self.children)
+        if self._text is None:
+            self._text = _join_text(self._children)
+        return self._text
 
     def prepare_html(self):
-        for child in self.children:
-            for item in child.prepare_html():
-                yield item
+        """
+        Yield the rendered output of the children.  The renderer doesn't
+        call this for containers that don't override it but renders the
+        children in place on its own stack.  Subclasses that wrap the
+        children should yield the child nodes themselves instead of
+        calling this method, so that they're rendered on that stack too
+        and dynamic nodes are kept by `compile_tree`.
+        """
+        return _iter_fragments(self._children, 'html')
+
+    def prepare_text(self):
+        if self.__class__.text is not Container.text:
+            # a custom text property
+            return iter((self.text,))
+        return iter(self._children)
+
+    def __getstate__(self):
+        state = Node.__getstate__(self)
+        state['children'] = list(state.pop('_children'))
+        return state
+
+    def __copy__(self):
+        """
+        Return a shallow copy.  The children are shared with this
+        container and keep it as their parent, so changes of nested
+        containers don't invalidate the text of the copy.
+        """
+        state = self.__getstate__()
+        children = state['children']
+        state['children'] = []
+        rv = self.__class__.__new__(self.__class__)
+        rv.__setstate__(state)
+        rv._children = NodeList(children)
+        rv._children.owner = rv
+        return rv
 
 
 class Document(Container):
     """
     Outermost node.
     """
+    __slots__ = ('_index',)
     is_document = True
+    _transient = ('_parent', '_text', '_index')
+
+    def __init__(self, children=None):
+        self._index = None
+        Container.__init__(self, children)
+
+    def get_index(self):
+        """
+        Return the `dmlt.query.NodeIndex` of the document.  It's built
+        on first use and dropped if the tree is changed.
+        """
+        if self._index is None:
+            self._index = NodeIndex(self)
+        return self._index
+
+
+#: maps formats to the default `prepare_*` methods of containers that
+#: only render the children, see `_prepare`.
+_expanded_formats = {'html': Container.prepare_html.im_func}
+
 
 @events.register('define-document-node')
 def _handle_define_document_node(manager, *args, **kwargs):
     return Document
 
 
+def iter_fragments(tree, format='html'):
+    """
+    Iterate over the output fragments of `tree` in the given `format`.
+
+    The `prepare_*` methods may yield child nodes instead of their
+    fragments.  Those are rendered in place using an explicit stack so
+    that no fragment has to pass a generator per tree level.
+    """
+    return _iter_fragments((tree,), format)
+
+
+def _prepare(node, format):
+    """
+    Return the `prepare_*` iterator of `node`.  For containers using the
+    default `Container.prepare_html` the children are returned, so that
+    the caller renders them on its stack.
+    """
+    func = node.format_table.get(format)
+    if func is not None and func is _expanded_formats.get(format):
+        return iter(node._children)
+    return iter(node.prepare_format(format))
+
+
+def _iter_fragments(items, format, keep=None):
+    """
+    Iterate over the fragments of `items`, the output of a `prepare_*`
+    method.  Nodes are expanded in place unless `keep` returns `True`
+    for them, those are yielded as they are.
+    """
+    stack = [iter(items)]
+    push = stack.append
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, basestring) or \
+               (keep is not None and keep(item)):
+                yield item
+            else:
+                push(_prepare(item, format))
+                break
+        else:
+            stack.pop()
+
+
+def render_to(tree, sink, format='html'):
+    """
+    Render `tree` into `sink` without building the output string.
+    `sink` is either a file like object with a `write` method or
+    a list the fragments get appended to.
+    """
+    write = getattr(sink, 'write', None) or sink.append
+    # the loop of `_iter_fragments` inlined, it's the hot path
+    expanded = _expanded_formats.get(format)
+    stack = [_prepare(tree, format)]
+    push = stack.append
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, basestring):
+                write(item)
+            elif expanded is not None and \
+                 item.format_table.get(format) is expanded:
+                push(iter(item._children))
+                break
+            else:
+                push(iter(item.prepare_format(format)))
+                break
+        else:
+            stack.pop()
+
+
+def compile_tree(tree, format='html'):
+    """
+    Compile `tree` into a `RenderProgram`.  The output of all static
+    nodes is rendered once and adjacent chunks are merged, nodes marked
+    as `is_dynamic` are kept to be rendered every time the program is
+    executed.
+    """
+    if tree.is_dynamic:
+        return RenderProgram([tree], format)
+    instructions = []
+    buffer = []
+    for item in _iter_fragments(_prepare(tree, format), format,
+                                lambda node: node.is_dynamic):
+        if isinstance(item, basestring):
+            buffer.append(item)
+        else:
+            if buffer:
+                instructions.append(u''.join(buffer))
+                del buffer[:]
+            instructions.append(item)
+    if buffer or not instructions:
+        instructions.append(u''.join(buffer))
+    return RenderProgram(instructions, format)
+
+
+class RenderProgram(object):
+    """
+    A flat list of static output chunks and dynamic nodes created by
+    `compile_tree`.  Executing the program renders the dynamic nodes
+    and joins everything in one go.
+    """
+
+    def __init__(self, instructions, format='html'):
+        self.instructions = instructions
+        self.format = format
+
+    @property
+    def is_static(self):
+        """True if the program contains no dynamic nodes."""
+        return len(self.instructions) == 1 and \
+               isinstance(self.instructions[0], basestring)
+
+    @property
+    def dynamic_nodes(self):
+        """A list of the slots that are filled at render time."""
+        return [x for x in self.instructions
+                if not isinstance(x, basestring)]
+
+    def render(self):
+        """Execute the program and return the output."""
+        if self.is_static:
+            return self.instructions[0]
+        result = []
+        self.render_to(result)
+        return u''.join(result)
+
+    def render_to(self, sink):
+        """Execute the program and write the output into `sink`."""
+        write = getattr(sink, 'write', None) or sink.append
+        for item in self.instructions:
+            if isinstance(item, basestring):
+                write(item)
+            else:
+                render_to(item, sink, self.format)
+
+    def dump(self):
+        """Dump the program in the format of `dump_tree`."""
+        return _dump_items(self.instructions, self.format)
+
+    @classmethod
+    def load(cls, obj):
+        """Load a program from a string dumped by `dump`."""
+        instructions, node, format = load_tree(obj)
+        return cls(instructions, format)
+
+    def __eq__(self, other):
+        return self.__class__ is other.__class__ and \
+               self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '<%s(%s, %d instructions)>' % (self.__class__.__name__,
+            self.format, len(self.instructions))
+
+
+def get_text(tree):
+    """
+    Return the text of `tree`.  The text of all nodes is collected in
+    one pass without building the text of every container on its own.
+    """
+    return u''.join(iter_fragments(tree, 'text'))
+
+
 class Raw(Container):
     """
     A raw container.
     """
+    __slots__ = ()
     is_raw = True
@@ -5,9 +5,112 @@
 
     This module implements some query interface for nodes.
 
+    Queries on a `dmlt.node.Document` or a container in it use the
+    `NodeIndex` of the document.  It's built on the first query and maps
+    the node classes to the nodes in document order, so repeated queries
+    only cost the size of their results.  Changing the `children` of
+    a container in the document drops the index.
+
+    The tree is walked with `iter_tree`, `iter_tree_post` and
+    `iter_tree_events`.  They use an explicit stack, so the depth of a
+    tree is not limited by the recursion limit and every node passes
+    through only one generator.
+
     :copyright: 2008 by Christopher Grebs.
     :license: BSD, see LICENSE for details.
 """
+from bisect import bisect_left
+from heapq import merge
+from itertools import chain
+
+
+__all__ = ('NodeQueryMixin', 'Query', 'NodeIndex', 'iter_tree',
+           'iter_tree_post', 'iter_tree_events')
+
+
+def _expand(node, prune):
+    return node.is_container and (prune is None or not prune(node))
+
+
+def iter_tree(tree, prune=None):
+    """
+    Iterate over `tree` and all of its descendants in pre-order.
+
+    :param prune: A function called with every container.  If it returns
+                  `True` the children of the container are skipped.
+                  It's called after the container was yielded.
+    """
+    yield tree
+    if not _expand(tree, prune):
+        return
+    stack = [iter(tree.children)]
+    push = stack.append
+    pop = stack.pop
+    while stack:
+        for node in stack[-1]:
+            yield node
+            if node.is_container and (prune is None or not prune(node)):
+                push(iter(node.children))
+                break
+        else:
+            pop()
+
+
+def iter_tree_post(tree, prune=None):
+    """
+    Iterate over `tree` and all of its descendants in post-order, the
+    children of a container are yielded before the container.
+
+    :param prune: A function called with every container before its
+                  children are visited.  If it returns `True` they're
+                  skipped.
+    """
+    if not _expand(tree, prune):
+        yield tree
+        return
+    stack = [(tree, iter(tree.children))]
+    push = stack.append
+    pop = stack.pop
+    while stack:
+        for node in stack[-1][1]:
+            if node.is_container and (prune is None or not prune(node)):
+                push((node, iter(node.children)))
+                break
+            yield node
+        else:
+            yield pop()[0]
+
+
+def iter_tree_events(tree, prune=None):
+    """
+    Walk `tree` and yield ``(node, parent, index, leaving)`` tuples,
+    one with `leaving` set to `False` before the descendants of the node
+    are visited and one with `leaving` set to `True` afterwards.  `parent`
+    and `index` are the container the node was found in and its position
+    in the children (`None` and ``0`` for `tree`).
+
+    :param prune: A function called with every container after it was
+                  entered.  If it returns `True` the children of the
+                  container are skipped, but it's left nonetheless.
+    """
+    yield tree, None, 0, False
+    if not _expand(tree, prune):
+        yield tree, None, 0, True
+        return
+    stack = [(tree, None, 0, enumerate(tree.children))]
+    push = stack.append
+    pop = stack.pop
+    while stack:
+        parent, grandparent, parent_index, children = stack[-1]
+        for index, node in children:
+            yield node, parent, index, False
+            if node.is_container and (prune is None or not prune(node)):
+                push((node, parent, index, enumerate(node.children)))
+                break
+            yield node, parent, index, True
+        else:
+            pop()
+            yield parent, grandparent, parent_index, True
 
 
 class NodeQueryMixin(object):
@@ -16,6 +119,7 @@ class NodeQueryMixin(object):
     attribute returns a new `Query` object for the node that implements the
     query interface.
     """
+    __slots__ = ()
 
     @property
     def query(self):
@@ -48,6 +152,29 @@ class Query(object):
             return False
         return True
 
+    def _get_index(self):
+        """
+        Return the `NodeIndex` that holds the subtree of the queried
+        node or `None` if the query can't use an index.
+        """
+        nodes = self.nodes
+        if not self.recurse or nodes.__class__ is not tuple or \
+           len(nodes) != 1 or not self._nodeiter.__length_hint__():
+            # not a query of one node or the node was consumed already
+            return None
+        root = nodes[0]
+        parent = getattr(root, '_parent', None)
+        while parent is not None:
+            root = parent
+            parent = getattr(root, '_parent', None)
+        get_index = getattr(root, 'get_index', None)
+        if get_index is None:
+            return None
+        index = get_index()
+        if nodes[0] not in index:
+            return None
+        return index
+
     @property
     def children(self):
         """Return a new `Query` just for the direct children."""
@@ -56,18 +183,115 @@ class Query(object):
     @property
     def all(self):
         """Retrn a `Query` object for all nodes this node holds."""
-        def walk(nodes):
-            for node in nodes:
-                yield node
-                if self.recurse and node.is_container:
-                    for result in walk(node.children):
-                        yield result
-        return Query(walk(self))
+        if not self.recurse:
+            return Query(self)
+        return Query(chain.from_iterable(iter_tree(x) for x in self))
 
     def by_type(self, type):
         """Performs an instance test on all nodes."""
+        index = self._get_index()
+        if index is not None:
+            return Query(index.by_type(type, self.nodes[0]))
         return Query(n for n in self.all if isinstance(n, type))
 
     def text_nodes(self):
         """Only text nodes."""
+        index = self._get_index()
+        if index is not None:
+            return Query(index.text_nodes(self.nodes[0]))
         return Query(n for n in self.all if n.is_text_node)
+
+
+class NodeIndex(object):
+    """
+    Maps the node classes of a tree to its nodes in document order.
+    The index is built in one traversal and not updated, it must be
+    thrown away if the tree changes.  The size of a subtree is counted
+    when it's queried first.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        nodes = {}
+        positions = {}
+        text_nodes = []
+        text_positions = []
+        #: maps the ids of the containers to their position
+        starts = {}
+        pos = 0
+        for node in iter_tree(root):
+            cls = node.__class__
+            try:
+                nodes[cls].append(node)
+                positions[cls].append(pos)
+            except KeyError:
+                nodes[cls] = [node]
+                positions[cls] = [pos]
+            if node.is_text_node:
+                text_nodes.append(node)
+                text_positions.append(pos)
+            if node.is_container:
+                starts[id(node)] = pos
+            pos += 1
+        self._classes = dict((cls, (positions[cls], nodes[cls]))
+                             for cls in nodes)
+        self._text = (text_positions, text_nodes)
+        self._starts = starts
+        #: the ranges of positions of the subtrees queried so far
+        self._ranges = {}
+        #: the results of subclass queries
+        self._cache = {}
+
+    def _get_type(self, type):
+        try:
+            return self._cache[type]
+        except KeyError:
+            pass
+        found = [v for k, v in self._classes.iteritems()
+                 if issubclass(k, type)]
+        if not found:
+            rv = ([], [])
+        elif len(found) == 1:
+            rv = found[0]
+        else:
+            items = list(merge(*[zip(*x) for x in found]))
+            rv = ([x[0] for x in items], [x[1] for x in items])
+        self._cache[type] = rv
+        return rv
+
+    def _slice(self, (positions, nodes), node):
+        if node is None or node is self.root:
+            return nodes
+        start, end = self._get_range(node)
+        return nodes[bisect_left(positions, start):
+                     bisect_left(positions, end)]
+
+    def _get_range(self, node):
+        try:
+            return self._ranges[id(node)]
+        except KeyError:
+            start = self._starts[id(node)]
+            end = start
+            for item in iter_tree(node):
+                end += 1
+            self._ranges[id(node)] = rv = (start, end)
+            return rv
+
+    def by_type(self, type, node=None):
+        """
+        Return a list of all nodes that are instances of `type` in
+        document order.  If `node` is given only the nodes in its
+        subtree (including `node`) are returned.
+        """
+        return self._slice(self._get_type(type), node)
+
+    def text_nodes(self, node=None):
+        """Return a list of the text nodes like `by_type`."""
+        return self._slice(self._text, node)
+
+    def __contains__(self, node):
+        """Check if the subtree of the container `node` is indexed."""
+        return id(node) in self._starts
+
+    def __len__(self):
+        return sum(len(x[1]) for x in self._classes.itervalues())
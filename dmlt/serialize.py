@@ -0,0 +1,483 @@
+#-*- coding: utf-8 -*-
+"""
+    dmlt.serialize
+    ~~~~~~~~~~~~~~
+
+    A compact and versioned binary format for node-trees.
+
+    A dump starts with a header (magic, version and the output format)
+    followed by a table of the node types and an opcode stream in post
+    order.  Loading is a simple stack machine, so trees of arbitrary
+    depth can be processed without recursion and without pickle.
+
+    The arguments of the opcodes, the text of all unicode strings and
+    all other values are stored in separate sections after the opcodes,
+    so the loader decodes all strings at once and reads the arguments
+    from an array instead of parsing every opcode on its own.
+
+    Nodes are restored by creating an instance of their class without
+    calling `__init__` and restoring their attributes like
+    `BaseNode.__setstate__` does.  Only node classes can be loaded, they
+    are looked up by module and name among the node classes defined so
+    far and never imported.  Pass `resolve` to `load_nodes` to control
+    that lookup.
+
+    :copyright: 2008 by Christopher Grebs.
+    :license: BSD, see LICENSE for more details.
+"""
+import re
+import sys
+from array import array
+from keyword import iskeyword
+from struct import pack, unpack_from
+from dmlt.exc import SerializationError
+from dmlt.node import BaseNode, _node_types
+
+
+__all__ = ('dump_nodes', 'load_nodes', 'FORMAT_VERSION')
+
+
+MAGIC = 'DMLT'
+#: The version of the format.  Dumps of other versions are rejected.
+FORMAT_VERSION = 2
+
+# opcodes
+OP_NONE = 'n'
+OP_TRUE = 't'
+OP_FALSE = 'f'
+OP_INT = 'i'
+OP_LONG = 'I'
+OP_FLOAT = 'd'
+OP_UNICODE = 'u'
+OP_BYTES = 'b'
+OP_LIST = 'l'
+OP_TUPLE = 'p'
+OP_DICT = 'm'
+OP_NODE = 'N'
+
+# how the unicode strings are stored: joined by null characters or,
+# if a string contains one, with the lengths of the encoded strings
+TEXT_JOINED = '\0'
+TEXT_SIZED = '\1'
+
+_atomic_types = (type(None), bool, int, long, float, unicode, str)
+
+#: the typecode of an array of unsigned 32 bit integers, stored in
+#: little endian byte order
+_arg_type = [x for x in 'IL' if array(x).itemsize == 4][0]
+_swap_args = sys.byteorder != 'little'
+
+_identifier_re = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*\Z')
+
+#: the functions that restore nodes by the attributes they set
+_constructors = {}
+
+
+def _varint(value):
+    if value < 0x80:
+        return chr(value)
+    result = []
+    while value >= 0x80:
+        result.append(chr(value & 0x7f | 0x80))
+        value >>= 7
+    result.append(chr(value))
+    return ''.join(result)
+
+
+def _read_varint(data, pos):
+    byte = ord(data[pos])
+    if byte < 0x80:
+        return byte, pos + 1
+    value = shift = 0
+    while byte >= 0x80:
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        pos += 1
+        byte = ord(data[pos])
+    return value | (byte << shift), pos + 1
+
+
+def _string(value):
+    return _varint(len(value)) + value
+
+
+def _dump_args(args):
+    if _swap_args:
+        args.byteswap()
+    return args.tostring()
+
+
+def _load_args(data):
+    args = array(_arg_type)
+    args.fromstring(data)
+    if _swap_args:
+        args.byteswap()
+    return args
+
+
+def _get_state(obj):
+    """Return the attributes of a node as a sorted list of items."""
+    return sorted(obj.__getstate__().items())
+
+
+def _resolve_class(module, name):
+    try:
+        return _node_types[module, name]
+    except KeyError:
+        raise SerializationError('unknown node type %s.%s, is the module '
+                                 'imported?' % (module, name))
+
+
+def _check_attributes(cls, names):
+    """Return `True` if nodes of `cls` may be restored with `names`."""
+    for name in names:
+        if name in cls.state_slots:
+            continue
+        # other attributes are properties or stored in the `__dict__`
+        if not _identifier_re.match(name) or iskeyword(name) or \
+           name.startswith('__') or name in cls._transient or \
+           not (cls.__dictoffset__ or hasattr(cls, name)):
+            return False
+    return True
+
+
+def _make_constructor(transient, nones, names):
+    """
+    Return a function that creates a node and restores its attributes
+    like `BaseNode.__setstate__` does.  It's called with `__new__` and
+    the class of the node and a function that pops the values of
+    `names` from the stack of the loader in reverse order.
+    """
+    key = (transient, nones, names)
+    try:
+        return _constructors[key]
+    except KeyError:
+        pass
+    source = ['def construct(new, cls, pop):', '    obj = new(cls)']
+    source.extend('    obj.%s = None' % x for x in transient + nones)
+    source.extend('    obj.%s = pop()' % x for x in reversed(names))
+    source.append('    return obj')
+    namespace = {}
+    exec compile('\n'.join(source), '<dmlt.serialize>', 'exec') in namespace
+    rv = _constructors[key] = namespace['construct']
+    return rv
+
+
+def _make_setstate_constructor(nones, names):
+    """
+    Like `_make_constructor` but for nodes that override `__setstate__`.
+    """
+    def construct(new, cls, pop):
+        values = [pop() for x in names]
+        values.reverse()
+        state = dict.fromkeys(nones)
+        state.update(zip(names, values))
+        obj = new(cls)
+        obj.__setstate__(state)
+        return obj
+    return construct
+
+
+def _get_type(cls, attributes):
+    """
+    Return the entry of the type table for nodes of `cls`.  The
+    attributes are a list of ``(name, is_none)`` tuples in the order
+    of `_get_state`.
+    """
+    names = tuple(x[0] for x in attributes if not x[1])
+    nones = tuple(x[0] for x in attributes if x[1])
+    if not _check_attributes(cls, names + nones):
+        raise SerializationError('invalid attributes for node type %s.%s'
+                                 % (cls.__module__, cls.__name__))
+    if getattr(cls.__setstate__, 'im_func', None) is \
+       BaseNode.__setstate__.im_func:
+        construct = _make_constructor(tuple(cls._transient), nones, names)
+    else:
+        construct = _make_setstate_constructor(nones, names)
+    return construct, cls.__new__, cls, len(names)
+
+
+def dump_nodes(obj, format=''):
+    """
+    Dump `obj`, a node-tree or a list of nodes and strings, into a
+    byte string.  All objects must either be nodes or atomic values
+    (None, bools, numbers, strings) or lists, tuples and dicts of those.
+    Nodes referenced multiple times are dumped multiple times, the tree
+    must not contain cycles.
+    """
+    if isinstance(format, unicode):
+        format = format.encode('utf-8')
+    if '\0' in format:
+        raise ValueError('format must not contain null bytes')
+    types = {}
+    type_table = []
+    ops = []
+    op = ops.append
+    args = array(_arg_type)
+    arg = args.append
+    texts = []
+    text = texts.append
+    values = []
+    write = values.append
+    # post order traversal: containers are written after their items
+    stack = [(obj, False)]
+    push = stack.append
+    pop = stack.pop
+    while stack:
+        value, done = pop()
+        if done:
+            # the opcode and argument that close a container
+            op(value[0])
+            arg(value[1])
+            continue
+        cls = value.__class__
+        if cls is unicode:
+            op(OP_UNICODE)
+            text(value)
+        elif cls is str:
+            op(OP_BYTES)
+            arg(len(value))
+            write(value)
+        elif value is None:
+            op(OP_NONE)
+        elif cls is bool:
+            op(value and OP_TRUE or OP_FALSE)
+        elif (cls is int or cls is long) and 0 <= value <= 0xffffffff:
+            op(OP_INT)
+            arg(value)
+        elif cls is int or cls is long:
+            value = str(value)
+            op(OP_LONG)
+            arg(len(value))
+            write(value)
+        elif cls is float:
+            op(OP_FLOAT)
+            write(pack('<d', value))
+        elif cls is list or cls is tuple:
+            push(((cls is list and OP_LIST or OP_TUPLE, len(value)), True))
+            for item in reversed(value):
+                push((item, False))
+        elif cls is dict:
+            push(((OP_DICT, len(value)), True))
+            for key, item in sorted(value.items(), reverse=True):
+                push((item, False))
+                push((key, False))
+        elif not isinstance(value, BaseNode) or \
+             isinstance(value, _atomic_types):
+            raise SerializationError('cannot dump objects of type %s'
+                                     % cls.__name__)
+        else:
+            state = _get_state(value)
+            # attributes set to `None` are stored in the type table
+            key = (cls, tuple((x[0], x[1] is None) for x in state))
+            type_id = types.get(key)
+            if type_id is None:
+                type_id = types[key] = len(type_table)
+                type_table.append(key)
+            push(((OP_NODE, type_id), True))
+            for name, item in reversed(state):
+                if item is not None:
+                    push((item, False))
+
+    text_data = u'\0'.join(texts).encode('utf-8')
+    if text_data.count('\0') == max(len(texts) - 1, 0):
+        text_mode = TEXT_JOINED
+        sizes = ''
+    else:
+        text_mode = TEXT_SIZED
+        texts = [x.encode('utf-8') for x in texts]
+        text_data = ''.join(texts)
+        sizes = _dump_args(array(_arg_type, map(len, texts)))
+    ops = ''.join(ops)
+    args = _dump_args(args)
+    values = ''.join(values)
+
+    header = [MAGIC, chr(FORMAT_VERSION), format, '\0',
+              _varint(len(type_table))]
+    for cls, attributes in type_table:
+        header.append(_string(cls.__module__))
+        header.append(_string(cls.__name__))
+        header.append(_varint(len(attributes)))
+        for name, is_none in attributes:
+            header.append((is_none and '\1' or '\0') + _string(name))
+    header.append(text_mode)
+    header.extend(_varint(x) for x in (len(ops), len(args), len(texts),
+                                       len(text_data), len(values)))
+    return ''.join(header) + ops + args + text_data + values + sizes
+
+
+def _read_header(data):
+    if data[:len(MAGIC)] != MAGIC:
+        raise SerializationError('not a dumped node-tree')
+    version = ord(data[len(MAGIC)])
+    if version != FORMAT_VERSION:
+        raise SerializationError('unsupported format version %d, '
+                                 'expected %d' % (version, FORMAT_VERSION))
+    pos = data.index('\0', len(MAGIC) + 1)
+    return data[len(MAGIC) + 1:pos], pos + 1
+
+
+def _read_type_table(data, pos, resolve):
+    count, pos = _read_varint(data, pos)
+    type_table = []
+    for x in xrange(count):
+        length, pos = _read_varint(data, pos)
+        module = data[pos:pos + length]
+        pos += length
+        length, pos = _read_varint(data, pos)
+        name = data[pos:pos + length]
+        pos += length
+        num, pos = _read_varint(data, pos)
+        attributes = []
+        for y in xrange(num):
+            is_none = data[pos]
+            length, pos = _read_varint(data, pos + 1)
+            attributes.append((data[pos:pos + length], is_none == '\1'))
+            pos += length
+            if is_none not in '\0\1' or len(attributes[-1][0]) != length:
+                raise SerializationError('truncated or corrupted dump')
+        try:
+            cls = resolve(module, name)
+        except SerializationError:
+            raise
+        except Exception, e:
+            raise SerializationError('cannot resolve node type %s.%s: %s'
+                                     % (module, name, e))
+        if not isinstance(cls, type) or not issubclass(cls, BaseNode):
+            raise SerializationError('%s.%s is not a node type'
+                                     % (module, name))
+        type_table.append(_get_type(cls, attributes))
+    return type_table, pos
+
+
+def _read_strings(mode, data, count, sizes):
+    if mode == TEXT_JOINED:
+        if not count:
+            return []
+        strings = data.decode('utf-8').split(u'\0')
+    elif mode == TEXT_SIZED:
+        strings = []
+        pos = 0
+        for size in _load_args(sizes):
+            strings.append(data[pos:pos + size].decode('utf-8'))
+            pos += size
+        if pos != len(data):
+            raise ValueError('string sizes do not match')
+    else:
+        raise ValueError('unknown text mode')
+    if len(strings) != count:
+        raise ValueError('string count does not match')
+    return strings
+
+
+def load_nodes(data, resolve=None):
+    """
+    Load the object dumped by `dump_nodes` from `data`.
+
+    :param resolve: A function called with the module and name of a
+                    node type that returns the class.  The default
+                    looks the class up among the node classes defined
+                    so far.  Classes that are not subclasses of
+                    `BaseNode` are rejected.
+    :return: A tuple in the form of ``(format, obj)``.
+    :raise SerializationError: if the dump is invalid or a node can't
+                               be restored.
+    """
+    if resolve is None:
+        resolve = _resolve_class
+    try:
+        format, pos = _read_header(data)
+        type_table, pos = _read_type_table(data, pos, resolve)
+        text_mode = data[pos]
+        sections = []
+        pos += 1
+        for x in xrange(5):
+            value, pos = _read_varint(data, pos)
+            sections.append(value)
+        num_ops, num_args, num_strings, num_text, num_values = sections
+        ops = data[pos:pos + num_ops]
+        pos += num_ops
+        args = _load_args(data[pos:pos + num_args])
+        pos += num_args
+        text = data[pos:pos + num_text]
+        pos += num_text
+        values = data[pos:pos + num_values]
+        pos += num_values
+        sizes = data[pos:]
+        if len(values) != num_values or \
+           len(sizes) != (text_mode == TEXT_SIZED and 4 * num_strings):
+            raise SerializationError('truncated or corrupted dump')
+        strings = _read_strings(text_mode, text, num_strings, sizes)
+    except (IndexError, ValueError, UnicodeError, EOFError):
+        raise SerializationError('truncated or corrupted dump')
+
+    next_arg = iter(args).next
+    next_string = iter(strings).next
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    pos = 0
+    try:
+        for op in ops:
+            if op == OP_UNICODE:
+                push(next_string())
+            elif op == OP_NODE:
+                construct, new, cls, count = type_table[next_arg()]
+                if count > len(stack):
+                    raise IndexError()
+                try:
+                    push(construct(new, cls, pop))
+                except Exception, e:
+                    raise SerializationError('cannot restore node of type '
+                                             '%s.%s: %s' % (cls.__module__,
+                                             cls.__name__, e))
+            elif op == OP_NONE:
+                push(None)
+            elif op == OP_LIST or op == OP_TUPLE or op == OP_DICT:
+                length = next_arg()
+                if op == OP_DICT:
+                    length *= 2
+                if length > len(stack):
+                    raise IndexError()
+                items = length and stack[-length:] or []
+                del stack[len(stack) - length:]
+                if op == OP_LIST:
+                    push(items)
+                elif op == OP_TUPLE:
+                    push(tuple(items))
+                else:
+                    push(dict(zip(items[::2], items[1::2])))
+            elif op == OP_TRUE:
+                push(True)
+            elif op == OP_FALSE:
+                push(False)
+            elif op == OP_INT:
+                push(int(next_arg()))
+            elif op == OP_FLOAT:
+                push(unpack_from('<d', values, pos)[0])
+                pos += 8
+            elif op == OP_BYTES or op == OP_LONG:
+                length = next_arg()
+                value = values[pos:pos + length]
+                if len(value) != length:
+                    raise IndexError()
+                if op == OP_LONG:
+                    value = int(value)
+                push(value)
+                pos += length
+            else:
+                raise SerializationError('unknown opcode %r' % op)
+        # all arguments and strings must have been used
+        for x in next_arg, next_string:
+            try:
+                x()
+            except StopIteration:
+                continue
+            raise IndexError()
+    except SerializationError:
+        raise
+    except Exception:
+        raise SerializationError('truncated or corrupted dump')
+    if len(stack) != 1:
+        raise SerializationError('truncated or corrupted dump')
+    return format, stack[0]
@@ -0,0 +1,249 @@
+#-*- coding: utf-8 -*-
+"""
+    dmlt.store
+    ~~~~~~~~~~
+
+    A file format that packs many documents dumped by `dump_tree` into
+    one file.  Stores are opened with `mmap`, so opening is cheap and
+    lookups don't read anything but the entries they return::
+
+        >>> write_store('pages.dmls', ((name, dump_tree(tree, 'html'))
+        ...                            for name, tree in pages))
+        >>> store = DocumentStore('pages.dmls')
+        >>> store.get_static('FrontPage')
+        <read-only buffer ...>
+
+    The file starts with a header (magic, version and the offset of the
+    index) followed by the dumped documents.  The index at the end of
+    the file is a table of fixed size records sorted by key that is
+    searched with a binary search, followed by the keys.
+
+    :copyright: 2008 by Christopher Grebs.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import mmap
+import errno
+import tempfile
+from struct import Struct
+from dmlt.exc import SerializationError
+from dmlt.utils import load_tree
+
+
+__all__ = ('DocumentStore', 'write_store', 'STORE_VERSION')
+
+
+MAGIC = 'DMLS'
+#: The version of the store format.  Other versions are rejected.
+STORE_VERSION = 1
+
+# magic, version, index offset
+_header = Struct('<4sB3xQ')
+# number of entries
+_index_header = Struct('<Q')
+# key offset, key length, document offset, document length
+_record = Struct('<QIQQ')
+
+
+def _encode_key(key):
+    if isinstance(key, unicode):
+        return key.encode('utf-8')
+    return key
+
+
+def _write_store(f, items):
+    entries = []
+    f.write(_header.pack(MAGIC, STORE_VERSION, 0))
+    offset = _header.size
+    for key, data in items:
+        entries.append((_encode_key(key), offset, len(data)))
+        f.write(data)
+        offset += len(data)
+
+    entries.sort()
+    for idx in xrange(1, len(entries)):
+        if entries[idx][0] == entries[idx - 1][0]:
+            raise ValueError('duplicate key %r' % entries[idx][0])
+    index_offset = offset
+    key_offset = index_offset + _index_header.size + \
+                 len(entries) * _record.size
+    f.write(_index_header.pack(len(entries)))
+    for key, offset, length in entries:
+        f.write(_record.pack(key_offset, len(key), offset, length))
+        key_offset += len(key)
+    for key, offset, length in entries:
+        f.write(key)
+    f.seek(0)
+    f.write(_header.pack(MAGIC, STORE_VERSION, index_offset))
+
+
+def write_store(filename, items, mode=0644):
+    """
+    Write a store to `filename`.  The store is written to a temporary
+    file that replaces `filename` once it's complete, so an existing
+    store is left as it is if writing fails.
+
+    :param items: An iterable of ``(key, data)`` tuples where `data` is
+                  a string returned by `dump_tree`.  Keys are unicode
+                  or byte strings and must be unique.
+    :param mode: The permissions of the written file.
+    """
+    fd, tmp = tempfile.mkstemp(prefix='.',
+                               dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            _write_store(f, items)
+        finally:
+            f.close()
+        os.chmod(tmp, mode)
+        try:
+            os.rename(tmp, filename)
+        except OSError, e:
+            # windows doesn't replace existing files
+            if e.errno != errno.EEXIST:
+                raise
+            os.remove(filename)
+            os.rename(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class DocumentStore(object):
+    """
+    A read-only store written by `write_store`.  Documents are returned
+    as buffers on the memory mapped file, they are not copied until
+    they're decoded.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        f = open(filename, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < _header.size:
+                raise SerializationError('not a document store')
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, version, index_offset = _header.unpack_from(self._map)
+        if magic != MAGIC:
+            self.close()
+            raise SerializationError('not a document store')
+        if version != STORE_VERSION:
+            self.close()
+            raise SerializationError('unsupported store version %d, '
+                                     'expected %d' % (version, STORE_VERSION))
+        self._records = index_offset + _index_header.size
+        if index_offset < _header.size or self._records > size:
+            self.close()
+            raise SerializationError('truncated or corrupted store')
+        self._count = _index_header.unpack_from(self._map, index_offset)[0]
+        # the keys are stored in the order of the records after them
+        if self._count > (size - self._records) // _record.size or \
+           self._count and sum(self._get_record(self._count - 1)[:2]) > size:
+            self.close()
+            raise SerializationError('truncated or corrupted store')
+
+    def _get_record(self, idx):
+        return _record.unpack_from(self._map, self._records +
+                                   idx * _record.size)
+
+    def _get_key(self, record):
+        return self._map[record[0]:record[0] + record[1]]
+
+    def _find(self, key):
+        key = _encode_key(key)
+        low = 0
+        high = self._count
+        while low < high:
+            middle = (low + high) // 2
+            record = self._get_record(middle)
+            other = self._get_key(record)
+            if other < key:
+                low = middle + 1
+            elif other > key:
+                high = middle
+            else:
+                return record
+        raise KeyError(key)
+
+    def get_raw(self, key):
+        """
+        Return the data dumped by `dump_tree` for `key` as a buffer.
+        Raises a `KeyError` if the key does not exist.
+        """
+        record = self._find(key)
+        return buffer(self._map, record[2], record[3])
+
+    def get_format(self, key):
+        """Return the output format of the document `key`."""
+        record = self._find(key)
+        if self._map[record[2]] == '!':
+            end = self._map.find('\0', record[2], record[2] + record[3])
+            return self._map[record[2] + 1:end]
+        return load_tree(self._map[record[2]:record[2] + record[3]])[2]
+
+    def get_static(self, key):
+        """
+        Return the utf-8 encoded output of the static document `key`
+        as a buffer or `None` if the document is dynamic.
+        """
+        record = self._find(key)
+        offset, length = record[2], record[3]
+        if self._map[offset] != '!':
+            return None
+        start = self._map.find('\0', offset, offset + length) + 1
+        return buffer(self._map, start, offset + length - start)
+
+    def load(self, key):
+        """
+        Load the document `key` like `load_tree`.
+
+        :return: A tuple in the form of (instructions, node, format).
+        """
+        record = self._find(key)
+        return load_tree(self._map[record[2]:record[2] + record[3]])
+
+    def write_to(self, key, sink):
+        """
+        Write the utf-8 encoded output of the static document `key` into
+        the file like object `sink` without decoding it.  Returns `False`
+        if the document is dynamic and must be loaded.
+        """
+        data = self.get_static(key)
+        if data is None:
+            return False
+        sink.write(data)
+        return True
+
+    def keys(self):
+        """Return a list of all keys in the store."""
+        return [self._get_key(self._get_record(idx))
+                for idx in xrange(self._count)]
+
+    def close(self):
+        """Close the memory mapped file."""
+        self._map.close()
+
+    def __contains__(self, key):
+        try:
+            self._find(key)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, key):
+        return self.get_raw(key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self._count
+
+    def __repr__(self):
+        return '<%s(%r, %d documents)>' % (self.__class__.__name__,
+                                           self.filename, self._count)
@@ -0,0 +1,53 @@
+#-*- coding: utf-8 -*-
+
+from nose.tools import *
+from dmlt.datastructure import Token, TokenTypeTable, CompactTokenBuffer
+
+
+RAW = u'== foo == bar **baz**'
+TOKENS = [
+    ('headline', u'== foo ==', 'd1', True),
+    ('headline_level', u'=='),
+    ('headline_text', u' foo '),
+    ('text', u' bar ', 'd2', False),
+    ('strong_begin', u'**', 'd1', False),
+    ('text', u'baz', 'd2', False),
+    ('strong', None, None, True),
+    ('strong_end', u'**', 'd1', True),
+]
+
+
+def test_type_table():
+    types = TokenTypeTable()
+    assert_equal(types.intern('foo'), 0)
+    assert_equal(types.intern('bar'), 1)
+    assert_equal(types.intern('foo'), 0)
+    assert_equal(types[1], 'bar')
+    assert_true('bar' in types)
+    assert_equal(len(types), 2)
+
+
+def test_buffer():
+    buffer = CompactTokenBuffer(RAW)
+    buffer.extend(TOKENS)
+    assert_equal(len(buffer), len(TOKENS))
+    assert_equal([t.as_tuple() for t in buffer],
+                 [Token(*t).as_tuple() for t in TOKENS])
+    assert_equal(buffer[-1].type, 'strong_end')
+    assert_equal(buffer.directives, ['d1', 'd2'])
+    assert_equal(len(buffer.types), 7)
+    # all values are stored as offsets into the document
+    assert_equal(buffer._values, [])
+    assert_equal(list(buffer._starts), [0, 0, 2, 9, 14, 16, 0, 19])
+
+
+def test_buffer_copies():
+    buffer = CompactTokenBuffer(u'foo \\*bar**')
+    buffer.append('text', u'foo *bar')
+    buffer.append(1, 42)
+    buffer.extend([Token('strong', u'**')])
+    # the value after some text with escape characters is still found
+    assert_equal(buffer._values, [u'foo *bar', 42])
+    assert_equal(list(buffer._starts), [0, 1, 9])
+    assert_equal([t.as_tuple()[:2] for t in buffer],
+                 [('text', u'foo *bar'), (1, 42), ('strong', u'**')])
@@ -0,0 +1,46 @@
+#-*- coding: utf-8 -*-
+
+from nose.tools import *
+from dmlt.exc import StackEmpty
+from dmlt.datastructure import ContextStack
+
+
+def test_push_pop():
+    stack = ContextStack()
+    assert_true(stack.top is None)
+    stack.push('quote')
+    stack.push('b')
+    assert_equal(stack.top, 'b')
+    assert_equal(len(stack), 2)
+    assert_equal(stack.pop(), 'b')
+    assert_equal(stack.pop(), 'quote')
+    assert_raises(StackEmpty, stack.pop)
+
+
+def test_contains():
+    stack = ContextStack(['quote', 'b', 'quote'])
+    assert_true('quote' in stack)
+    assert_false('i' in stack)
+    assert_equal(stack.count('quote'), 2)
+    stack.pop()
+    assert_true('quote' in stack)
+    stack.pop()
+    stack.pop()
+    assert_false('quote' in stack)
+
+
+def test_remove():
+    stack = ContextStack(['quote', 'b', 'i', 'b'])
+    stack.remove('quote')
+    assert_equal(list(stack), ['b', 'i', 'b'])
+    stack.remove('b')
+    assert_equal(list(stack), ['i', 'b'])
+    assert_equal(stack.top, 'i')
+    stack.push('b')
+    stack.remove('b')
+    assert_equal(list(stack), ['i', 'b'])
+    assert_equal(len(stack), 2)
+    assert_raises(ValueError, stack.remove, 'u')
+    assert_equal(stack.pop(), 'i')
+    assert_equal(stack.pop(), 'b')
+    assert_equal(stack._order, [])
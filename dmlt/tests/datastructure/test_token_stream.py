@@ -45,6 +45,7 @@
 >>> stream.current
 <Token(2, None, None)>
 """
+from itertools import count
 from nose.tools import *
 from dmlt.datastructure import Token, TokenStream, _undefined, TokenStreamIterator
 
@@ -109,3 +110,90 @@ def test_token_stream_iterator():
     assert_equal(iter_._stream.current.type, 'bold')
     iter_.next()
     assert_equal(iter_._stream.current.type, 'italic')
+
+
+def test_lazy_from_tuple_iter():
+    consumed = []
+
+    def generate():
+        for x in count():
+            consumed.append(x)
+            yield (x, None, None, False)
+
+    stream = TokenStream.from_tuple_iter(generate())
+    assert_equal(stream.current.type, 0)
+    assert_equal(stream.look().type, 1)
+    stream.skip(3)
+    assert_equal(stream.current.type, 3)
+    assert_equal(consumed, [0, 1, 2, 3])
+
+
+def test_look_ahead():
+    stream = TokenStream.from_tuple_iter(TEST_STREAM)
+    assert_equal(stream.look(0).type, 'bold')
+    assert_equal(stream.look(3).type, 'papapapa')
+    assert_equal(stream.look(1).type, 'italic')
+    assert_equal(stream.look(20).type, 'eof')
+    assert_equal(stream.peek_types(3), ('bold', 'italic', 'uff'))
+    stream.push(Token('pushed'))
+    assert_equal(stream.peek_types(3), ('bold', 'pushed', 'italic'))
+    stream.next()
+    stream.next()
+    assert_equal(stream.current.type, 'italic')
+    assert_equal([t.type for t in stream][-1], 'mom')
+    assert_true(stream.eof)
+
+
+def test_mark_rewind():
+    stream = TokenStream.from_tuple_iter(TEST_STREAM)
+    mark = stream.mark()
+    stream.skip(2)
+    inner = stream.mark()
+    stream.skip(2)
+    assert_equal(stream.current.type, 'foo')
+    stream.rewind(inner)
+    assert_equal(stream.current.type, 'uff')
+    assert_raises(ValueError, stream.rewind, inner)
+    stream.next()
+    stream.rewind(mark)
+    assert_equal(stream.current.type, 'bold')
+    assert_equal([t.type for t in stream],
+                 [t.type for t in TEST_STREAM])
+    assert_true(stream._history is None)
+
+
+def test_release():
+    stream = TokenStream.from_tuple_iter(TEST_STREAM)
+    mark = stream.mark()
+    stream.skip(3)
+    stream.release(mark)
+    assert_true(stream._history is None)
+    assert_equal(stream.current.type, 'papapapa')
+    assert_raises(ValueError, stream.rewind, mark)
+
+
+def test_nested_marks():
+    stream = TokenStream.from_tuple_iter(TEST_STREAM)
+    outer = stream.mark()
+    inner = stream.mark()
+    assert_not_equal(outer, inner)
+    stream.skip(2)
+    stream.rewind(inner)
+    assert_equal(stream.current.type, 'bold')
+    stream.skip(3)
+    stream.rewind(outer)
+    assert_equal(stream.current.type, 'bold')
+    assert_true(stream._history is None)
+    # releasing an inner marker keeps the outer one
+    outer = stream.mark()
+    inner = stream.mark()
+    stream.next()
+    stream.release(inner)
+    stream.next()
+    stream.rewind(outer)
+    assert_equal(stream.current.type, 'bold')
+    # markers of earlier cycles are rejected
+    assert_raises(ValueError, stream.rewind, outer)
+    stream.mark()
+    assert_raises(ValueError, stream.rewind, outer)
+    assert_raises(ValueError, stream.release, inner)
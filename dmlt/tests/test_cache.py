@@ -0,0 +1,144 @@
+#-*- coding: utf-8 -*-
+import shutil
+import tempfile
+from nose.tools import *
+from dmlt import events
+from dmlt.cache import LRUCache, FileSystemCache, cache_key, \
+    machine_fingerprint
+from dmlt.machine import Directive, rule
+from dmlt.tests.test_machine import TestMachine, StrongDirective, \
+    StarDirective
+
+
+def test_lru_cache():
+    cache = LRUCache(max_size=10)
+    cache.set('a', 'xxxx')
+    cache.set('b', 'yyyy')
+    assert_equal(cache.get('a'), 'xxxx')
+    # `b` is the least recently used entry now
+    cache.set('c', 'zzzz')
+    assert_true(cache.get('b') is None)
+    assert_equal(cache.get('c'), 'zzzz')
+    assert_equal(cache.size, 8)
+    # values larger than the cache are not stored
+    cache.set('d', 'x' * 11)
+    assert_true(cache.get('d') is None)
+    assert_equal(cache.stats(), {'hits': 2, 'misses': 2, 'evictions': 1})
+    cache.clear()
+    assert_equal((len(cache), cache.size, cache.hits), (0, 0, 0))
+
+
+def test_filesystem_cache():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = FileSystemCache(cache_dir, threshold=2)
+        cache.set('a', 'xxxx')
+        assert_equal(cache.get('a'), 'xxxx')
+        assert_true(cache.get('b') is None)
+        cache.set('a', 'yyyy')
+        assert_equal(FileSystemCache(cache_dir).get('a'), 'yyyy')
+        cache.set('b', 'b')
+        cache.set('c', 'c')
+        assert_equal(cache.evictions, 1)
+        assert_equal(cache.stats()['hits'], 1)
+        cache.clear()
+        assert_true(cache.get('c') is None)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_cache_key():
+    machine = TestMachine()
+    key = cache_key(machine, 'render', u'**a**', 'html')
+    assert_equal(cache_key(TestMachine(), 'render', u'**a**', 'html'), key)
+    assert_not_equal(cache_key(machine, 'render', u'**b**', 'html'), key)
+    assert_not_equal(cache_key(machine, 'parse', u'**a**', 'html'), key)
+    assert_not_equal(cache_key(machine, 'render', u'**a**', 'html', True),
+                     key)
+    machine.max_nesting_depth = 3
+    assert_not_equal(cache_key(machine, 'render', u'**a**', 'html'), key)
+
+
+def test_fingerprint_changes():
+    class FirstMachine(TestMachine):
+        directives = [StrongDirective]
+
+    class SecondMachine(TestMachine):
+        directives = [StrongDirective]
+
+    fingerprint = machine_fingerprint(FirstMachine())
+    # the name of the machine class is part of the definition
+    assert_not_equal(machine_fingerprint(SecondMachine()), fingerprint)
+    FirstMachine.directives.append(StarDirective)
+    assert_not_equal(machine_fingerprint(FirstMachine()), fingerprint)
+
+    def make_machine(pattern):
+        class OtherDirective(Directive):
+            rule = rule(pattern, enter='other', one=True)
+
+        class OtherMachine(TestMachine):
+            directives = [OtherDirective]
+        return OtherMachine()
+    assert_equal(machine_fingerprint(make_machine(r'!')),
+                 machine_fingerprint(make_machine(r'!')))
+    assert_not_equal(machine_fingerprint(make_machine(r'!')),
+                     machine_fingerprint(make_machine(r'\?')))
+
+
+def test_fingerprint_callbacks():
+    def make_machine(upper):
+        scope = events.EventManager()
+        if upper:
+            def callback(manager, document, ctx):
+                return document.text.upper()
+        else:
+            def callback(manager, document, ctx):
+                return document.text
+        scope.register('process-doc-tree')(callback)
+
+        class OtherMachine(TestMachine):
+            event_scope = scope
+        return OtherMachine()
+    assert_equal(machine_fingerprint(make_machine(True)),
+                 machine_fingerprint(make_machine(True)))
+    # same name, different code
+    assert_not_equal(machine_fingerprint(make_machine(True)),
+                     machine_fingerprint(make_machine(False)))
+
+
+def test_cached_machine():
+    class CachedMachine(TestMachine):
+        cache = LRUCache()
+    machine = CachedMachine()
+    assert_equal(machine.render(u'a **b**'), u'a <b>b</b>')
+    # a render miss builds the tree without caching it
+    assert_equal(machine.cache.stats(),
+                 {'hits': 0, 'misses': 1, 'evictions': 0})
+    assert_equal(len(machine.cache), 1)
+    assert_equal(machine.render(u'a **b**'), u'a <b>b</b>')
+    assert_equal(machine.cache.hits, 1)
+    tree = machine.parse(u'a **b**')
+    assert_equal(machine.cache.misses, 2)
+    tree = machine.parse(u'a **b**')
+    assert_equal(machine.cache.hits, 2)
+    assert_equal(tree.text, u'a b')
+    # cached trees are not shared
+    assert_false(machine.parse(u'a **b**') is tree)
+    assert_equal(machine.parse(u'a **b**', inline=True)[0].text, u'a ')
+    assert_equal(machine.render(u'a **b**', enable_escaping=True),
+                 u'a <b>b</b>')
+    assert_equal(machine.cache.misses, 3)
+
+
+def test_cached_trees_are_not_pickled():
+    from cPickle import dumps
+    class CachedMachine(TestMachine):
+        cache = LRUCache()
+    machine = CachedMachine()
+    tree = machine.parse(u'a **b**')
+    key = cache_key(machine, 'parse', u'a **b**', None, False)
+    assert_true(machine.cache.get(key).startswith('DMLT'))
+    # entries that are not dumped node-trees are replaced
+    machine.cache.set(key, dumps(tree))
+    assert_equal(machine.parse(u'a **b**'), tree)
+    assert_true(machine.cache.get(key).startswith('DMLT'))
@@ -0,0 +1,77 @@
+#-*- coding: utf-8 -*-
+from nose.tools import *
+from dmlt import events
+from dmlt.exc import EventNotFound
+from dmlt.machine import MarkupMachine, RawDirective
+from dmlt.node import Document
+from dmlt.tests.test_machine import TestMachine
+
+
+scope = events.EventManager()
+processed = []
+
+
+class ScopedDocument(Document):
+    __slots__ = ()
+
+
+@scope.register('define-document-node')
+def _define_document_node(manager):
+    return ScopedDocument
+
+
+@scope.register('process-doc-tree')
+def _count_children(manager, document, ctx):
+    processed.append(len(document.children))
+
+
+class ScopedMachine(TestMachine):
+    event_scope = scope
+
+
+def test_register():
+    manager = events.EventManager()
+    calls = []
+
+    @manager.register('process-stream')
+    def callback(manager, stream, ctx):
+        calls.append(manager)
+
+    # the decorated function can be called without the manager
+    callback(None, None)
+    assert_equal(calls, [manager])
+    assert_equal(callback.__name__, 'callback')
+    assert_equal(list(manager.iter('process-stream')), [callback])
+    assert_raises(EventNotFound, manager.connect, 'foo', callback)
+    version = manager.version
+    assert_equal(manager.remove(callback), 1)
+    assert_true(manager.version > version)
+    assert_equal(list(manager.iter('process-stream')), [])
+
+
+def test_scoped_machine():
+    tree = ScopedMachine().parse(u'a **b**')
+    assert_true(type(tree) is ScopedDocument)
+    assert_equal(processed, [2])
+    # other machines don't use the scope
+    assert_true(type(TestMachine().parse(u'a')) is Document)
+    assert_equal(processed, [2])
+    assert_equal(TestMachine().get_callback_chains()['process-doc-tree'], ())
+
+
+def test_frozen_chains():
+    machine = ScopedMachine()
+    chains = machine.get_callback_chains()
+    assert_true(isinstance(chains['process-doc-tree'], tuple))
+    assert_true(ScopedMachine().get_callback_chains() is chains)
+    assert_equal(chains['define-raw-directive'][0](machine), RawDirective)
+
+    @scope.register('process-stream')
+    def callback(manager, stream, ctx):
+        pass
+    try:
+        new_chains = machine.get_callback_chains()
+        assert_false(new_chains is chains)
+        assert_equal(new_chains['process-stream'][-1:], (callback,))
+    finally:
+        scope.remove(callback)
@@ -0,0 +1,231 @@
+#-*- coding: utf-8 -*-
+from nose.tools import *
+from dmlt import events
+from dmlt.node import Document, Container, Text, HTML, Raw
+from dmlt.filters import NodeFilter, FilterPass, compile_pipeline, \
+     TokenFilter, TokenFilterChain, compile_stream_pipeline
+from dmlt.machine import Context
+from dmlt.datastructure import Token
+from dmlt.tests.test_machine import TestMachine
+
+
+class RecordingFilter(NodeFilter):
+
+    def __init__(self, name, log, node_types=None):
+        self.name = name
+        self.log = log
+        self.node_types = node_types
+
+    def enter(self, node, ctx):
+        self.log.append((self.name, 'enter', node.__class__.__name__))
+
+    def leave(self, node, ctx):
+        self.log.append((self.name, 'leave', node.__class__.__name__))
+
+
+class UpperFilter(NodeFilter):
+    node_types = (Text,)
+
+    def leave(self, node, ctx):
+        return Text(node.text.upper())
+
+
+class SkipRawFilter(NodeFilter):
+    node_types = (Text,)
+
+    def __init__(self):
+        self.seen = []
+
+    def leave(self, node, ctx):
+        self.seen.append(node.text)
+
+
+class PruneRaw(SkipRawFilter):
+    node_types = None
+
+    def enter(self, node, ctx):
+        if node.is_raw:
+            return False
+
+    def leave(self, node, ctx):
+        if node.is_text_node:
+            SkipRawFilter.leave(self, node, ctx)
+
+
+def make_tree():
+    return Document([Text(u'a'), Container([Text(u'b'), HTML(u'<br>')]),
+                     Raw([Text(u'c')])])
+
+
+def test_order():
+    log = []
+    tree = Document([Container([Text(u'a')])])
+    FilterPass([RecordingFilter(1, log), RecordingFilter(2, log)])(tree,
+                                                                   None)
+    assert_equal(log, [
+        (1, 'enter', 'Document'), (2, 'enter', 'Document'),
+        (1, 'enter', 'Container'), (2, 'enter', 'Container'),
+        (1, 'enter', 'Text'), (2, 'enter', 'Text'),
+        (1, 'leave', 'Text'), (2, 'leave', 'Text'),
+        (1, 'leave', 'Container'), (2, 'leave', 'Container'),
+        (1, 'leave', 'Document'), (2, 'leave', 'Document'),
+    ])
+
+
+def test_node_types():
+    log = []
+    # Raw and Document are subclasses of Container
+    FilterPass([RecordingFilter(1, log, (Container,)),
+                RecordingFilter(2, log, (Text, HTML))])(make_tree(), None)
+    assert_equal([x for x in log if x[1] == 'enter'], [
+        (1, 'enter', 'Document'), (2, 'enter', 'Text'),
+        (1, 'enter', 'Container'), (2, 'enter', 'Text'),
+        (2, 'enter', 'HTML'), (1, 'enter', 'Raw'), (2, 'enter', 'Text'),
+    ])
+
+
+def test_replace():
+    tree = make_tree()
+    FilterPass([UpperFilter()])(tree, None)
+    assert_equal(tree.text, u'ABC')
+    assert_equal(tree.children[1].children[1].html, u'<br>')
+
+    class ReplaceDocument(NodeFilter):
+        node_types = (Document,)
+        def leave(self, node, ctx):
+            return Container(node.children)
+    tree = FilterPass([ReplaceDocument(), UpperFilter()])(make_tree(), None)
+    assert_true(type(tree) is Container)
+    assert_equal(tree.text, u'ABC')
+
+
+def test_prune():
+    pruning = PruneRaw()
+    other = SkipRawFilter()
+    FilterPass([pruning, other])(make_tree(), None)
+    assert_equal(pruning.seen, [u'a', u'b'])
+    assert_equal(other.seen, [u'a', u'b', u'c'])
+
+
+def test_compile_pipeline():
+    def legacy(document, ctx):
+        pass
+    a, b, c = UpperFilter(), UpperFilter(), UpperFilter()
+    steps = compile_pipeline((a, b, legacy, c))
+    assert_equal(len(steps), 3)
+    assert_equal(steps[0].filters, (a, b))
+    assert_true(steps[1] is legacy)
+    assert_equal(steps[2].filters, (c,))
+    assert_equal(compile_pipeline(()), ())
+
+
+def test_machine():
+    scope = events.EventManager()
+    calls = []
+
+    @scope.register('process-doc-tree')
+    def legacy(manager, document, ctx):
+        calls.append(document.text)
+
+    upper = UpperFilter()
+    scope.connect('process-doc-tree', upper)
+
+    class FilteredMachine(TestMachine):
+        event_scope = scope
+
+    machine = FilteredMachine()
+    pipeline = machine.get_filter_pipeline()
+    assert_true(pipeline[0] is legacy)
+    assert_equal(pipeline[1].filters, (upper,))
+    assert_true(machine.get_filter_pipeline() is pipeline)
+    assert_equal(machine.render(u'a **b**'), u'A <b>B</b>')
+    assert_equal(calls, [u'a b'])
+    scope.remove(legacy)
+    assert_equal(len(machine.get_filter_pipeline()), 1)
+
+
+def test_single_filter():
+    tree = UpperFilter()(make_tree(), Context(TestMachine(), False))
+    assert_equal(tree.text, u'ABC')
+
+
+class DropStars(TokenFilter):
+
+    def process(self, token, ctx):
+        if token.type == 'star':
+            return ()
+        return (token,)
+
+
+class DoubleText(TokenFilter):
+
+    def filter(self, tokens, ctx):
+        for token in tokens:
+            yield token
+            if token.type == 'raw':
+                yield Token('raw', token.value, token.directive)
+
+
+def get_types(stream):
+    return [x.type for x in stream]
+
+
+def test_token_filters():
+    machine = TestMachine()
+    stream = machine.tokenize(u'a*b')
+    ctx = Context(machine, False)
+    assert_equal(get_types(DropStars()(stream, ctx)), ['raw', 'raw'])
+    chain = TokenFilterChain([DropStars(), DoubleText()])
+    tokens = chain.apply(iter(machine.tokenize(u'a*b')), ctx)
+    assert_equal([x.value for x in tokens], [u'a', u'a', u'b', u'b'])
+
+
+def test_token_filters_lazy():
+    consumed = []
+
+    class Recorder(TokenFilter):
+        def filter(self, tokens, ctx):
+            for token in tokens:
+                consumed.append(token.value)
+                yield token
+
+    scope = events.EventManager()
+    scope.connect('process-stream', Recorder())
+
+    class FilteredMachine(TestMachine):
+        event_scope = scope
+
+    stream = FilteredMachine().tokenize(u'a*b*c')
+    assert_equal(consumed, [u'a'])
+    stream.next()
+    assert_equal(consumed, [u'a', u'*'])
+
+
+def test_compile_stream_pipeline():
+    scope = events.EventManager()
+    calls = []
+
+    @scope.register('process-stream')
+    def legacy(manager, stream, ctx):
+        calls.append(stream.current.value)
+
+    drop = DropStars()
+    double = DoubleText()
+    scope.connect('process-stream', drop)
+    scope.connect('process-stream', double)
+    scope.connect('process-stream', legacy)
+
+    class FilteredMachine(TestMachine):
+        event_scope = scope
+
+    machine = FilteredMachine()
+    steps = machine.get_stream_pipeline()
+    assert_equal(len(steps), 3)
+    assert_true(steps[0] is legacy and steps[2] is legacy)
+    assert_equal(steps[1].filters, (drop, double))
+    assert_true(machine.get_stream_pipeline() is steps)
+    stream = machine.tokenize(u'a*b')
+    assert_equal([x.value for x in stream], [u'a', u'a', u'b', u'b'])
+    assert_equal(calls, [u'a', u'a'])
+    assert_equal(compile_stream_pipeline(()), ())
+    assert_equal(machine.render(u'**a*b**'), u'<b>aabb</b>')
@@ -0,0 +1,332 @@
+#-*- coding: utf-8 -*-
+from StringIO import StringIO
+from threading import Thread
+from nose.tools import *
+from dmlt import node
+from dmlt.exc import MissingContext, FormatNotFound
+from dmlt.utils import parse_child_nodes
+from dmlt.machine import MarkupMachine, Directive, rule, bygroups, \
+    LexerTable, CombinedRules, SingleRule, first_chars
+
+
+class StrongDirective(Directive):
+    rule = rule(r'\*\*', enter='strong', leave='strong')
+
+    def parse(self, stream):
+        stream.expect('strong_begin')
+        children = parse_child_nodes(stream, self, 'strong_end')
+        stream.expect('strong_end')
+        return node.Container([node.HTML(u'<b>')] + children +
+                              [node.HTML(u'</b>')])
+
+
+class HeadlineDirective(Directive):
+    rule = rule(r'(={1,6})(.*?)(\1)', bygroups('headline_level',
+                'headline_text'), enter='headline', one=True)
+
+
+class LinkDirective(Directive):
+    rule = rule(r'\[(\S+)\]', bygroups('link_href'), enter='link',
+                one=True)
+
+
+class StarDirective(Directive):
+    rule = rule(r'\*', enter='star', one=True)
+
+
+class TestMachine(MarkupMachine):
+    directives = [StrongDirective, HeadlineDirective, LinkDirective,
+                  StarDirective]
+
+
+class QuoteDirective(Directive):
+    rules = [rule(r'\[quote\]', enter='quote'),
+             rule(r'\[/quote\]', leave='quote')]
+
+
+class RestrictiveMachine(MarkupMachine):
+    directives = [QuoteDirective, StrongDirective]
+    restrictive_mode = True
+
+
+def _types(machine, raw):
+    return [t.type for t in machine(raw).tokenize()]
+
+
+def test_combined_rules():
+    machine = TestMachine(u'')
+    items = [(d.rule, d) for d in (x(machine) for x in machine.directives)]
+    table = LexerTable(items)
+    # the headline rule uses a backreference so it's not merged
+    assert_equal([type(m) for m in table.matchers],
+                 [SingleRule, SingleRule, CombinedRules])
+    m, r, d = table.match(u'[foo]', 0)
+    assert_true(isinstance(d, LinkDirective))
+    assert_equal(m.groups(), (u'foo',))
+    # the declaration order is the priority
+    m, r, d = table.match(u'**', 0)
+    assert_true(isinstance(d, StrongDirective))
+    m, r, d = table.match(u'*', 0)
+    assert_true(isinstance(d, StarDirective))
+    assert_true(table.match(u'foo', 0) is None)
+
+
+def test_combined_tokenize():
+    raw = u'foo **bar** == head ==*[link] baz'
+    TestMachine.combine_rules = False
+    try:
+        expected = _types(TestMachine, raw)
+    finally:
+        del TestMachine.combine_rules
+    assert_equal(_types(TestMachine, raw), expected)
+    assert_equal(expected, ['raw', 'strong_begin', 'raw', 'strong_end',
+                            'raw', 'headline', 'headline_level',
+                            'headline_text', 'star', 'link', 'link_href',
+                            'raw'])
+
+
+def test_first_chars():
+    assert_equal(first_chars(rule(r'\*\*').regex),
+                 (frozenset(u'*'), frozenset()))
+    assert_equal(first_chars(rule(r'(?:a|b?)c').regex),
+                 (frozenset(u'abc'), frozenset()))
+    assert_equal(first_chars(rule(r'^[-\w]+@(?m)').regex),
+                 (frozenset(u'-'), frozenset([r'\w'])))
+    assert_equal(first_chars(rule(r'(?i)k').regex),
+                 (frozenset(u'kK\u212a'), frozenset()))
+    # unknown first characters or patterns that match the empty string
+    assert_true(first_chars(rule(r'.a').regex) is None)
+    assert_true(first_chars(rule(r'[^a]').regex) is None)
+    assert_true(first_chars(rule(r'a*').regex) is None)
+
+
+def test_skip_text():
+    machine = TestMachine(u'')
+    items = [(d.rule, d) for d in (x(machine) for x in machine.directives)]
+    scan = LexerTable(items).scanner()
+    assert_equal(scan(u'foo bar *baz', 0).start(), 8)
+    assert_true(scan(u'foo bar baz', 0) is None)
+    assert_equal(LexerTable(items).scanner(u'\\')(u'a\\*', 0).start(), 1)
+    stream = TestMachine(u'foo bar baz ** [x]').tokenize()
+    assert_equal(stream.current.value, u'foo bar baz ')
+
+
+def test_skip_text_escaped():
+    raw = u'foo \\**bar\\\\ \\baz\\'
+    tokens = [t.as_tuple()[:2] for t in
+              TestMachine(raw).tokenize(enable_escaping=True)]
+    assert_equal(tokens, [('raw', u'foo **bar\\ \\baz\\')])
+
+
+def test_first_char_index():
+    machine = TestMachine(u'')
+    items = [(d.rule, d) for d in (x(machine) for x in machine.directives)]
+    items.append((rule(r'\w+@', enter='mail', one=True), None))
+    table = LexerTable(items)
+    assert_equal(sorted(table.index), [u'*', u'=', u'['])
+    assert_equal([r.enter for r, d in table.unknown], ['mail'])
+    assert_equal([r.enter for m in table.index[u'*'] for r, d in m.items],
+                 ['strong', 'star'])
+    assert_equal([r.enter for m in table.default for r, d in m.items],
+                 ['mail'])
+    assert_equal(table.match(u'foo@', 0)[1].enter, 'mail')
+    assert_true(table.match(u'!', 0) is None)
+
+
+def test_debug_rules():
+    stream = StringIO()
+    TestMachine(u'').debug_rules(stream)
+    lines = stream.getvalue().splitlines()
+    assert_equal(lines[0], "u'*': <rule(None, strong -> strong)>, "
+                           "<rule(None, star -> None)>")
+    assert_equal(lines[-1], 'unknown first char: ')
+
+
+def test_lexer_table_cache():
+    class CachedMachine(TestMachine):
+        directives = [StrongDirective, StarDirective]
+    machine = CachedMachine(u'**')
+    table = machine.get_lexer_table()
+    assert_true(CachedMachine(u'').get_lexer_table() is table)
+    # subclasses don't share the table of their parent class
+    assert_false(TestMachine(u'').get_lexer_table() is table)
+    assert_equal([idx for r, idx in table.items], [0, 1])
+    directives = machine.get_directives()
+    machine.tokenize()
+    assert_true(machine.get_directives() is directives)
+    assert_false(machine.get_directives(True) is directives)
+    # changing the directives invalidates both caches
+    CachedMachine.directives.append(LinkDirective)
+    assert_false(machine.get_lexer_table() is table)
+    assert_equal(len(machine.get_directives()), 3)
+    assert_equal([t.type for t in machine.tokenize(u'*[x]')],
+                 ['star', 'link', 'link_href'])
+
+
+def test_unbound_machine():
+    machine = TestMachine()
+    assert_raises(TypeError, machine.tokenize)
+    assert_equal(machine.render(u'a **b**'), u'a <b>b</b>')
+    assert_equal(machine.render(u'**c** d'), u'<b>c</b> d')
+    assert_equal(machine.parse(u'e').text, u'e')
+    assert_equal(machine.parse(u'').children, [])
+    # the old interface still works
+    assert_equal(TestMachine(u'**f**').render(), u'<b>f</b>')
+
+
+def test_shared_machine():
+    machine = TestMachine()
+    results = []
+
+    def worker(num):
+        for x in xrange(50):
+            raw = u'%d **%d** %d' % (num, x, num)
+            results.append(machine.render(raw) ==
+                           u'%d <b>%d</b> %d' % (num, x, num))
+
+    threads = [Thread(target=worker, args=(x,)) for x in xrange(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equal(results, [True] * 200)
+
+
+def test_max_nesting_depth():
+    raw = u'[quote]' * 5 + u'**x**' + u'[/quote]' * 5
+    machine = RestrictiveMachine()
+    machine.max_nesting_depth = 3
+    tokens = [t.as_tuple()[:2] for t in machine.tokenize(raw)]
+    assert_equal(tokens, [('quote_begin', u'[quote]')] * 3 + [
+        ('raw', u'[quote][quote]**x**[/quote][/quote]')] +
+        [('quote_end', u'[/quote]')] * 3)
+    # overflowed contexts are forgotten when the outer context closes
+    machine.max_nesting_depth = 1
+    tokens = [t.as_tuple()[:2] for t in
+              machine.tokenize(u'[quote]**x[/quote]**y**')]
+    assert_equal(tokens, [('quote_begin', u'[quote]'), ('raw', u'**x'),
+                          ('quote_end', u'[/quote]'),
+                          ('strong_begin', u'**'), ('raw', u'y'),
+                          ('strong_end', u'**')])
+    # the limit is only reached for the nested contexts
+    assert_equal(_types(RestrictiveMachine, raw)[5:7],
+                 ['strong_begin', 'raw'])
+    # deep nesting doesn't take quadratic time
+    raw = u'[quote]' * 5000 + u'**' + u'[/quote]' * 5000
+    machine.max_nesting_depth = None
+    assert_equal(len(list(machine.tokenize(raw))), 10002)
+    # there is no limit by default
+    assert_true(RestrictiveMachine.max_nesting_depth is None)
+    assert_equal(len(list(RestrictiveMachine().tokenize(raw))), 10002)
+
+
+def test_lazy_tokenize():
+    stream = TestMachine().tokenize(u'**foo** [/quote]')
+    assert_equal(stream.expect('strong_begin').value, u'**')
+    stream = RestrictiveMachine().tokenize(u'**foo** [/quote]')
+    stream.skip(3)
+    # the lexer runs no further than the stream is consumed
+    assert_raises(MissingContext, stream.next)
+
+
+def test_compact_tokenize():
+    raw = u'foo **bar** == head ==*[link] baz'
+    machine = TestMachine()
+    expected = [t.as_tuple() for t in machine.tokenize(raw)]
+    assert_equal([t.as_tuple() for t in machine.tokenize(raw, compact=True)],
+                 expected)
+    buffer = machine.compact_tokens(raw)
+    assert_equal(buffer._values, [])
+    assert_true(buffer.types is machine.token_types)
+
+
+def test_rule_names():
+    r = rule(r'\*\*', enter='strong', leave='strong')
+    assert_equal((r.begin, r.end, r.standalone),
+                 ('strong_begin', 'strong_end', 'strong_begin'))
+    assert_true(r.begin is intern('strong' + '_begin'))
+    r = rule(r'\[(\S+)\]', enter='link', one=True)
+    assert_equal((r.begin, r.end, r.standalone), ('link_begin', None, 'link'))
+
+    class OtherMachine(MarkupMachine):
+        directives = [QuoteDirective]
+        _begin = '_open'
+        _end = '_close'
+    assert_equal(_types(OtherMachine, u'[quote][/quote]'),
+                 ['quote_open', 'quote_close'])
+    # the rules of other machines are not touched
+    assert_equal(QuoteDirective.rules[0].begin, 'quote_begin')
+    stream = RestrictiveMachine().tokenize(u'[quote][/quote]')
+    assert_true(stream.current.type is QuoteDirective.rules[0].begin)
+
+
+def test_render_to():
+    stream = StringIO()
+    TestMachine().render_to(stream, u'a **b**')
+    assert_equal(stream.getvalue(), u'a <b>b</b>')
+    result = []
+    machine = TestMachine()
+    machine.render_to(result, machine.parse(u'**c**'))
+    assert_equal(result, [u'<b>', u'c', u'</b>'])
+
+
+def test_compile():
+    machine = TestMachine()
+    program = machine.compile(u'a **b**')
+    assert_equal(program.render(), machine.render(u'a **b**'))
+    assert_equal(program.instructions, [u'a <b>b</b>'])
+
+
+def test_output_formats():
+    assert_equal(TestMachine().render(u'a **b**', format='text'), u'a b')
+
+    class BrokenMachine(TestMachine):
+        output_formats = ('html', 'rtf')
+    assert_raises(FormatNotFound, BrokenMachine)
+
+    class HTMLMachine(TestMachine):
+        output_formats = ('html',)
+
+    # the format is checked before the document is processed
+    machine = HTMLMachine()
+    assert_raises(FormatNotFound, machine.render, None, 'text')
+    assert_raises(FormatNotFound, machine.compile, u'**', 'text')
+
+
+def test_instance_suffixes():
+    machine = TestMachine()
+    machine._begin = '_start'
+    assert_equal([t.type for t in machine.tokenize(u'**a**')],
+                 ['strong_start', 'raw', 'strong_end'])
+    # other instances still use the suffixes of the class
+    assert_equal([t.type for t in TestMachine().tokenize(u'**a**')],
+                 ['strong_begin', 'raw', 'strong_end'])
+
+
+def test_directive_context():
+    from dmlt import events
+    contexts = []
+
+    class CountingDirective(StrongDirective):
+        def parse(self, stream):
+            self.ctx['strong'] = self.ctx.get('strong', 0) + 1
+            contexts.append(self.ctx)
+            return StrongDirective.parse(self, stream)
+
+    scope = events.EventManager()
+    counts = []
+    scope.connect('process-doc-tree',
+                  lambda document, ctx: counts.append(ctx.get('strong')))
+
+    class CountingMachine(MarkupMachine):
+        directives = [CountingDirective]
+        event_scope = scope
+
+    machine = CountingMachine()
+    machine.parse(u'**a** **b**')
+    machine.parse(u'**c**')
+    # every document has a context of its own shared with the filters
+    assert_equal(counts, [2, 1])
+    assert_true(contexts[0] is contexts[1])
+    assert_true(contexts[1] is not contexts[2])
+    assert_true(machine.get_directives()[0].ctx is None)
@@ -0,0 +1,277 @@
+#-*- coding: utf-8 -*-
+from StringIO import StringIO
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from copy import copy
+from nose.tools import *
+from dmlt.exc import FormatNotFound
+from dmlt.node import Node, Container, Document, Text, HTML, \
+    iter_fragments, render_to, compile_tree, RenderProgram, FORMATS, \
+    register_format, check_format, get_text, NodeList, DeferredNode
+
+
+class Bold(Container):
+
+    def prepare_html(self):
+        yield u'<b>'
+        for item in self.children:
+            yield item
+        yield u'</b>'
+
+    def prepare_markdown(self):
+        yield u'**'
+        for item in self.children:
+            yield item
+        yield u'**'
+
+
+class Markdown(Text):
+
+    def prepare_markdown(self):
+        yield self.text.replace(u'*', u'\\*')
+
+
+class Counter(Node):
+    is_dynamic = True
+    count = 0
+
+    def prepare_html(self):
+        Counter.count += 1
+        yield unicode(Counter.count)
+
+
+def _tree():
+    return Document([Text(u'a < b'), Bold([Text(u'c'), HTML(u'<br />')]),
+                     Container([Bold([])])])
+
+
+def test_iter_fragments():
+    assert_equal(list(iter_fragments(_tree())),
+                 [u'a &lt; b', u'<b>', u'c', u'<br />', u'</b>',
+                  u'<b>', u'</b>'])
+    assert_equal(u''.join(_tree().prepare()),
+                 u'a &lt; b<b>c<br /></b><b></b>')
+
+
+def test_container_prepare_html():
+    # the default implementation yields the rendered children
+    tree = Container([Text(u'a'), Bold([Text(u'b')]), Container([HTML(u'c')])])
+    assert_equal(list(Container.prepare_html(tree)),
+                 [u'a', u'<b>', u'b', u'</b>', u'c'])
+    assert_equal(list(tree.prepare_html()), list(iter_fragments(tree)))
+
+
+def test_render_to():
+    result = []
+    render_to(_tree(), result)
+    assert_equal(u''.join(result), u'a &lt; b<b>c<br /></b><b></b>')
+    stream = StringIO()
+    _tree().render_to(stream)
+    assert_equal(stream.getvalue(), u'a &lt; b<b>c<br /></b><b></b>')
+
+
+def test_render_deep_tree():
+    tree = Text(u'x')
+    for x in xrange(5000):
+        tree = Bold([tree])
+    result = []
+    render_to(tree, result)
+    assert_equal(len(result), 10001)
+    assert_equal(u''.join(tree.prepare()),
+                 u'<b>' * 5000 + u'x' + u'</b>' * 5000)
+
+
+def test_compile_tree():
+    program = compile_tree(_tree())
+    assert_true(program.is_static)
+    assert_equal(program.instructions, [u'a &lt; b<b>c<br /></b><b></b>'])
+    assert_equal(program.render(), u'a &lt; b<b>c<br /></b><b></b>')
+    assert_equal(compile_tree(Document()).render(), u'')
+
+
+def test_compile_dynamic_tree():
+    counter = Counter()
+    tree = Document([Text(u'a'), Bold([Text(u'b'), counter]), Text(u'c')])
+    program = compile_tree(tree)
+    assert_false(program.is_static)
+    assert_equal(program.instructions, [u'a<b>b', counter, u'</b>c'])
+    assert_equal(program.dynamic_nodes, [counter])
+    Counter.count = 0
+    assert_equal(program.render(), u'a<b>b1</b>c')
+    result = []
+    program.render_to(result)
+    assert_equal(u''.join(result), u'a<b>b2</b>c')
+    assert_equal(compile_tree(counter).instructions, [counter])
+
+
+def test_dump_program():
+    program = compile_tree(_tree())
+    assert_equal(program.dump(), '!html\0a &lt; b<b>c<br /></b><b></b>')
+    assert_equal(RenderProgram.load(program.dump()), program)
+    program = compile_tree(Document([Text(u'a'), Counter()]))
+    loaded = RenderProgram.load(program.dump())
+    assert_equal(loaded.instructions[0], u'a')
+    assert_true(isinstance(loaded.instructions[1], Counter))
+    # dumping doesn't change the parents of the dynamic nodes
+    box = DynamicBox([Text(u'x')])
+    tree = Document([box])
+    program = compile_tree(tree)
+    assert_equal(program.dynamic_nodes, [box])
+    program.dump()
+    assert_true(box._parent is tree)
+
+
+class DynamicBox(Container):
+    __slots__ = ()
+    is_dynamic = True
+
+
+def test_format_table():
+    assert_equal(sorted(Text.format_table), ['html', 'text'])
+    assert_equal(sorted(Bold.format_table), ['html', 'markdown', 'text'])
+    assert_true(Bold.format_table['text'] is Container.prepare_text.im_func)
+    assert_true('markdown' in FORMATS)
+    check_format('markdown')
+    assert_raises(FormatNotFound, check_format, 'rtf')
+    register_format('rtf')
+    check_format('rtf')
+    FORMATS.discard('rtf')
+
+
+def test_render_formats():
+    tree = Document([Bold([Markdown(u'a*b')]), HTML(u'<i>c</i>')])
+    assert_equal(u''.join(tree.prepare('text')), u'a*bc')
+    assert_raises(FormatNotFound, lambda: u''.join(tree.prepare('markdown')))
+    tree = Bold([Markdown(u'a*b')])
+    assert_equal(u''.join(tree.prepare('markdown')), u'**a\\*b**')
+
+
+def test_cached_text():
+    inner = Bold([Text(u'b')])
+    middle = Container([Text(u'a'), inner])
+    tree = Document([middle, HTML(u'<i>c</i>')])
+    assert_equal(tree.text, u'abc')
+    assert_equal(inner._text, None)
+    assert_equal(middle.text, u'ab')
+    # changing a child invalidates all parents
+    inner.children.append(Text(u'x'))
+    assert_equal((middle._text, tree._text), (None, None))
+    assert_equal(tree.text, u'abxc')
+    inner.children[1:] = [Text(u'y'), Text(u'z')]
+    assert_equal(tree.text, u'abyzc')
+    del middle.children[0]
+    assert_equal(tree.text, u'byzc')
+    inner.children = [Text(u'q')]
+    assert_equal(tree.text, u'qc')
+    assert_true(isinstance(inner.children, NodeList))
+    # new children are linked to their parent
+    other = Container([])
+    inner.children.insert(0, other)
+    assert_equal(tree.text, u'qc')
+    other.children.append(Text(u'!'))
+    assert_equal(tree.text, u'!qc')
+
+
+def test_cached_html_text():
+    node = HTML(u'<b>a</b>')
+    assert_equal(node.text, u'a')
+    node.html = u'<i>b</i>'
+    assert_equal(node.text, u'b')
+
+
+def test_get_text():
+    class Upper(Container):
+        @property
+        def text(self):
+            return Container.text.__get__(self).upper()
+    tree = Document([Text(u'a'), Upper([Text(u'b'), Bold([Text(u'c')])]),
+                     Container([Container([Text(u'd')])])])
+    assert_equal(get_text(tree), u'aBCd')
+    assert_equal(get_text(tree), tree.text)
+
+
+def test_text_independent_of_format():
+    class Hidden(Container):
+        def prepare_text(self):
+            return iter(())
+    tree = Document([Text(u'a'), Hidden([Text(u'b')])])
+    assert_equal(tree.text, u'ab')
+    # nodes outside of containers are changed in place
+    class Plain(Node):
+        def __init__(self, value):
+            self.value = value
+    for parent in (None, Plain([])):
+        deferred = DeferredNode(Text(u'x'))
+        if parent is not None:
+            parent.value.append(deferred)
+        deferred.replace_by(Plain(u'y'))
+        assert_true(type(deferred) is Plain)
+        assert_equal(deferred.value, u'y')
+    assert_equal(u''.join(tree.prepare('text')), u'a')
+    # changed leaves are picked up if they are assigned again
+    leaf = tree.children[1].children[0]
+    leaf.text = u'c'
+    assert_equal(tree.text, u'ab')
+    tree.children[1].children[0] = leaf
+    assert_equal(tree.text, u'ac')
+
+
+def test_copy_keeps_parents():
+    inner = Container([Text(u'x')])
+    tree = Document([inner])
+    assert_equal(tree.text, u'x')
+    copied = copy(tree)
+    assert_true(copied.children[0] is inner)
+    assert_true(inner._parent is tree)
+    inner.children.append(Text(u'y'))
+    assert_equal(tree.text, u'xy')
+    copied.children.append(Text(u'z'))
+    assert_equal(copied.text, u'xyz')
+    assert_equal(tree.text, u'xy')
+
+
+def test_transient_state():
+    tree = Document([Bold([Text(u'a')])])
+    other = Document([Bold([Text(u'a')])])
+    tree.text
+    assert_equal(tree, other)
+    assert_equal(repr(tree), repr(other))
+    assert_false('_parent' in repr(tree))
+    loaded = loads(dumps(tree.children[0], HIGHEST_PROTOCOL))
+    assert_equal(loaded, other.children[0])
+    assert_true(loaded._parent is None)
+    assert_true(isinstance(loaded.children, NodeList))
+    assert_true(loaded.children.owner is loaded)
+
+
+def test_slots():
+    for node in (Text(u'a'), HTML(u'b'), Container(), Document()):
+        assert_false(hasattr(node, '__dict__'))
+    assert_equal(Container.state_slots, ('_children',))
+    assert_equal(Text.state_slots, ('text',))
+    assert_equal(HTML(u'<b>a</b>').__getstate__(), {'html': u'<b>a</b>'})
+    assert_equal(Bold([Text(u'a')]).__getstate__(),
+                 {'children': [Text(u'a')]})
+    assert_equal(repr(Text(u'a')), "node.Text(text=u'a')")
+    assert_not_equal(Text(u'a'), Text(u'b'))
+    assert_not_equal(Text(u'a'), HTML(u'a'))
+
+
+def test_pickle_slots():
+    tree = Document([Bold([Text(u'a'), HTML(u'<br />')]), Text(u'b')])
+    tree.text
+    for protocol in (0, HIGHEST_PROTOCOL):
+        loaded = loads(dumps(tree, protocol))
+        assert_equal(loaded, tree)
+        assert_equal(loaded.text, u'ab')
+        assert_true(loaded.children[0]._parent is loaded)
+
+
+def test_replace_by():
+    deferred = DeferredNode(Text(u'x'))
+    assert_raises(ValueError, deferred.replace_by, Text(u'y'))
+    tree = Document([Text(u'a'), Bold([deferred])])
+    assert_equal(tree.text, u'a')
+    deferred.replace_by(Text(u'b'))
+    assert_equal(tree.children[1].children, [Text(u'b')])
+    assert_equal(deferred.node, Text(u'b'))
+    assert_equal(tree.text, u'ab')
@@ -0,0 +1,154 @@
+#-*- coding: utf-8 -*-
+import sys
+from nose.tools import *
+from dmlt.node import Document, Container, Text, HTML, Raw
+from dmlt.query import Query, NodeIndex, iter_tree, iter_tree_post, \
+     iter_tree_events
+from dmlt.filters import NodeFilter, FilterPass
+
+
+class Strong(Container):
+    __slots__ = ()
+
+
+def make_tree():
+    return Document([
+        Text(u'a'),
+        Strong([Text(u'b'), HTML(u'<br>'), Container([Text(u'c')])]),
+        Raw([Text(u'd')]),
+        Text(u'e'),
+    ])
+
+
+def walk_by_type(node, type):
+    # the unindexed query
+    return list(Query(iter((node,))).by_type(type))
+
+
+def test_by_type():
+    tree = make_tree()
+    for type in (Text, HTML, Container, Strong, Raw, Document,
+                 (Strong, Text), object):
+        assert_equal(list(tree.query.by_type(type)),
+                     walk_by_type(tree, type))
+    assert_equal([x.text for x in tree.query.by_type(Text)],
+                 [u'a', u'b', u'c', u'd', u'e'])
+    assert_equal(list(tree.query.by_type(Strong)), [tree.children[1]])
+    assert_equal(len(list(tree.query.by_type(Container))), 4)
+    assert_equal(list(tree.query.by_type(Document)), [tree])
+    assert_equal(len(tree.get_index()), 10)
+
+
+def test_subtree():
+    tree = make_tree()
+    strong = tree.children[1]
+    assert_equal([x.text for x in strong.query.by_type(Text)],
+                 [u'b', u'c'])
+    assert_equal(list(strong.query.by_type(Container)),
+                 [strong, strong.children[2]])
+    assert_equal([x.text for x in tree.children[2].query.text_nodes()],
+                 [u'd'])
+    # leaf nodes are not indexed
+    assert_false(tree.children[0] in tree.get_index())
+    assert_equal(list(tree.children[0].query.by_type(Text)),
+                 [tree.children[0]])
+
+
+def test_text_nodes():
+    tree = make_tree()
+    assert_equal([x.text for x in tree.query.text_nodes()],
+                 [u'a', u'b', u'c', u'd', u'e'])
+
+
+def test_invalidation():
+    tree = make_tree()
+    index = tree.get_index()
+    assert_true(tree.get_index() is index)
+    inner = tree.children[1].children[2]
+    inner.children.append(Text(u'f'))
+    assert_true(tree.get_index() is not index)
+    assert_equal([x.text for x in tree.query.text_nodes()],
+                 [u'a', u'b', u'c', u'f', u'd', u'e'])
+    tree.children[1].children = [Strong()]
+    assert_equal(len(list(tree.query.by_type(Strong))), 2)
+
+
+def test_unindexed():
+    # started queries and trees without a document don't use an index
+    tree = make_tree()
+    query = tree.query
+    assert_true(query._get_index() is not None)
+    assert_true(query.has_any)
+    assert_true(query._get_index() is None)
+    container = Container([Text(u'x'), Container([Text(u'y')])])
+    assert_true(container.query._get_index() is None)
+    assert_equal([x.text for x in container.query.text_nodes()],
+                 [u'x', u'y'])
+
+
+def test_index_merge():
+    index = NodeIndex(make_tree())
+    assert_equal([x.__class__.__name__ for x in index.by_type(Container)],
+                 ['Document', 'Strong', 'Container', 'Raw'])
+    assert_equal(index.by_type(Strong, index.root.children[2]), [])
+    assert_true(index.by_type(Container) is index.by_type(Container))
+
+
+def names(nodes):
+    return [getattr(x, 'text', None) if x.is_text_node else
+            x.__class__.__name__ for x in nodes]
+
+
+def test_iter_tree():
+    tree = make_tree()
+    assert_equal(names(iter_tree(tree)),
+                 ['Document', u'a', 'Strong', u'b', 'HTML', 'Container',
+                  u'c', 'Raw', u'd', u'e'])
+    assert_equal(names(iter_tree(tree, lambda x: x.is_raw)),
+                 ['Document', u'a', 'Strong', u'b', 'HTML', 'Container',
+                  u'c', 'Raw', u'e'])
+    assert_equal(names(iter_tree(Text(u'x'))), [u'x'])
+
+
+def test_iter_tree_post():
+    tree = make_tree()
+    assert_equal(names(iter_tree_post(tree)),
+                 [u'a', u'b', 'HTML', u'c', 'Container', 'Strong', u'd',
+                  'Raw', u'e', 'Document'])
+    assert_equal(names(iter_tree_post(tree, lambda x: x.is_raw)),
+                 [u'a', u'b', 'HTML', u'c', 'Container', 'Strong',
+                  'Raw', u'e', 'Document'])
+
+
+def test_iter_tree_events():
+    tree = Document([Text(u'a'), Raw([Text(u'b')])])
+    events = [(names([x[0]])[0], x[1] is not None and
+               x[1].__class__.__name__, x[2], x[3])
+              for x in iter_tree_events(tree, lambda x: x.is_raw)]
+    assert_equal(events, [
+        ('Document', False, 0, False),
+        (u'a', 'Document', 0, False),
+        (u'a', 'Document', 0, True),
+        ('Raw', 'Document', 1, False),
+        ('Raw', 'Document', 1, True),
+        ('Document', False, 0, True),
+    ])
+
+
+def test_deep_tree():
+    depth = sys.getrecursionlimit() * 2
+    tree = leaf = Container([Text(u'x')])
+    for x in xrange(depth):
+        tree = Container([tree])
+    document = Document([tree])
+    assert_equal(len(list(tree.query.all)), depth + 2)
+    assert_equal(list(tree.query.text_nodes()), [leaf.children[0]])
+    assert_equal(len(list(document.query.by_type(Container))), depth + 2)
+    assert_equal(len(list(iter_tree_post(document))), depth + 3)
+
+    class Upper(NodeFilter):
+        node_types = (Text,)
+        def leave(self, node, ctx):
+            return Text(node.text.upper())
+    FilterPass([Upper()])(document, None)
+    assert_equal(list(document.query.text_nodes())[0].text, u'X')
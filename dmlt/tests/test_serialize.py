@@ -0,0 +1,114 @@
+#-*- coding: utf-8 -*-
+import sys
+from cPickle import dumps, HIGHEST_PROTOCOL
+from nose.tools import *
+from dmlt.exc import SerializationError
+from dmlt.node import Container, Document, Text, HTML
+from dmlt.serialize import dump_nodes, load_nodes, FORMAT_VERSION
+from dmlt.utils import dump_tree, load_tree
+
+
+class Link(Container):
+
+    def __init__(self, href, children=None, title=None):
+        Container.__init__(self, children)
+        self.href = href
+        self.title = title
+
+
+def _tree():
+    return Document([Text(u'a \xfc'), Link('http://x.y', [Text(u'b')]),
+                     HTML(u'<br />'), Link(u'#', [], title=u'x')])
+
+
+def test_round_trip():
+    tree = _tree()
+    data = dump_nodes(tree, 'html')
+    assert_equal(load_nodes(data), ('html', tree))
+    values = [None, True, False, 0, -1, 2 ** 70, -300, 1.5, u'☃', 'x',
+              (1, [2]), {u'a': [Text(u'b')], 2: None}, 2 ** 32, u'',
+              Text(None)]
+    assert_equal(load_nodes(dump_nodes(values)), ('', values))
+    # strings that contain null characters
+    values = [u'a\0b', u'', Text(u'\0'), u'☃']
+    assert_equal(load_nodes(dump_nodes(values)), ('', values))
+
+
+def test_deep_tree():
+    tree = Text(u'x')
+    for x in xrange(5000):
+        tree = Container([tree])
+    format, loaded = load_nodes(dump_nodes(tree))
+    for x in xrange(5000):
+        loaded = loaded.children[0]
+    assert_equal(loaded, Text(u'x'))
+
+
+def test_type_table():
+    data = dump_nodes(Document([Text(u'a'), Text(u'b'), Text(u'c')]))
+    assert_equal(data.count('Text'), 1)
+    loaded = load_nodes(data, lambda module, name: {
+        'Document': Container, 'Text': Text}[name])[1]
+    assert_true(loaded.__class__ is Container)
+
+
+def test_invalid_dumps():
+    data = dump_nodes(_tree(), 'html')
+    assert_raises(SerializationError, load_nodes,
+                  data[:4] + chr(FORMAT_VERSION + 1) + data[5:])
+    assert_raises(SerializationError, load_nodes, 'PICKLE')
+    assert_raises(SerializationError, load_nodes, data[:-3])
+    assert_raises(SerializationError, load_nodes,
+                  data.replace('Document', 'Documenx'))
+    assert_raises(SerializationError, dump_nodes, [object()])
+    for x in xrange(len(data)):
+        assert_raises(SerializationError, load_nodes, data[:x])
+    # invalid attribute names
+    assert_raises(SerializationError, load_nodes,
+                  data.replace('href', 'h-ef'))
+    assert_raises(SerializationError, load_nodes,
+                  data.replace('title', '_text'))
+
+
+def _replace_type(data, module, name):
+    return data.replace('\x09dmlt.node\x04Text',
+                        chr(len(module)) + module + chr(len(name)) + name)
+
+
+class BrokenNode(Container):
+
+    def __setstate__(self, state):
+        raise RuntimeError('broken')
+
+
+def test_node_types():
+    data = dump_nodes(Text(u'a'))
+    # only node classes are loaded and modules are never imported
+    for module, name in [('subprocess', 'Popen'), ('dmlt.node', 'NodeList'),
+                         ('dmlt.tests.not_imported', 'Text')]:
+        assert_raises(SerializationError, load_nodes,
+                      _replace_type(data, module, name))
+    assert_false('dmlt.tests.not_imported' in sys.modules)
+    for cls in (dict, object, None, Text(u'a')):
+        assert_raises(SerializationError, load_nodes, data,
+                      lambda module, name: cls)
+    def resolve(module, name):
+        raise KeyError(name)
+    assert_raises(SerializationError, load_nodes, data, resolve)
+    # errors of __setstate__ and __new__
+    assert_raises(SerializationError, load_nodes,
+                  dump_nodes(BrokenNode([Text(u'a')])))
+    assert_raises(SerializationError, load_nodes, data,
+                  lambda module, name: Container)
+
+
+def test_dump_tree():
+    tree = Container([u'a', u'b', Text(u'c'), u'd'])
+    data = dump_tree(tree, 'html')
+    assert_equal(data[0], '#')
+    assert_equal(load_tree(data), ([u'ab', Text(u'c'), u'd'], None, 'html'))
+    assert_equal(load_tree(dump_tree(Container([u'a', u'b']), 'html')),
+                 ([u'ab'], None, 'html'))
+    # dumps of older versions are still loaded
+    data = '@' + dumps(('html', [Text(u'c')]), HIGHEST_PROTOCOL)
+    assert_equal(load_tree(data), ([Text(u'c')], None, 'html'))
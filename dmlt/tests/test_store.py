@@ -0,0 +1,97 @@
+#-*- coding: utf-8 -*-
+import os
+import tempfile
+from StringIO import StringIO
+from nose.tools import *
+from dmlt.exc import SerializationError
+from dmlt.node import Container, Text
+from dmlt.store import DocumentStore, write_store
+from dmlt.utils import dump_tree
+
+
+def _make_store(items):
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    write_store(filename, items)
+    return filename
+
+
+def test_store():
+    static = dump_tree(Container([u'<b>\xfc</b>']), 'html')
+    dynamic = dump_tree(Container([u'a', Text(u'b')]), 'html')
+    filename = _make_store([(u'zeta', static), (u'\xe4lpha', dynamic),
+                            ('beta', static)])
+    try:
+        store = DocumentStore(filename)
+        assert_equal(len(store), 3)
+        assert_equal(store.keys(),
+                     ['beta', 'zeta', u'\xe4lpha'.encode('utf-8')])
+        assert_true(u'\xe4lpha' in store)
+        assert_false('gamma' in store)
+        assert_raises(KeyError, store.get_raw, 'gamma')
+        assert_equal(str(store['zeta']), static)
+        # static documents are not decoded
+        data = store.get_static('zeta')
+        assert_true(isinstance(data, buffer))
+        assert_equal(str(data), u'<b>\xfc</b>'.encode('utf-8'))
+        assert_true(store.get_static(u'\xe4lpha') is None)
+        assert_equal(store.get_format('beta'), 'html')
+        assert_equal(store.get_format(u'\xe4lpha'), 'html')
+        assert_equal(store.load('beta'), ([u'<b>\xfc</b>'], None, 'html'))
+        assert_equal(store.load(u'\xe4lpha'),
+                     ([u'a', Text(u'b')], None, 'html'))
+        sink = StringIO()
+        assert_true(store.write_to('zeta', sink))
+        assert_false(store.write_to(u'\xe4lpha', sink))
+        assert_equal(sink.getvalue(), u'<b>\xfc</b>'.encode('utf-8'))
+        store.close()
+    finally:
+        os.remove(filename)
+
+
+def test_empty_store():
+    filename = _make_store([])
+    try:
+        store = DocumentStore(filename)
+        assert_equal(len(store), 0)
+        assert_false('a' in store)
+        store.close()
+    finally:
+        os.remove(filename)
+
+
+def test_invalid_store():
+    filename = _make_store([('a', '!html\0')])
+    try:
+        assert_raises(ValueError, write_store, filename,
+                      [('a', '!html\0'), ('a', '!html\0')])
+        # the old store is kept
+        store = DocumentStore(filename)
+        assert_equal(store.keys(), ['a'])
+        store.close()
+        f = open(filename, 'r+b')
+        f.seek(4)
+        f.write('\xff')
+        f.close()
+        assert_raises(SerializationError, DocumentStore, filename)
+        f = open(filename, 'wb')
+        f.write('DMLT')
+        f.close()
+        assert_raises(SerializationError, DocumentStore, filename)
+    finally:
+        os.remove(filename)
+
+
+def test_truncated_store():
+    filename = _make_store([('a', '!html\0a'), ('b', '!html\0b')])
+    try:
+        f = open(filename, 'rb')
+        data = f.read()
+        f.close()
+        for size in xrange(len(data) - 2, 0, -1):
+            f = open(filename, 'wb')
+            f.write(data[:size])
+            f.close()
+            assert_raises(SerializationError, DocumentStore, filename)
+    finally:
+        os.remove(filename)
@@ -2,7 +2,7 @@
 
 from nose.tools import *
 from dmlt.utils import lstrip_ext, rstrip_ext, strip_ext, escape, unescape, \
-    replace_entities, striptags
+    replace_entities, striptags, escape_many, build_html_tag
 
 
 def test_lstrip():
@@ -25,6 +25,21 @@ def test_escape():
                         'you &amp; me are so &lt; then &gt;')
     assert_equal(escape('I love "foo" >> bar!', True),
                         'I love &quot;foo&quot; &gt;&gt; bar!')
+    assert_equal(escape(u'"&&"'), u'"&amp;&amp;"')
+    assert_equal(escape(None), '')
+    assert_equal(escape(42), u'42')
+    # strings without special chars are not copied
+    val = u'nothing to escape'
+    assert_true(escape(val, True) is val)
+
+
+def test_escape_many():
+    assert_equal(escape_many([u'a & b', u'', None, u'<"x">', 3], True),
+                 [u'a &amp; b', u'', u'', u'&lt;&quot;x&quot;&gt;', u'3'])
+    assert_equal(escape_many([u'a\0<', u'>']), [u'a\0&lt;', u'&gt;'])
+    assert_equal(escape_many([]), [])
+    assert_equal(escape_many(['b\xc3\xa4r & <', u'x']),
+                 [u'b\xe4r &amp; &lt;', u'x'])
 
 
 def test_unescape():
@@ -42,3 +57,21 @@ def test_striptags():
     assert_equal(striptags('foo <b>bar</b> foo<ins>baaaar</ins>'), u'foo bar foobaaaar')
     # test that tags etc. are stripped as well
     assert_equal(striptags('<fooo<bar>>baz'), u'>baz')
+
+
+def test_build_html_tag():
+    assert_equal(build_html_tag(u'strong', id=None, style=None,
+                                class_=None), u'<strong>')
+    assert_equal(build_html_tag(u'br'), u'<br />')
+    assert_equal(build_html_tag(u'span', classes=('underline', None)),
+                 u'<span class="underline">')
+    assert_equal(build_html_tag(u'span', style=u'a"b'),
+                 u'<span style=\'a"b\'>')
+    assert_equal(build_html_tag(u'span', class_=u'x', id=u'y'),
+                 build_html_tag(u'span', id=u'y', class_=u'x'))
+    assert_equal(build_html_tag(u'img', src=[u'unhashable']),
+                 u'<img src="[u\'unhashable\']" />')
+    # equal values of different types are rendered differently
+    assert_equal([build_html_tag(u'td', colspan=x) for x in (1, True, 1.0)],
+                 [u'<td colspan="1">', u'<td colspan="True">',
+                  u'<td colspan="1.0">'])
@@ -10,7 +10,6 @@
 """
 import re
 import locale
-from cPickle import loads, dumps, HIGHEST_PROTOCOL
 from htmlentitydefs import name2codepoint
 from xml.sax.saxutils import quoteattr
 from collections import defaultdict
@@ -25,6 +24,9 @@ EMPTY_TAGS = set(['br', 'img', 'area', 'hr', 'param', 'meta', 'link', 'base',
 _entity_re = re.compile(r'&([^;]+);')
 _strip_re = re.compile(r'<!--.*?-->|<[^>]*>(?s)')
 del name2codepoint
+#: memoized opening tags built by `build_html_tag`
+_html_tag_cache = {}
+_HTML_TAG_CACHE_SIZE = 1000
 
 
 def to_unicode(string, charset=None):
@@ -60,15 +62,41 @@ def encode(string, charset='utf-8'):
 def escape(val, quote=False):
     """
     SGML/XML escape an unicode object.
+
+    Strings without special characters are returned as they are, for
+    the others only the characters they contain are replaced.
     """
     if val is None:
         return ''
     elif not isinstance(val, basestring):
         val = unicode(val)
-    val = val.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-    if not quote:
-        return val
-    return val.replace('"', '&quot;')
+    if '&' in val:
+        val = val.replace('&', '&amp;')
+    if '<' in val:
+        val = val.replace('<', '&lt;')
+    if '>' in val:
+        val = val.replace('>', '&gt;')
+    if quote and '"' in val:
+        val = val.replace('"', '&quot;')
+    return val
+
+
+def escape_many(values, quote=False):
+    """
+    Escape a list of strings at once and return a list of the escaped
+    unicode strings.  The strings are joined and escaped in one go which
+    is faster than escaping many small strings on their own.
+    """
+    if not values:
+        return []
+    values = [u'' if x is None else
+              to_unicode(x) if isinstance(x, basestring) else unicode(x)
+              for x in values]
+    joined = u'\0'.join(values)
+    if joined.count(u'\0') != len(values) - 1:
+        # a string contains the separator
+        return [escape(x, quote) for x in values]
+    return escape(joined, quote).split(u'\0')
 
 
 def unescape(val):
@@ -154,6 +182,12 @@ def strip_ext(text, chars=None, num=None):
     return lstrip_ext(rstrip_ext(text, chars, num), chars, num)
 
 
+def _get_state(obj):
+    if hasattr(obj, '__getstate__'):
+        return obj.__getstate__()
+    return getattr(obj, '__dict__', {})
+
+
 def node_repr(obj):
     """
     A function that does a debug repr for an object. This is used by all the
@@ -163,7 +197,7 @@ def node_repr(obj):
         obj.__class__.__module__.rsplit('.', 1)[-1],
         obj.__class__.__name__,
         ', '.join('%s=%r' % (key, value)
-        for key, value in sorted(getattr(obj, '__dict__', {}).items()))
+        for key, value in sorted(_get_state(obj).items()))
     )
 
 
@@ -175,7 +209,7 @@ def parse_child_nodes(stream, node, until):
     `until`-type one so that you can `stream.expect` this token type.
     """
     children = []
-    while not stream._pushed and not stream.current.type == 'eof':
+    while not stream.eof:
         if isinstance(until, (list, tuple)):
             if stream.current.type in until: break
         else:
@@ -209,17 +243,26 @@ def filter_stream(stream, until, pop_none=True):
 
 def dump_tree(tree, format):
     """
-    Dump ``tree`` with the help of pickle.
+    Dump the children of ``tree``.  Adjacent strings are merged and if
+    there are only strings the result is a static document.  Trees that
+    contain nodes are dumped with `dmlt.serialize.dump_nodes`.
 
-    :param tree: The node-tree to pickle.
+    :param tree: The node-tree to dump.
     :param format: the output format that tree represents.
     """
+    return _dump_items(tree.children, format)
+
+
+def _dump_items(items, format):
+    """Dump a list of nodes and strings like `dump_tree`."""
+    # imported here as dmlt.node imports this module
+    from dmlt.serialize import dump_nodes
     assert not '\0' in format
     result = []
     text_buffer = []
     is_dynamic = False
 
-    for item in tree.children:
+    for item in items:
         if isinstance(item, basestring):
             text_buffer.append(item)
         else:
@@ -233,7 +276,7 @@ def dump_tree(tree, format):
 
     if not is_dynamic:
         return '!%s\0%s' % (format, u''.join(result).encode('utf-8'))
-    return '@' + dumps((format, result), HIGHEST_PROTOCOL)
+    return '#' + dump_nodes(result, format)
 
 
 def load_tree(obj):
@@ -241,17 +284,22 @@ def load_tree(obj):
     Load a node-tree from ``object``.
 
     ``object`` can be a node-tree (than it's just returned)
-    or a string-instance dumped by `dump_tree`.
+    or a string-instance dumped by `dump_tree`.  Dynamic trees dumped
+    with pickle by older versions are still loaded.
 
     :return: A tuple in the form of (instructions, node, format).
     """
+    from dmlt.serialize import load_nodes
     if isinstance(obj, str):
         node = None
         if obj[0] == '!':
             pos = obj.index('\0')
             format = obj[1:pos]
             instructions = [obj[pos+1:].decode('utf-8')]
+        elif obj[0] == '#':
+            format, instructions = load_nodes(obj[1:])
         elif obj[0] == '@':
+            from cPickle import loads
             format, instructions = loads(obj[1:])
     else:
         instructions = format = None
@@ -273,12 +321,32 @@ def _build_html_tag(tag, attrs):
 
 
 def build_html_tag(tag, class_=None, classes=None, **attrs):
-    """Build an HTML opening tag."""
+    """
+    Build an HTML opening tag.
+
+    The tags are memoized by the tag name and the names, types and
+    values of the attributes that are not `None`, so values that are
+    equal but rendered differently (like ``1``, ``True`` and ``1.0``)
+    don't share a tag.  Tags without attributes just cost a dict lookup.
+    """
     if classes:
         class_ = u' '.join(x for x in classes if x)
     if class_:
         attrs['class'] = class_
-    return _build_html_tag(tag, attrs)[0]
+    items = [x for x in attrs.iteritems() if x[1] is not None]
+    try:
+        key = items and (tag, frozenset((k, type(v), v)
+                                        for k, v in items)) or tag
+        return _html_tag_cache[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # unhashable attribute values
+        return _build_html_tag(tag, attrs)[0]
+    if len(_html_tag_cache) >= _HTML_TAG_CACHE_SIZE:
+        _html_tag_cache.clear()
+    rv = _html_tag_cache[key] = _build_html_tag(tag, dict(items))[0]
+    return rv
 
 
 def replace_entities(string):
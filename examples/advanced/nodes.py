@@ -25,8 +25,8 @@ class Emphasized(Element):
     def prepare_html(self):
         yield build_html_tag(u'em', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</em>'
 
 
@@ -35,8 +35,8 @@ class Strong(Element):
     def prepare_html(self):
         yield build_html_tag(u'strong', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</strong>'
 
 
@@ -48,8 +48,8 @@ class Underline(Element):
             style=self.style,
             classes=('underline', self.class_)
         )
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</span>'
 
 
@@ -58,8 +58,8 @@ class Small(Element):
     def prepare_html(self):
         yield build_html_tag(u'small', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</small>'
 
 
@@ -68,8 +68,8 @@ class Big(Element):
     def prepare_html(self):
         yield build_html_tag(u'big', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</big>'
 
 
@@ -78,8 +78,8 @@ class Sub(Element):
     def prepare_html(self):
         yield build_html_tag(u'sub', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</sub>'
 
 
@@ -88,6 +88,6 @@ class Sup(Element):
     def prepare_html(self):
         yield build_html_tag(u'sup', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</sup>'
@@ -29,8 +29,7 @@ class SimpleMarkupDirective(Directive):
     __directive_node__ = None
 
     def parse(self, stream):
-        dn = self.rule.enter
-        begin, end = '%s_begin' % dn, '%s_end' % dn
+        begin, end = self.rule.begin, self.rule.end
         stream.expect(begin)
         children = parse_child_nodes(stream, self, end)
         stream.expect(end)
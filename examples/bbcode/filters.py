@@ -1,6 +1,6 @@
 #-*- coding: utf-8 -*-
 import re
-from dmlt import events
+from dmlt.filters import NodeFilter
 import nodes
 
 
@@ -33,45 +33,48 @@ def joined_text_iter(node):
         yield item
 
 
-@events.register('process-doc-tree')
-def process(emanager, parent, ctx):
+class ParagraphFilter(NodeFilter):
     """
-    Insert real paragraphs into the node and return it.
+    Insert real paragraphs into the containers that allow them.
     """
-    for node in parent.children:
-        if node.is_container and not node.is_raw:
-            process(node, ctx)
+    node_types = (nodes.Container,)
 
-    if not parent.allows_paragraphs:
-        return parent
+    def enter(self, node, ctx):
+        # the content of raw nodes is left alone
+        if node.is_raw:
+            return False
 
-    paragraphs = [[]]
+    def leave(self, parent, ctx):
+        if parent.is_raw or not parent.allows_paragraphs:
+            return
 
-    for child in joined_text_iter(parent):
-        if child.is_text_node:
-            blockiter = iter(_paragraph_re.split(child.text))
-            for block in blockiter:
-                try:
-                    is_paragraph = blockiter.next()
-                except StopIteration:
-                    is_paragraph = False
-                if block:
-                    paragraphs[-1].append(nodes.Text(block))
-                if is_paragraph:
-                    paragraphs.append([])
-        elif child.is_block_tag:
-            paragraphs.extend((child, []))
-        else:
-            paragraphs[-1].append(child)
+        paragraphs = [[]]
 
-    del parent.children[:]
-    for paragraph in paragraphs:
-        if not isinstance(paragraph, list):
-            parent.children.append(paragraph)
-        else:
-            for node in paragraph:
-                if not node.is_text_node or node.text:
-                    parent.children.append(nodes.Paragraph(paragraph))
-                    break
+        for child in joined_text_iter(parent):
+            if child.is_text_node:
+                blockiter = iter(_paragraph_re.split(child.text))
+                for block in blockiter:
+                    try:
+                        is_paragraph = blockiter.next()
+                    except StopIteration:
+                        is_paragraph = False
+                    if block:
+                        paragraphs[-1].append(nodes.Text(block))
+                    if is_paragraph:
+                        paragraphs.append([])
+            elif child.is_block_tag:
+                paragraphs.extend((child, []))
+            else:
+                paragraphs[-1].append(child)
+
+        del parent.children[:]
+        for paragraph in paragraphs:
+            if not isinstance(paragraph, list):
+                parent.children.append(paragraph)
+            else:
+                for node in paragraph:
+                    if not node.is_text_node or node.text:
+                        parent.children.append(nodes.Paragraph(paragraph))
+                        break
 
-    return parent
+nodes.scope.connect('process-doc-tree', ParagraphFilter())
@@ -4,6 +4,10 @@ from dmlt.node import Node as BaseNode, Container as BaseContainer, Text as Base
 from dmlt.utils import escape, build_html_tag, lstrip_ext
 
 
+#: the events of the `BBCodeMarkupMachine`
+scope = events.EventManager()
+
+
 class Node(BaseNode):
     allows_paragraphs = False
     is_paragraph = False
@@ -26,9 +30,7 @@ class Container(Node):
         return u''.join(x.text for x in self.children)
 
     def prepare_html(self):
-        for child in self.children:
-            for item in child.prepare_html():
-                yield item
+        return iter(self.children)
 
 
 class Document(Container):
@@ -38,7 +40,7 @@ class Document(Container):
     is_document = True
     allows_paragraphs = True
 
-@events.register('define-document-node')
+@scope.register('define-document-node')
 def _handle_define_document_node(manager, *args, **kwargs):
     return Document
 
@@ -1,6 +1,5 @@
 #-*- coding: utf-8 -*-
 import re
-from dmlt import events
 from dmlt.machine import MarkupMachine, Directive, RawDirective, \
                          rule, bygroups
 from dmlt.utils import parse_child_nodes, filter_stream
@@ -111,7 +110,7 @@ class TextDirective(RawDirective):
 
     def parse(self, stream):
         return nodes.Text(stream.expect('text').value)
-@events.register('define-raw-directive')
+@nodes.scope.register('define-raw-directive')
 def _handle_define_raw_Directive(*args, **kwargs):
     return TextDirective
 
@@ -128,15 +127,18 @@ class SimpleBBCodeDirective(Directive):
     __directive_node__ = None
     name = None
 
-    @property
-    def rules(self):
-        return [
+    def __init__(self, machine, escaping_enabled=False):
+        Directive.__init__(self, machine, escaping_enabled)
+        self._rules = [
             rule(make_bbcode_tag(self.name), enter=self.name),
             rule(make_bbcode_end(self.name), leave=self.name)]
 
+    @property
+    def rules(self):
+        return self._rules
+
     def parse(self, stream):
-        dn = self.name
-        begin, end = '%s_begin' % dn, '%s_end' % dn
+        begin, end = self._rules[0].begin, self._rules[1].end
         stream.expect(begin)
         children = parse_child_nodes(stream, self, end)
         stream.expect(end)
@@ -276,6 +278,7 @@ class BBCodeMarkupMachine(MarkupMachine):
                   UnderlineDirective, ColorDirective, ListDirective,
                   QuoteDirective, UrlDirective]
     restrictive_mode = True
+    event_scope = nodes.scope
 
 
 TESTTEXT = u'''\
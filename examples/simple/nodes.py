@@ -111,8 +111,8 @@ class Span(Element):
             style=self.style,
             class_=self.class_,
         )
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</span>'
 
 
@@ -140,8 +140,8 @@ class Link(Element):
             title=self.title,
             href=self.href
         )
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</a>'
 
 
@@ -158,8 +158,8 @@ class Paragraph(Element):
     def prepare_html(self):
         yield build_html_tag(u'p', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</p>'
 
 
@@ -175,8 +175,8 @@ class Error(Element):
             style=self.style,
             classes=('error', self.class_)
         )
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</div>'
 
 
@@ -189,8 +189,8 @@ class Preformatted(Element):
     def prepare_html(self):
         yield build_html_tag(u'pre', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</pre>'
 
 
@@ -213,8 +213,8 @@ class Headline(Element):
             style=self.style,
             class_=self.class_
         )
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield (u'<a title="Link to %s" class="anchor" href="#%s">#</a>'
                % (self.id, self.id))
         yield u'</h%d>' % (self.level)
@@ -229,8 +229,8 @@ class Strong(Element):
     def prepare_html(self):
         yield build_html_tag(u'strong', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</strong>'
 
 
@@ -243,8 +243,8 @@ class Emphasized(Element):
     def prepare_html(self):
         yield build_html_tag(u'em', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</em>'
 
 
@@ -258,8 +258,8 @@ class Code(Element):
     def prepare_html(self):
         yield build_html_tag(u'code', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</code>'
 
 
@@ -277,8 +277,8 @@ class Underline(Element):
             style=self.style,
             classes=('underline', self.class_)
         )
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</span>'
 
 
@@ -290,8 +290,8 @@ class Stroke(Element):
     def prepare_html(self):
         yield build_html_tag(u'del', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</del>'
 
 
@@ -304,8 +304,8 @@ class Small(Element):
     def prepare_html(self):
         yield build_html_tag(u'small', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</small>'
 
 
@@ -317,8 +317,8 @@ class Big(Element):
     def prepare_html(self):
         yield build_html_tag(u'big', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</big>'
 
 
@@ -330,8 +330,8 @@ class Sub(Element):
     def prepare_html(self):
         yield build_html_tag(u'sub', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</sub>'
 
 
@@ -343,6 +343,6 @@ class Sup(Element):
     def prepare_html(self):
         yield build_html_tag(u'sup', id=self.id, style=self.style,
                              class_=self.class_)
-        for item in Element.prepare_html(self):
-            yield item
+        for child in self.children:
+            yield child
         yield u'</sup>'
@@ -26,7 +26,11 @@ class TextDirective(RawDirective):
     def parse(self, stream):
         return nodes.Text(stream.expect('text').value)
 
-@events.register('define-raw-directive')
+#: the events of the `SimpleMarkupMachine`
+scope = events.EventManager()
+
+
+@scope.register('define-raw-directive')
 def _handle_register_raw_directive(mnager, *args, **kwargs):
     return TextDirective
 
@@ -201,6 +205,7 @@ class SimpleMarkupMachine(MarkupMachine):
                   SuperscriptDirective, SubscriptDirective, StrokeDirective,
                   HeadlineDirective, CodeDirective, RulerDirective]
     special_directives = [TextDirective]
+    event_scope = scope
 
 def main():
     text=u'''
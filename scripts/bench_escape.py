@@ -0,0 +1,61 @@
+#-*- coding: utf-8 -*-
+"""
+Compare `dmlt.utils.escape` and `escape_many` with the old chained
+replace implementation on the text of the bundled example documents.
+
+Run from the root of the repository:
+
+    python scripts/bench_escape.py
+"""
+import os
+import sys
+from timeit import Timer
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [root, os.path.join(root, 'examples')]
+
+from dmlt.utils import escape, escape_many
+
+
+def old_escape(val, quote=False):
+    if val is None:
+        return ''
+    elif not isinstance(val, basestring):
+        val = unicode(val)
+    val = val.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    if not quote:
+        return val
+    return val.replace('"', '&quot;')
+
+
+def get_corpora():
+    from advanced.parser import TESTTEXT, AdvancedMarkupMachine
+    from bbcode.parser import text, BBCodeMarkupMachine
+    from simple.parser import SimpleMarkupMachine
+    simple = u"**bold __ underline __ ''italic'' **\n== Headline ==\n" \
+             u"[http://iamalink.xy alt text]\n{{{\n  a < b && c > d\n}}}\n"
+    for name, machine, raw in (('advanced', AdvancedMarkupMachine, TESTTEXT),
+                               ('bbcode', BBCodeMarkupMachine, text),
+                               ('simple', SimpleMarkupMachine, simple)):
+        fragments = [t.value for t in machine().tokenize(raw)
+                     if t.value] * 20
+        yield name, fragments
+
+
+def bench(func, number=200):
+    return min(Timer(func).repeat(3, number)) / number * 1000
+
+
+def main():
+    print '%-10s %10s %10s %10s %10s' % ('corpus', 'fragments', 'old ms',
+                                         'escape ms', 'batch ms')
+    for name, fragments in get_corpora():
+        assert [old_escape(x) for x in fragments] == escape_many(fragments)
+        print '%-10s %10d %10.3f %10.3f %10.3f' % (name, len(fragments),
+            bench(lambda: [old_escape(x) for x in fragments]),
+            bench(lambda: [escape(x) for x in fragments]),
+            bench(lambda: escape_many(fragments)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#-*- coding: utf-8 -*-
+"""
+Compare the memory used by trees of the slot based core nodes with
+trees of nodes that keep their attributes in an instance dict like
+the nodes of older versions did.
+
+Run from the root of the repository:
+
+    python scripts/bench_memory.py [paragraphs]
+"""
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from dmlt.node import Document, Container, Text, HTML
+
+
+class DictNode(object):
+    """A node with an instance dict, the layout of older versions."""
+
+
+class DictText(DictNode):
+
+    def __init__(self, text):
+        self.text = text
+
+
+class DictHTML(DictNode):
+
+    def __init__(self, html):
+        self.html = html
+
+
+class DictContainer(DictNode):
+
+    def __init__(self, children):
+        self.children = children
+
+
+def build(document, container, text, html, paragraphs):
+    return document([container([text(u'Lorem ipsum '),
+                                container([text(u'dolor'), html(u'<br />')]),
+                                text(u' sit amet.')])
+                     for x in xrange(paragraphs)])
+
+
+def deep_size(tree):
+    """The size of all nodes, their dicts and lists (not the strings)."""
+    seen = set()
+    size = 0
+    stack = [tree]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, basestring):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, list):
+            stack.extend(obj)
+            continue
+        if hasattr(obj, '__dict__'):
+            size += sys.getsizeof(obj.__dict__)
+            stack.extend(obj.__dict__.values())
+        children = getattr(obj, 'children', None)
+        if children is not None and id(children) not in seen:
+            stack.append(children)
+    return size
+
+
+def main():
+    paragraphs = len(sys.argv) > 1 and int(sys.argv[1]) or 10000
+    nodes = paragraphs * 6 + 1
+    before = deep_size(build(DictContainer, DictContainer, DictText,
+                             DictHTML, paragraphs))
+    after = deep_size(build(Document, Container, Text, HTML, paragraphs))
+    print '%d nodes' % nodes
+    print '%-8s %12s %10s' % ('layout', 'bytes', 'per node')
+    print '%-8s %12d %10.1f' % ('dict', before, float(before) / nodes)
+    print '%-8s %12d %10.1f' % ('slots', after, float(after) / nodes)
+    print 'saved %.1f%%' % (100 - after * 100.0 / before)
+
+
+if __name__ == '__main__':
+    main()
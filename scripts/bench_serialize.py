@@ -0,0 +1,60 @@
+#-*- coding: utf-8 -*-
+"""
+Compare the dmlt.serialize format with pickle for the trees of the
+bundled examples.
+
+Run from the root of the repository:
+
+    python scripts/bench_serialize.py
+"""
+import os
+import sys
+from timeit import Timer
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [root, os.path.join(root, 'examples')]
+
+from dmlt.node import Container
+from dmlt.serialize import dump_nodes, load_nodes
+
+
+PROSE = u'Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
+
+
+def get_trees():
+    from bbcode.parser import BBCodeMarkupMachine
+    from simple.parser import SimpleMarkupMachine
+    bbcode = (PROSE * 5 + u'[b]bold [i]it[/i][/b] [url=http://x.y]link'
+              u'[/url]\n') * 50
+    simple = (PROSE * 5 + u"**bold ''it''** [http://x.y link]\n") * 50
+    deep = PROSE
+    for x in xrange(300):
+        deep = u'[quote]%s[/quote]' % deep
+    return [('bbcode', BBCodeMarkupMachine().parse(bbcode)),
+            ('simple', SimpleMarkupMachine().parse(simple)),
+            ('nested', BBCodeMarkupMachine().parse(deep))]
+
+
+def bench(func, number=20):
+    return min(Timer(func).repeat(3, number)) / number * 1000
+
+
+def main():
+    print '%-8s %-8s %10s %10s %10s' % ('tree', 'format', 'size',
+                                        'dump ms', 'load ms')
+    for name, tree in get_trees():
+        data = dump_nodes(tree)
+        print '%-8s %-8s %10d %10.3f %10.3f' % (name, 'dmlt', len(data),
+            bench(lambda: dump_nodes(tree)), bench(lambda: load_nodes(data)))
+        try:
+            pickled = dumps(tree, HIGHEST_PROTOCOL)
+            print '%-8s %-8s %10d %10.3f %10.3f' % (name, 'pickle',
+                len(pickled), bench(lambda: dumps(tree, HIGHEST_PROTOCOL)),
+                bench(lambda: loads(pickled)))
+        except RuntimeError:
+            print '%-8s %-8s %s' % (name, 'pickle', 'recursion limit')
+
+
+if __name__ == '__main__':
+    main()
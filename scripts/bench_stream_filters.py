@@ -0,0 +1,76 @@
+#-*- coding: utf-8 -*-
+"""
+Time token-filters one by one and composed into one generator chain,
+compared with a whole-stream callback that drains and rebuilds the
+`TokenStream`.
+
+Run from the root of the repository:
+
+    python scripts/bench_stream_filters.py
+"""
+import os
+import sys
+from timeit import Timer
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [root, os.path.join(root, 'examples')]
+
+from dmlt.datastructure import Token, TokenStream, Context
+from dmlt.filters import TokenFilter, TokenFilterChain
+
+
+class DropEmpty(TokenFilter):
+    """Drop tokens without a value (uses `filter`)."""
+
+    def filter(self, tokens, ctx):
+        for token in tokens:
+            if token.value:
+                yield token
+
+
+class StripValues(TokenFilter):
+    """Strip the values of raw tokens (uses `process`)."""
+
+    def process(self, token, ctx):
+        if token.type == 'raw':
+            token = Token(token.type, token.value.strip(), token.directive,
+                          token.end_of_context)
+        return (token,)
+
+
+def rebuild(stream, ctx):
+    """A whole-stream callback that drains and rebuilds the stream."""
+    return TokenStream(iter([x for x in stream if x.value]))
+
+
+def bench(func, number=20):
+    return min(Timer(func).repeat(3, number)) / number * 1000
+
+
+def main():
+    from bbcode.parser import BBCodeMarkupMachine
+    machine = BBCodeMarkupMachine()
+    raw = (u'Lorem ipsum [b]dolor[/b] sit [i]amet[/i], '
+           u'[url=http://x.y]link[/url]\n\n') * 500
+    ctx = Context(machine, False)
+    tokens = list(machine.tokenize(raw))
+
+    def run(apply):
+        for x in apply(iter(tokens)):
+            pass
+
+    print '%d tokens' % len(tokens)
+    print '%-22s %10s' % ('stage', 'ms')
+    print '%-22s %10.3f' % ('none', bench(lambda: run(lambda x: x)))
+    for f in (DropEmpty(), StripValues()):
+        print '%-22s %10.3f' % (f.__class__.__name__,
+            bench(lambda: run(lambda x: f.filter(x, ctx))))
+    chain = TokenFilterChain([DropEmpty(), StripValues()])
+    print '%-22s %10.3f' % ('chain', bench(lambda: run(lambda x:
+                                                        chain.apply(x, ctx))))
+    print '%-22s %10.3f' % ('rebuilt stream', bench(lambda: run(lambda x:
+        iter(rebuild(TokenStream(x), ctx)))))
+
+
+if __name__ == '__main__':
+    main()